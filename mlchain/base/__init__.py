@@ -1,5 +1,7 @@
 from mlchain.base.serializer import JsonSerializer, MsgpackSerializer, MsgpackBloscSerializer, \
     JpgMsgpackSerializer, PngMsgpackSerializer
-from .serve_model import ServeModel, non_thread, batch
+from .serve_model import ServeModel, non_thread, batch, cache, warmup, limit, max_content_length, \
+    compression
+from .registry import ModelRegistry
 from .log import logger
 from .converter import Converter, AsyncConverter
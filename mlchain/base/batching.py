@@ -0,0 +1,715 @@
+"""
+Background batch collectors used by the @batch decorator
+"""
+import os
+import sys
+import time
+import asyncio
+import inspect
+import weakref
+import functools
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Event, Lock, Thread, local
+import numpy as np
+from .exceptions import MlChainError, MLChainBusyError
+from .metrics import registry, SIZE_BUCKETS
+from mlchain.context import mlchain_context
+
+BATCH_SIZE = registry.histogram('mlchain_batch_size', 'Items of the executed batches',
+                                ['function'], buckets=SIZE_BUCKETS)
+BATCH_DURATION = registry.histogram('mlchain_batch_duration_seconds', 'Execution time of the batches',
+                                    ['function'])
+
+
+def estimate_size(value):
+    """
+    Cheap estimate of the payload bytes held by a value
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, memoryview):
+        return value.nbytes
+    if isinstance(value, (list, tuple, set)):
+        return sum(estimate_size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(estimate_size(v) for v in value.values())
+    return sys.getsizeof(value)
+
+
+def shape_bucket_key(variable, granularity=1):
+    """
+    Bucket key of one call: the shape of an ndarray argument, or the length of a
+    sequence argument, rounded up to a multiple of granularity
+    """
+    granularity = max(int(granularity), 1)
+
+    def get_key(params):
+        value = params[variable]
+        if isinstance(value, np.ndarray):
+            shape = value.shape
+        elif hasattr(value, '__len__'):
+            shape = (len(value),)
+        else:
+            return None
+        return tuple(-(-dim // granularity) * granularity for dim in shape)
+    return get_key
+
+
+class PaddingBuffer:
+    """
+    Reusable contiguous buffer that variable-shaped ndarrays are padded into
+    """
+
+    def __init__(self, pad_value=0):
+        self.pad_value = pad_value
+        self.raw = None
+        self.returned = None
+
+    def _take(self, shape, dtype):
+        count = int(np.prod(shape))
+        if np.dtype(dtype).hasobject:
+            return np.empty(shape, dtype=dtype)
+        nbytes = count * np.dtype(dtype).itemsize
+        # Every view of the handed out array has it as its base, so the weak reference
+        # stays alive while any part of the last batch is still in use
+        in_use = self.returned is not None and self.returned() is not None
+        if self.raw is None or len(self.raw) < nbytes or in_use:
+            self.raw = bytearray(max(nbytes, 1))
+        flat = np.frombuffer(self.raw, dtype=dtype, count=count)
+        self.returned = weakref.ref(flat)
+        return flat.reshape(shape)
+
+    def pad(self, values):
+        """
+        Pad ndarrays of the same ndim into one (n, *max_shape) tensor.
+        Return the tensor, a boolean mask of the valid region and the original shapes
+        """
+        values = [np.asarray(value) for value in values]
+        ndims = set(value.ndim for value in values)
+        if len(ndims) != 1:
+            raise MlChainError("Can't pad arrays with different ndim {0}".format(sorted(ndims)))
+        shapes = [value.shape for value in values]
+        max_shape = tuple(max(dims) for dims in zip(*shapes))
+        dtype = np.result_type(*values)
+
+        tensor = self._take((len(values),) + max_shape, dtype)
+        tensor.fill(self.pad_value)
+        mask = np.zeros(tensor.shape, dtype=bool)
+        for idx, value in enumerate(values):
+            region = (idx,) + tuple(slice(0, dim) for dim in value.shape)
+            tensor[region] = value
+            mask[region] = True
+        return tensor, mask, shapes
+
+
+class BatchQueue:
+    """
+    FIFO queue of batch items grouped into buckets.
+    Without a bucket key every item goes to the same bucket.
+    """
+
+    def __init__(self):
+        self.buckets = OrderedDict()
+        self.size = 0
+        self.bytes = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, item):
+        bucket = self.buckets.get(item.bucket)
+        if bucket is None:
+            bucket = self.buckets[item.bucket] = deque()
+        bucket.append(item)
+        self.size += 1
+        self.bytes += item.size
+
+    def oldest_arrival(self):
+        return min(bucket[0].arrival for bucket in self.buckets.values())
+
+    def has_full_bucket(self, batch_size):
+        return any(len(bucket) >= batch_size for bucket in self.buckets.values())
+
+    def _pick_bucket(self, batch_size):
+        full = [key for key, bucket in self.buckets.items() if len(bucket) >= batch_size]
+        keys = full if len(full) > 0 else self.buckets.keys()
+        return min(keys, key=lambda key: self.buckets[key][0].arrival)
+
+    def pop_batch(self, batch_size):
+        """
+        Pop up to batch_size live items of one bucket, preferring full buckets
+        and then the bucket holding the oldest item
+        """
+        items = []
+        while len(items) == 0 and self.size > 0:
+            key = self._pick_bucket(batch_size)
+            bucket = self.buckets[key]
+            while len(bucket) > 0 and len(items) < batch_size:
+                item = bucket.popleft()
+                self.size -= 1
+                self.bytes -= item.size
+                if not item.cancelled:
+                    items.append(item)
+            if len(bucket) == 0:
+                del self.buckets[key]
+        return items
+
+
+class AdaptiveBatchSize:
+    """
+    Pick the largest batch size whose p99 latency stays under a target.
+    Batch execution time is fitted as intercept + slope * batch_size over a window
+    of recent batches. The p99 latency of a size is the batching deadline plus the
+    fitted time plus the p99 of the fit residuals.
+    """
+
+    def __init__(self, latency_target_ms, max_batch_size, min_batch_size=1, max_wait_ms=0,
+                 window=256, update_every=8):
+        self.latency_target = float(latency_target_ms) / 1000
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.min_batch_size = min(max(int(min_batch_size), 1), self.max_batch_size)
+        self.max_wait = max(float(max_wait_ms or 0), 0) / 1000
+        self.update_every = update_every
+        self.observations = deque(maxlen=window)
+        self.batch_size = self.max_batch_size
+        self.intercept = None
+        self.slope = None
+        self.p99_residual = None
+        self._count = 0
+        self._lock = Lock()
+
+    def record(self, batch_size, elapsed):
+        with self._lock:
+            self.observations.append((batch_size, elapsed))
+            self._count += 1
+            if self._count % self.update_every == 0:
+                self._update()
+
+    def _fit(self):
+        sizes = np.array([size for size, _ in self.observations], dtype=np.float64)
+        times = np.array([elapsed for _, elapsed in self.observations], dtype=np.float64)
+        if len(np.unique(sizes)) > 1:
+            slope, intercept = np.polyfit(sizes, times, 1)
+        else:
+            # A single observed size can't separate fixed and per-item cost, assume all per-item
+            slope, intercept = times.mean() / sizes[0], 0.0
+        slope = max(float(slope), 0.0)
+        intercept = max(float(intercept), 0.0)
+        residuals = times - (intercept + slope * sizes)
+        p99_residual = max(float(np.percentile(residuals, 99)), 0.0)
+        return intercept, slope, p99_residual
+
+    def _update(self):
+        self.intercept, self.slope, self.p99_residual = self._fit()
+        budget = self.latency_target - self.max_wait - self.intercept - self.p99_residual
+        if self.slope == 0:
+            size = self.max_batch_size
+        else:
+            size = int(budget // self.slope)
+        # Grow step by step so the fit is checked against real batches of the new size
+        size = min(size, self.batch_size * 2)
+        self.batch_size = min(max(size, self.min_batch_size), self.max_batch_size)
+
+    def predict(self, batch_size):
+        """
+        Predicted p99 latency in seconds of a batch of batch_size items
+        """
+        if self.slope is None:
+            return None
+        return self.max_wait + self.intercept + self.slope * batch_size + self.p99_residual
+
+    def status(self):
+        with self._lock:
+            curve = None
+            if self.slope is not None:
+                curve = {
+                    'intercept_ms': round(self.intercept * 1000, 3),
+                    'slope_ms_per_item': round(self.slope * 1000, 3),
+                    'p99_residual_ms': round(self.p99_residual * 1000, 3),
+                    'predicted_p99_ms': round(self.predict(self.batch_size) * 1000, 3)
+                }
+            return {
+                'latency_target_ms': round(self.latency_target * 1000, 3),
+                'batch_size': self.batch_size,
+                'observations': len(self.observations),
+                'curve': curve
+            }
+
+
+class BatchItem:
+    """
+    One queued call of a batched function
+    """
+    __slots__ = ('params', 'size', 'bucket', 'arrival', 'started', 'elapsed', 'event', 'output', 'exception',
+                 'cancelled')
+
+    def __init__(self, params, size=0, bucket=None):
+        self.params = params
+        self.size = size
+        self.bucket = bucket
+        self.arrival = time.monotonic()
+        self.started = None
+        self.elapsed = None
+        self.event = Event()
+        self.output = None
+        self.exception = None
+        self.cancelled = False
+
+
+class AsyncBatchItem:
+    """
+    One queued call of a batched function, awaited through an asyncio Future
+    """
+    __slots__ = ('params', 'size', 'bucket', 'arrival', 'started', 'elapsed', 'future')
+
+    def __init__(self, params, future, size=0, bucket=None):
+        self.params = params
+        self.size = size
+        self.bucket = bucket
+        self.arrival = time.monotonic()
+        self.started = None
+        self.elapsed = None
+        self.future = future
+
+    @property
+    def cancelled(self):
+        return self.future.done()
+
+
+class BatchCollector:
+    """
+    Collect single calls into batches in a dedicated thread.
+    A batch is flushed when max_batch_size items are queued or when the oldest
+    queued item has waited max_wait_ms milliseconds, whichever comes first.
+    New calls are rejected with 429 when the queue holds max_queue items, when the
+    queued payload would exceed max_queue_bytes, or when the estimated wait is
+    longer than max_queue_delay_ms (the call timeout by default).
+    With an AdaptiveBatchSize controller the flush size follows the controller,
+    bounded by max_batch_size.
+    With a bucket_key, only calls with the same key are batched together, and
+    the batch variables listed in pad are padded into one contiguous tensor.
+    With a ReplicaPool, one batch runs on each free replica at the same time.
+    """
+
+    def __init__(self, batch_func, variable_names, default=None, timeout=-1,
+                 name='single_func', max_queue=100, max_batch_size=32, max_wait_ms=0,
+                 max_queue_bytes=None, max_queue_delay_ms=None, controller=None,
+                 bucket_key=None, pad=None, pad_value=0):
+        self.batch_func = batch_func
+        self.variable_names = variable_names
+        self.default = default or {}
+        self.timeout = timeout if timeout is not None and timeout > 0 else None
+        self.name = name
+        self.max_queue = max_queue
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.max_wait = max(float(max_wait_ms or 0), 0) / 1000
+        self.max_queue_bytes = max_queue_bytes
+        if max_queue_delay_ms is not None:
+            self.max_queue_delay = float(max_queue_delay_ms) / 1000
+        else:
+            self.max_queue_delay = self.timeout
+        self.controller = controller
+        self.bucket_key = bucket_key
+        if isinstance(pad, str):
+            pad = [pad]
+        self.padding_buffers = {variable: PaddingBuffer(pad_value) for variable in pad or []}
+        self.replica_pool = None
+        self.batch_attribute = None
+        # Moving average of the execution time of one batch
+        self.batch_time = 0
+
+        self._start_lock = Lock()
+        self._closing = False
+        self._reset()
+
+    def _reset(self):
+        self.queue = BatchQueue()
+        self.condition = Condition()
+        self._thread = None
+        self._executor = None
+        self._local = local()
+        self._pid = os.getpid()
+
+    def close(self):
+        """
+        Stop the collector once its queued calls are done, e.g. after a model swap
+        """
+        with self.condition:
+            self._closing = True
+            self.condition.notify_all()
+
+    def use_replicas(self, replica_pool, batch_attribute):
+        """
+        Run batches on replicas of the pool, calling their batch_attribute method
+        """
+        self.replica_pool = replica_pool
+        self.batch_attribute = batch_attribute
+
+    def _get_executor(self):
+        if self._executor is None:
+            max_workers = self.replica_pool.size if self.replica_pool is not None else 1
+            self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                                thread_name_prefix="mlchain-batch-{0}".format(self.name))
+        return self._executor
+
+    def _get_batch_func(self, replica):
+        if replica is None:
+            return self.batch_func
+        return getattr(replica, self.batch_attribute)
+
+    @property
+    def queued_bytes(self):
+        return self.queue.bytes
+
+    @property
+    def batch_size(self):
+        if self.controller is not None:
+            return self.controller.batch_size
+        return self.max_batch_size
+
+    def status(self):
+        return {
+            'queue': len(self.queue),
+            'queued_bytes': self.queued_bytes,
+            'batch_size': self.batch_size,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': round(self.max_wait * 1000, 3),
+            'batch_time_ms': round(self.batch_time * 1000, 3),
+            'buckets': len(self.queue.buckets)
+        }
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                # Threads don't survive fork, e.g. gunicorn with preload_app
+                self._reset()
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="mlchain-batch-{0}".format(self.name),
+                                      daemon=True)
+                self._thread.start()
+
+    def submit(self, params):
+        """
+        Queue one call and block until its output is ready
+        """
+        self._ensure_started()
+        item = BatchItem(params, self._estimate_size(params), self._get_bucket(params))
+        with self.condition:
+            self._admit(item)
+            self.queue.push(item)
+            self.condition.notify()
+            if self._thread is None:
+                # The collector was closed and has already stopped
+                self._ensure_started()
+
+        if not item.event.wait(self.timeout):
+            item.cancelled = True
+            raise MlChainError("Timeout batch", code="T002", status_code=408)
+        self._add_timings(item)
+        if item.exception is not None:
+            raise item.exception
+        return item.output
+
+    def _get_bucket(self, params):
+        if self.bucket_key is None:
+            return None
+        return self.bucket_key(params)
+
+    def _estimate_size(self, params):
+        if self.max_queue_bytes is None:
+            return 0
+        return sum(estimate_size(value) for value in params.values())
+
+    def estimate_wait(self):
+        """
+        Estimated seconds until a newly queued call gets its output
+        """
+        waiting_batches = len(self.queue) // self.batch_size + 1
+        return self.max_wait + waiting_batches * self.batch_time
+
+    def _admit(self, item):
+        estimated_wait = self.estimate_wait()
+        if len(self.queue) >= self.max_queue:
+            reason = "{0} calls are queued".format(len(self.queue))
+        elif self.max_queue_bytes is not None and len(self.queue) > 0 \
+                and self.queued_bytes + item.size > self.max_queue_bytes:
+            reason = "{0} bytes are queued".format(self.queued_bytes)
+        elif self.max_queue_delay is not None and len(self.queue) > 0 \
+                and estimated_wait > self.max_queue_delay:
+            reason = "estimated wait is {0:.3f}s".format(estimated_wait)
+        else:
+            return
+        raise MLChainBusyError("Serve busy, {0}".format(reason), retry_after=estimated_wait)
+
+    def _add_timings(self, item):
+        """
+        Add the queue wait and the batch execution of a call to its Server-Timing
+        """
+        if item.started is not None:
+            mlchain_context.add_timing('queue', item.started - item.arrival)
+        if item.elapsed is not None:
+            mlchain_context.add_timing('batch', item.elapsed)
+
+    def _record_batch_time(self, items, elapsed):
+        for item in items:
+            item.elapsed = elapsed
+        batch_size = len(items)
+        BATCH_SIZE.observe(batch_size, function=self.name)
+        BATCH_DURATION.observe(elapsed, function=self.name)
+        if self.controller is not None:
+            self.controller.record(batch_size, elapsed)
+        if self.batch_time == 0:
+            self.batch_time = elapsed
+        else:
+            self.batch_time = 0.8 * self.batch_time + 0.2 * elapsed
+
+    def _collect(self):
+        with self.condition:
+            while len(self.queue) == 0:
+                if self._closing:
+                    self._thread = None
+                    return None
+                self.condition.wait()
+            deadline = self.queue.oldest_arrival() + self.max_wait
+            while not self.queue.has_full_bucket(self.batch_size):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.queue.pop_batch(self.batch_size)
+
+    def _run(self):
+        while True:
+            if self.replica_pool is None:
+                items = self._collect()
+                if items is None:
+                    return
+                kwargs = self._prepare(items)
+                if kwargs is not None:
+                    self._execute(items, kwargs)
+                continue
+
+            # Wait for a free replica first so the next batch keeps filling meanwhile
+            replica = self.replica_pool.get(None)
+            items = self._collect()
+            if items is None:
+                self.replica_pool.put(replica)
+                return
+            kwargs = self._prepare(items)
+            if kwargs is None:
+                self.replica_pool.put(replica)
+                continue
+            self._get_executor().submit(self._execute_on_replica, items, kwargs, replica)
+
+    def _execute_on_replica(self, items, kwargs, replica):
+        try:
+            self._execute(items, kwargs, replica)
+        finally:
+            self.replica_pool.put(replica)
+
+    def _call_batch_func(self, kwargs, replica=None):
+        outputs = self._get_batch_func(replica)(**kwargs, **self.default)
+        if inspect.isawaitable(outputs):
+            # async def batch functions run on a private loop of the executing thread
+            loop = getattr(self._local, 'loop', None)
+            if loop is None:
+                loop = self._local.loop = asyncio.new_event_loop()
+            outputs = loop.run_until_complete(outputs)
+        return outputs
+
+    def _prepare(self, items):
+        """
+        Build the batch kwargs of items, or fail them and return None
+        """
+        if len(items) == 0:
+            return None
+        try:
+            return self._build_kwargs(items)
+        except Exception as ex:
+            self._fail(items, ex)
+            return None
+
+    def _fail(self, items, exception):
+        for item in items:
+            item.exception = exception
+            item.event.set()
+
+    def _build_kwargs(self, items):
+        kwargs = {variable: [item.params[name] for item in items]
+                  for variable, name in self.variable_names.items()}
+        for variable, buffer in self.padding_buffers.items():
+            tensor, mask, shapes = buffer.pad(kwargs[variable])
+            kwargs[variable] = tensor
+            kwargs['{0}_mask'.format(variable)] = mask
+            kwargs['{0}_shapes'.format(variable)] = shapes
+        return kwargs
+
+    def _check_outputs(self, outputs, items):
+        if not hasattr(outputs, '__len__'):
+            outputs = list(outputs)
+        if len(outputs) != len(items):
+            raise MlChainError("Batch function {0} returned {1} outputs for {2} inputs".format(
+                self.name, len(outputs), len(items)))
+        return outputs
+
+    def _execute(self, items, kwargs, replica=None):
+        start_time = time.monotonic()
+        for item in items:
+            item.started = start_time
+        try:
+            outputs = self._call_batch_func(kwargs, replica)
+            outputs = self._check_outputs(outputs, items)
+        except Exception as ex:
+            self._fail(items, ex)
+            return
+        finally:
+            self._record_batch_time(items, time.monotonic() - start_time)
+
+        for item, output in zip(items, outputs):
+            item.output = output
+            item.event.set()
+
+
+class AsyncBatchCollector(BatchCollector):
+    """
+    Collect single calls into batches on the running event loop.
+    Each call awaits a Future, so pending calls never block the loop. Sync batch
+    functions run on a dedicated executor thread, async ones are awaited directly.
+    """
+
+    def _reset(self):
+        self.queue = BatchQueue()
+        self._loop = None
+        self._task = None
+        self._wakeup = None
+        self._executor = None
+        self._local = local()
+        self._running = set()
+        self._pid = os.getpid()
+
+    def close(self):
+        """
+        Stop the collector task once its queued calls are done, e.g. after a model swap
+        """
+        self._closing = True
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._pid != os.getpid():
+            self._reset()
+        if self._loop is not loop:
+            self.queue = BatchQueue()
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._task = None
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    async def submit(self, params):
+        """
+        Queue one call and wait for its output without blocking the event loop
+        """
+        self._ensure_started()
+        item = AsyncBatchItem(params, self._loop.create_future(), self._estimate_size(params),
+                              self._get_bucket(params))
+        self._admit(item)
+        self.queue.push(item)
+        self._wakeup.set()
+
+        try:
+            output = await asyncio.wait_for(item.future, self.timeout)
+        except asyncio.TimeoutError:
+            raise MlChainError("Timeout batch", code="T002", status_code=408)
+        finally:
+            self._add_timings(item)
+        return output
+
+    async def _wait_wakeup(self, timeout=None):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _collect(self):
+        while len(self.queue) == 0:
+            if self._closing:
+                return None
+            await self._wait_wakeup()
+        deadline = self.queue.oldest_arrival() + self.max_wait
+        while not self.queue.has_full_bucket(self.batch_size):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await self._wait_wakeup(remaining)
+        return self.queue.pop_batch(self.batch_size)
+
+    async def _run(self):
+        while True:
+            if self.replica_pool is None:
+                items = await self._collect()
+                if items is None:
+                    return
+                kwargs = self._prepare(items)
+                if kwargs is not None:
+                    await self._execute(items, kwargs)
+                continue
+
+            replica = await self.replica_pool.get_async(None)
+            try:
+                items = await self._collect()
+            except BaseException:
+                # The collector task was cancelled while holding a replica
+                self.replica_pool.put(replica)
+                raise
+            if items is None:
+                self.replica_pool.put(replica)
+                return
+            kwargs = self._prepare(items)
+            if kwargs is None:
+                self.replica_pool.put(replica)
+                continue
+            task = self._loop.create_task(self._execute_on_replica(items, kwargs, replica))
+            # The loop only keeps weak references to tasks
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    def _fail(self, items, exception):
+        for item in items:
+            if not item.future.done():
+                item.future.set_exception(exception)
+
+    async def _execute_on_replica(self, items, kwargs, replica):
+        try:
+            await self._execute(items, kwargs, replica)
+        finally:
+            self.replica_pool.put(replica)
+
+    async def _execute(self, items, kwargs, replica=None):
+        start_time = time.monotonic()
+        for item in items:
+            item.started = start_time
+        try:
+            batch_func = self._get_batch_func(replica)
+            if inspect.iscoroutinefunction(batch_func):
+                outputs = await batch_func(**kwargs, **self.default)
+            else:
+                outputs = await self._loop.run_in_executor(
+                    self._get_executor(), functools.partial(self._call_batch_func, kwargs, replica))
+            outputs = self._check_outputs(outputs, items)
+        except Exception as ex:
+            self._fail(items, ex)
+            return
+        finally:
+            self._record_batch_time(items, time.monotonic() - start_time)
+
+        for item, output in zip(items, outputs):
+            if not item.future.done():
+                item.future.set_result(output)
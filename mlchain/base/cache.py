@@ -0,0 +1,157 @@
+"""
+Result cache of served functions keyed by a content hash of their arguments
+"""
+import copy
+import time
+import pickle
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+from .batching import estimate_size
+
+
+class UncacheableError(TypeError):
+    """The arguments can't be hashed by content"""
+
+
+def _update_hash(h, value):
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            raise UncacheableError("Can't hash ndarray of objects")
+        h.update(b'n')
+        h.update(value.dtype.str.encode())
+        h.update(repr(value.shape).encode())
+        h.update(np.ascontiguousarray(value).data)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        h.update(b'b%d:' % len(value))
+        h.update(value)
+    elif isinstance(value, str):
+        value = value.encode('utf-8', 'surrogatepass')
+        h.update(b's%d:' % len(value))
+        h.update(value)
+    elif value is None or isinstance(value, (bool, int, float, complex, np.generic)):
+        h.update(b'v')
+        h.update(type(value).__name__.encode())
+        h.update(repr(value).encode())
+        h.update(b';')
+    elif isinstance(value, (list, tuple)):
+        h.update(b'l%d:' % len(value))
+        for item in value:
+            _update_hash(h, item)
+    elif isinstance(value, dict):
+        h.update(b'd%d:' % len(value))
+        for key, item in sorted(value.items(), key=lambda x: repr(x[0])):
+            _update_hash(h, key)
+            _update_hash(h, item)
+    else:
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as ex:
+            raise UncacheableError("Can't hash {0}: {1}".format(type(value), ex))
+        h.update(b'p%d:' % len(data))
+        h.update(data)
+
+
+def content_hash(function_name, args, kwargs):
+    """
+    Hash a call by the content of its arguments, ndarrays by their bytes, dtype and shape
+    """
+    h = hashlib.blake2b(digest_size=16)
+    _update_hash(h, function_name)
+    _update_hash(h, list(args))
+    _update_hash(h, kwargs)
+    return h.digest()
+
+
+def _copy_output(value):
+    """
+    Copy a mutable output so callers can't change what is cached
+    """
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes, np.generic)):
+        return value
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    return copy.deepcopy(value)
+
+
+class ResultCache:
+    """
+    LRU cache of outputs bounded by total bytes, with an optional time to live.
+    Outputs are copied in and out, the caller owns what put and get hand over
+    :max_bytes: Max estimated bytes of all cached outputs
+    :max_entries: Max number of cached outputs, None is no limit
+    :ttl: Seconds an output stays valid, None is forever
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entries=None, ttl=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl if ttl is not None and ttl > 0 else None
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Get (True, output) if key is cached, else (False, None)
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, output, size = entry
+                if expires is None or expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, _copy_output(output)
+                self._remove(key)
+            self.misses += 1
+            return False, None
+
+    def put(self, key, output):
+        size = estimate_size(output)
+        if size > self.max_bytes:
+            return False
+        try:
+            output = _copy_output(output)
+        except Exception:
+            return False
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (expires, output, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes or \
+                    (self.max_entries is not None and len(self.entries) > self.max_entries):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+        return True
+
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def status(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total > 0 else 0.0
+        }
@@ -0,0 +1,176 @@
+"""
+Per-function call plans built once when a ServeModel starts
+"""
+from inspect import signature, _empty, Parameter
+from typing import Union
+import numpy as np
+from .converter import get_type
+from .exceptions import MLChainAssertionError
+from .uploads import FileArgument
+from ..context import mlchain_context
+
+_IDENTITY = 'identity'
+
+
+class ParameterPlan:
+    """
+    How to bind and convert one parameter of a served function
+    """
+    __slots__ = ('name', 'annotation', 'default', 'generic', 'union', 'out_types', '_converters')
+
+    def __init__(self, parameter):
+        self.name = parameter.name
+        self.annotation = parameter.annotation
+        self.default = parameter.default
+        origin, args = get_type(self.annotation)
+        # Generic containers and unhashable annotations always go through the Converter
+        self.generic = args is not None and origin != Union
+        self.union = origin == Union
+        if self.annotation is _empty:
+            self.out_types = None
+        elif self.union:
+            self.out_types = tuple(args)
+        else:
+            self.out_types = (self.annotation,)
+        self._converters = {}
+
+    def needs_convert(self, value):
+        if self.annotation is _empty:
+            # Attachments are views of the request body, a parameter without type takes their bytes
+            return type(value) is memoryview
+        if type(value) == self.annotation:
+            return False
+        if self.default is _empty:
+            return True
+        eq = value == self.default
+        if isinstance(eq, np.ndarray):
+            return not np.all(eq)
+        return not eq
+
+    def resolve(self, value, convert_dict):
+        """
+        Get the converter callable for the type of value, None if only Converter.convert can decide
+        """
+        if self.out_types is None:
+            return memoryview.tobytes if type(value) is memoryview else _IDENTITY
+        if self.generic:
+            return None
+        value_type = type(value)
+        converter = self._converters.get(value_type)
+        if converter is not None:
+            return converter
+        try:
+            if value_type in self.out_types or \
+                    (not self.union and isinstance(value, self.annotation)):
+                converter = _IDENTITY
+        except TypeError:
+            return None
+        if converter is None:
+            for i_type, o_types in convert_dict.items():
+                if isinstance(value, i_type):
+                    for o_type in o_types:
+                        if o_type in self.out_types:
+                            converter = o_types[o_type]
+                            break
+                    if converter is not None:
+                        break
+        if converter is not None:
+            self._converters[value_type] = converter
+        return converter
+
+
+class CallPlan:
+    """
+    Parameters, defaults and converters of a served function, resolved once at startup
+    :name: The served name
+    :func: The function to call
+    """
+    __slots__ = ('name', 'func', 'signature', 'parameters', 'positional', 'required', 'accept_kwargs')
+
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+        try:
+            self.signature = signature(func)
+            parameters = self.signature.parameters
+        except (TypeError, ValueError):
+            # Served attributes and some builtins have no signature, pass values through
+            self.signature = None
+            parameters = {}
+        self.accept_kwargs = self.signature is None or \
+            any(p.kind == Parameter.VAR_KEYWORD for p in parameters.values())
+        self.parameters = {key: ParameterPlan(p) for key, p in parameters.items()
+                           if p.kind not in (Parameter.VAR_KEYWORD, Parameter.VAR_POSITIONAL)}
+        self.positional = tuple(parameters.keys())
+        self.required = tuple(key for key, p in self.parameters.items() if p.default is _empty)
+
+    def get_kwargs(self, args, kwargs):
+        """
+        Map positional args to parameter names
+        """
+        if len(args) == 0:
+            return dict(kwargs)
+        output = dict(zip(self.positional, args))
+        output.update(kwargs)
+        return output
+
+    def prepare(self, kwargs):
+        """
+        Drop unknown keys and yield (parameter plan, value) of the ones that need converting
+        """
+        for key, value in list(kwargs.items()):
+            parameter = self.parameters.get(key)
+            if parameter is None:
+                if not self.accept_kwargs:
+                    kwargs.pop(key)
+                continue
+            if parameter.needs_convert(value):
+                yield parameter, value
+
+    def files(self, kwargs):
+        """
+        Yield (key, file, keep) of the files sent by the mlchain client, keep is True
+        when the parameter takes the uploaded file itself instead of its bytes
+        """
+        for key, value in kwargs.items():
+            if isinstance(value, FileArgument):
+                parameter = self.parameters.get(key)
+                yield key, value, parameter is not None and value.accepts_storage(parameter.annotation)
+
+    def check_missing(self, kwargs):
+        missing = [key for key in self.required if key not in kwargs]
+        if len(missing) > 0:
+            raise MLChainAssertionError("Missing params {0}".format(missing))
+        return kwargs
+
+    def bind(self, args, kwargs, converter):
+        """
+        Build the kwargs of a call, converting values with converter
+        """
+        kwargs = self.get_kwargs(args, kwargs)
+        for key, value, keep in list(self.files(kwargs)):
+            kwargs[key] = value.storage if keep else value.read()
+        for parameter, value in self.prepare(kwargs):
+            mlchain_context['CONVERT_VARIABLE'] = parameter.name
+            convert = parameter.resolve(value, converter.convert_dict)
+            if convert is None:
+                kwargs[parameter.name] = converter.convert(value, parameter.annotation)
+            elif convert is not _IDENTITY:
+                kwargs[parameter.name] = convert(value)
+        return self.check_missing(kwargs)
+
+    async def bind_async(self, args, kwargs, converter):
+        """
+        Build the kwargs of a call with an AsyncConverter
+        """
+        kwargs = self.get_kwargs(args, kwargs)
+        for key, value, keep in list(self.files(kwargs)):
+            kwargs[key] = value.storage if keep else await converter.read_file(value)
+        for parameter, value in self.prepare(kwargs):
+            mlchain_context['CONVERT_VARIABLE'] = parameter.name
+            convert = parameter.resolve(value, converter.convert_dict)
+            if convert is None:
+                kwargs[parameter.name] = await converter.convert(value, parameter.annotation)
+            elif convert is not _IDENTITY:
+                kwargs[parameter.name] = await converter.apply(convert, value)
+        return self.check_missing(kwargs)
@@ -0,0 +1,250 @@
+"""
+Content-Encoding of request and response bodies: gzip, and zstd or lz4 when their packages are installed
+"""
+import gzip
+import io
+import json
+import zlib
+from .exceptions import MlChainError
+
+# Bodies under this size aren't compressed, the headers and CPU cost more than they save
+DEFAULT_MIN_SIZE = 1024
+# Max bytes a compressed request body inflates to
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+# Preference order of the encodings offered by both sides
+ENCODINGS = ('zstd', 'lz4', 'gzip')
+# Max decompressed bytes produced at once
+CHUNK_SIZE = 64 * 1024
+# Bodies of these types are already compressed, compressing them again only costs CPU
+COMPRESSED_TYPES = ('application/msgpack_blosc', 'application/zip', 'application/gzip', 'application/x-gzip',
+                    'application/zstd', 'application/x-lz4', 'application/pdf', 'image/', 'video/', 'audio/')
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# Compressors of the encodings, by name
+_CODECS = {
+    'gzip': lambda data: gzip.compress(data, compresslevel=6)
+}
+if zstandard is not None:
+    _CODECS['zstd'] = lambda data: zstandard.ZstdCompressor(level=3).compress(data)
+if lz4_frame is not None:
+    _CODECS['lz4'] = lambda data: lz4_frame.compress(data)
+
+
+def _too_large(max_size):
+    return MlChainError("Request too large, its decompressed body is over {0} bytes".format(max_size),
+                        code="too_large", status_code=413)
+
+
+class _LimitedSink:
+    """
+    File-like sink of a decompressor, raising 413 as soon as max_size bytes are exceeded
+    """
+
+    def __init__(self, out, max_size):
+        self.out = out
+        self.max_size = max_size
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise _too_large(self.max_size)
+        self.out.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class StreamDecompressor:
+    """
+    Decompress a body chunk by chunk into a file, holding at most CHUNK_SIZE decompressed bytes in memory
+    :encoding: Content-Encoding of the body
+    :out: File the decompressed body is written to
+    :max_size: Max bytes of the decompressed body, more raise 413
+    """
+
+    def __init__(self, encoding, out, max_size=None):
+        self.encoding = (encoding or 'identity').strip().lower()
+        if self.encoding != 'identity' and self.encoding not in _CODECS:
+            raise MlChainError("Content-Encoding {0} is not supported, use one of {1}".format(
+                encoding, ', '.join(available_encodings())), code="encoding", status_code=415)
+        self.sink = _LimitedSink(out, max_size)
+        if self.encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'zstd':
+            self._decompressor = zstandard.ZstdDecompressor().stream_writer(self.sink, write_size=CHUNK_SIZE)
+        elif self.encoding == 'lz4':
+            self._decompressor = lz4_frame.LZ4FrameDecompressor()
+
+    @property
+    def size(self):
+        return self.sink.size
+
+    def _write(self, data):
+        if self.encoding == 'identity':
+            self.sink.write(data)
+        elif self.encoding == 'gzip':
+            while data:
+                self.sink.write(self._decompressor.decompress(data, CHUNK_SIZE))
+                data = self._decompressor.unconsumed_tail
+        elif self.encoding == 'zstd':
+            self._decompressor.write(data)
+        else:
+            self.sink.write(self._decompressor.decompress(data, max_length=CHUNK_SIZE))
+            while not self._decompressor.needs_input:
+                self.sink.write(self._decompressor.decompress(b'', max_length=CHUNK_SIZE))
+
+    def _close(self):
+        if self.encoding == 'gzip':
+            self.sink.write(self._decompressor.flush())
+            if not self._decompressor.eof:
+                raise ValueError("truncated gzip stream")
+        elif self.encoding == 'zstd':
+            self._decompressor.flush()
+        elif self.encoding == 'lz4' and not self._decompressor.eof:
+            raise ValueError("truncated lz4 frame")
+
+    def _call(self, method, *args):
+        try:
+            return method(*args)
+        except MlChainError:
+            raise
+        except Exception as ex:
+            raise MlChainError("Can't decompress the {0} body: {1}".format(self.encoding, ex),
+                               code="encoding", status_code=400)
+
+    def write(self, data):
+        """
+        Decompress the next chunk of the body
+        """
+        self._call(self._write, data)
+
+    def close(self):
+        """
+        Flush the end of the body, raising 400 if it is truncated
+        """
+        self._call(self._close)
+
+
+def available_encodings():
+    """
+    Get the encodings this process can compress and decompress, by preference
+    """
+    return [encoding for encoding in ENCODINGS if encoding in _CODECS]
+
+
+def compress(data, encoding):
+    return _CODECS[encoding](data)
+
+
+def decompress(data, encoding, max_size=None):
+    """
+    Decompress a body, raising 413 when it inflates over max_size bytes
+    """
+    out = io.BytesIO()
+    decompressor = StreamDecompressor(encoding, out, max_size)
+    decompressor.write(data)
+    decompressor.close()
+    return out.getvalue()
+
+
+def parse_accept_encoding(accept_encoding):
+    """
+    Get {encoding: quality} of an Accept-Encoding header
+    """
+    qualities = {}
+    for item in (accept_encoding or '').split(','):
+        parts = item.strip().split(';')
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+    return qualities
+
+
+class Compression:
+    """
+    Compression of response bodies negotiated from the Accept-Encoding of requests
+    :min_size: Min bytes of a compressed body
+    :encodings: Encodings offered by preference, None is all the available ones, [] disables compression
+    """
+
+    def __init__(self, min_size=DEFAULT_MIN_SIZE, encodings=None):
+        self.min_size = min_size
+        available = available_encodings()
+        if encodings is None:
+            encodings = available
+        self.encodings = [encoding for encoding in encodings if encoding in available]
+
+    def override(self, options):
+        """
+        Get the Compression of a function from the options of its @compression, None keeps this one
+        """
+        if options is None:
+            return self
+        return Compression(min_size=options.get('min_size', self.min_size),
+                           encodings=options.get('encodings', self.encodings))
+
+    def negotiate(self, accept_encoding):
+        """
+        Get the preferred encoding accepted by the client, None to send the body as is
+        """
+        qualities = parse_accept_encoding(accept_encoding)
+        if len(qualities) == 0:
+            return None
+        best, best_quality = None, 0.0
+        for encoding in self.encodings:
+            quality = qualities.get(encoding, qualities.get('*', 0.0))
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def compress(self, body, accept_encoding, content_type=None):
+        """
+        Compress body for a client, get (body, encoding), encoding is None if it is sent as is.
+        Bodies of a type in COMPRESSED_TYPES are always sent as is
+        """
+        if self.min_size is None or not isinstance(body, (bytes, bytearray)) or len(body) < self.min_size:
+            return body, None
+        if content_type is not None and content_type.split(';')[0].strip().lower().startswith(COMPRESSED_TYPES):
+            return body, None
+        encoding = self.negotiate(accept_encoding)
+        if encoding is None:
+            return body, None
+        return compress(body, encoding), encoding
+
+
+def get_max_size(max_size, limit):
+    """
+    Get the smaller of two limits of a body, None is no limit
+    """
+    if max_size is None:
+        return limit
+    if limit is None:
+        return max_size
+    return min(max_size, limit)
+
+
+def error_body(exception):
+    """
+    Get the JSON body of a request whose body couldn't be decompressed
+    """
+    return json.dumps({'error': exception.msg, 'code': exception.code}).encode()
@@ -1,6 +1,9 @@
 import os
 import io
 import json
+import asyncio
+import functools
+import contextvars
 from base64 import b64decode
 from typing import List, Union, Dict, Set
 from inspect import signature, _empty, iscoroutinefunction
@@ -8,6 +11,8 @@ from collections import defaultdict
 import numpy as np
 from PIL import Image, ImageSequence
 from .exceptions import MLChainAssertionError
+from .batching import estimate_size
+from .uploads import is_file_type, is_path_type, get_stream, get_path
 from ..config import mlconfig
 from ..context import mlchain_context
 import ast 
@@ -16,6 +21,8 @@ cv2 = None
 ALL_LOWER_TRUE = set(["true", "yes", "yeah", "y"])
 ALL_LOWER_FALSE = set(["none", 'false', 'n', 'null', 'no'])
 ALL_LOWER_NULL = set(['none', 'null', 'nil'])
+# Payloads from this size are decoded and encoded off the event loop of async servers
+DEFAULT_OFFLOAD_THRESHOLD = 256 * 1024
 
 if mlconfig.image_rgba is None:
     CV2FLAG = 1
@@ -44,13 +51,19 @@ def ast_json_parse_string(value: str):
 
 def bytes2ndarray(value: bytes) -> np.ndarray: 
     import_cv2()
-    nparr = np.fromstring(value, np.uint8)
+    nparr = np.frombuffer(value, np.uint8)
     img = cv2.imdecode(nparr, CV2FLAG)
     if img is not None:
         return img
     else:
         raise MLChainAssertionError("Can't decode bytes {0} to ndarray. Please check the variable {1}".format(value, mlchain_context.CONVERT_VARIABLE))
 
+def memoryview2bytes(value: memoryview) -> bytes:
+    return value.tobytes()
+
+def memoryview2bytearray(value: memoryview) -> bytearray:
+    return bytearray(value)
+
 def str2ndarray(value: str) -> np.ndarray:
     if value.lower() in ALL_LOWER_NULL:
         return None
@@ -307,6 +320,11 @@ class Converter:
         origin, args = get_type(out_type)
         if origin == _empty:
             return value
+        if type(value) == self.FILE_STORAGE_TYPE:
+            if is_file_type(out_type):
+                return get_stream(value)
+            if is_path_type(out_type):
+                return get_path(value)
         if origin in [List, Set, Dict, list, set, dict] and args is not None:
             if isinstance(value, (List, list)):
                 if origin in [List, list]:
@@ -365,6 +383,50 @@ class Converter:
         raise MLChainAssertionError("Not found converter from {0} to {1}. Please check the variable {2}".format(type(value), out_type, mlchain_context.CONVERT_VARIABLE))
 
 class AsyncConverter(Converter):
+    """
+    Converter of async servers, decoding payloads of offload_threshold bytes or more in executor
+    so the event loop keeps receiving other requests meanwhile
+    :offload_threshold: Min bytes of a value decoded in executor, None to decode everything inline
+    :executor: The pool decoding values, None is the default executor of the event loop
+    """
+
+    def __init__(self, file_storage_type=None, get_file_name=None, get_data=None,
+                 offload_threshold=DEFAULT_OFFLOAD_THRESHOLD, executor=None):
+        Converter.__init__(self, file_storage_type, get_file_name, get_data)
+        self.offload_threshold = offload_threshold
+        self.executor = executor
+
+    def should_offload(self, value):
+        return self.offload_threshold is not None and estimate_size(value) >= self.offload_threshold
+
+    async def offload(self, func, *args):
+        """
+        Run a CPU bound func(*args) in executor, seeing the mlchain_context of the caller
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(contextvars.copy_context().run, func, *args))
+
+    async def apply(self, func, value):
+        """
+        Call a converter on value, in executor when value is large
+        """
+        if self.should_offload(value):
+            return await self.offload(func, value)
+        return func(value)
+
+    async def read_file(self, file):
+        """
+        Read the bytes of a FileArgument, in executor when the file is large
+        """
+        if self.offload_threshold is not None and file.size() >= self.offload_threshold:
+            return await self.offload(file.read)
+        return file.read()
+
+    async def convert_file_async(self, file_name, data, out_type):
+        if self.should_offload(data):
+            return await self.offload(self.convert_file, file_name, data, out_type)
+        return self.convert_file(file_name, data, out_type)
+
     async def convert(self, value, out_type):
         '''
         Convert type of value to out_type
@@ -375,6 +437,11 @@ class AsyncConverter(Converter):
         origin, args = get_type(out_type)
         if origin == _empty:
             return value
+        if type(value) == self.FILE_STORAGE_TYPE:
+            if is_file_type(out_type):
+                return get_stream(value)
+            if is_path_type(out_type):
+                return await self.offload(get_path, value)
         if origin in [List, Set, Dict, list, set, dict] and args is not None:
             if isinstance(value, (List, list)):
                 if origin in [List, list]:
@@ -391,8 +458,8 @@ class AsyncConverter(Converter):
             else:
                 if type(value) == self.FILE_STORAGE_TYPE:
                     byte_data = await self._get_data(value)
-                    return self.convert_file(self._get_file_name(value),
-                                             byte_data, out_type)
+                    return await self.convert_file_async(self._get_file_name(value),
+                                                         byte_data, out_type)
                 if origin in [List, list]:
                     return [await self.convert(value, args)]
                 if origin in [Set, set]:
@@ -417,11 +484,11 @@ class AsyncConverter(Converter):
             if isinstance(value, i_type):
                 for o_type in self.convert_dict[i_type]:
                     if o_type in out_type:
-                        return self.convert_dict[i_type][o_type](value)
+                        return await self.apply(self.convert_dict[i_type][o_type], value)
         
         if type(value) == self.FILE_STORAGE_TYPE:
             byte_data = await self._get_data(value)
-            return self.convert_file(self._get_file_name(value), byte_data, out_type)
+            return await self.convert_file_async(self._get_file_name(value), byte_data, out_type)
         
         for o_type in out_type:
             if callable(getattr(o_type, "from_json", None)):
@@ -434,6 +501,9 @@ class AsyncConverter(Converter):
 
 Converter.add_convert(lambda x: str(x), int, str)
 Converter.add_convert(bytes2ndarray)
+Converter.add_convert(bytes2ndarray, memoryview, np.ndarray)
+Converter.add_convert(memoryview2bytes)
+Converter.add_convert(memoryview2bytearray)
 Converter.add_convert(str2ndarray)
 Converter.add_convert(list2ndarray)
 Converter.add_convert(str2int)
@@ -0,0 +1,260 @@
+"""
+Cross-worker batching: HTTP workers forward decoded inputs of @batch functions
+to one model-owning process over a Unix socket, so batches form across workers
+"""
+import os
+import time
+import pickle
+import socket
+import struct
+import asyncio
+import inspect
+import itertools
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from threading import Lock, Thread
+from .exceptions import MlChainError
+from .log import logger
+
+_HEADER = struct.Struct('!I')
+# Set in the HTTP workers, a ServeModel built from a model_factory class then doesn't load the model
+COORDINATOR_ENV = 'MLCHAIN_BATCH_COORDINATOR'
+
+
+def _send_frame(sock, lock, obj):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    with lock:
+        sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise ConnectionError("Connection closed")
+        received += n
+    return buffer
+
+
+def _recv_frame(sock):
+    size, = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return pickle.loads(_recv_exact(sock, size))
+
+
+def _loadable_error(ex):
+    """
+    The exception itself if the worker can unpickle it, exceptions whose __init__ doesn't take
+    their args can't be rebuilt there
+    """
+    try:
+        pickle.loads(pickle.dumps(ex, protocol=pickle.HIGHEST_PROTOCOL))
+        return ex
+    except Exception:
+        return MlChainError("{0}: {1}".format(type(ex).__name__, ex))
+
+
+class BatchCoordinator:
+    """
+    Serve batched functions of a ServeModel to the HTTP workers
+    :serve_model: The ServeModel owning the model
+    :path: Path of the Unix socket
+    :max_workers: Number of requests waiting in the batch collectors at the same time
+    """
+
+    def __init__(self, serve_model, path, max_workers=256):
+        self.serve_model = serve_model
+        self.path = path
+        self.max_workers = max_workers
+        self._executor = None
+        self._sock = None
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self._sock.listen()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        logger.info("Batch coordinator is listening on {0}".format(self.path))
+        try:
+            while True:
+                conn, _ = self._sock.accept()
+                Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+        except OSError:
+            # The socket has been closed by close()
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def _serve_connection(self, conn):
+        send_lock = Lock()
+        try:
+            while True:
+                request_id, function_name, args, kwargs = _recv_frame(conn)
+                self._executor.submit(self._call, conn, send_lock, request_id,
+                                      function_name, args, kwargs)
+        except (ConnectionError, OSError, EOFError):
+            pass
+        finally:
+            conn.close()
+
+    def _call(self, conn, send_lock, request_id, function_name, args, kwargs):
+        try:
+            output = self.serve_model.call_function(function_name, None, *args, **kwargs)
+            if inspect.isawaitable(output):
+                output = asyncio.run(output)
+            response = (request_id, True, output)
+        except Exception as ex:
+            response = (request_id, False, _loadable_error(ex))
+        try:
+            try:
+                _send_frame(conn, send_lock, response)
+            except (pickle.PicklingError, TypeError, AttributeError) as ex:
+                if response[1]:
+                    error = MlChainError("Can't send the output of {0}: {1}".format(function_name, ex))
+                else:
+                    error = MlChainError(str(response[2]))
+                _send_frame(conn, send_lock, (request_id, False, error))
+        except OSError:
+            # The worker went away, nobody is waiting for this output
+            pass
+
+
+class CoordinatorClient:
+    """
+    Connection from one HTTP worker to the BatchCoordinator, shared by all its threads
+    :path: Path of the Unix socket
+    :timeout: Seconds to wait for an output, None is no limit
+    """
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self._lock = Lock()
+        self._reset()
+
+    def _reset(self):
+        self._sock = None
+        self._send_lock = Lock()
+        self._pending = {}
+        self._ids = itertools.count()
+        self._pid = os.getpid()
+
+    def _connect(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # A forked worker must not share the parent connection
+                self._reset()
+            if self._sock is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(self.path)
+                except OSError as ex:
+                    sock.close()
+                    raise MlChainError("Batch coordinator is unavailable: {0}".format(ex),
+                                       code="C001", status_code=503)
+                self._sock = sock
+                Thread(target=self._read, args=(sock,), daemon=True).start()
+            return self._sock
+
+    def _read(self, sock):
+        try:
+            while True:
+                request_id, ok, output = _recv_frame(sock)
+                future = self._pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                if ok:
+                    future.set_result(output)
+                else:
+                    future.set_exception(output)
+        except (ConnectionError, OSError, EOFError):
+            pass
+        except Exception as ex:
+            # A frame that can't be loaded, the calls of this connection can't be matched anymore
+            logger.error("Can't read from the batch coordinator: {0}".format(ex))
+        with self._lock:
+            if self._sock is sock:
+                self._sock = None
+            pending, self._pending = self._pending, {}
+        sock.close()
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(MlChainError("Batch coordinator connection is closed",
+                                                  code="C001", status_code=503))
+
+    def submit(self, function_name, args, kwargs):
+        """
+        Send a call to the coordinator and return a Future of its output
+        """
+        future = Future()
+        for _ in range(2):
+            sock = self._connect()
+            with self._lock:
+                # The reader may have closed this connection and taken its pending calls meanwhile
+                if self._sock is sock:
+                    request_id = next(self._ids)
+                    future.request_id = request_id
+                    self._pending[request_id] = future
+                    break
+        else:
+            raise MlChainError("Batch coordinator connection is closed", code="C001", status_code=503)
+        try:
+            _send_frame(sock, self._send_lock, (request_id, function_name, args, kwargs))
+        except OSError as ex:
+            self._pending.pop(request_id, None)
+            raise MlChainError("Batch coordinator is unavailable: {0}".format(ex),
+                               code="C001", status_code=503)
+        return future
+
+    def call(self, function_name, *args, **kwargs):
+        future = self.submit(function_name, args, kwargs)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            self._pending.pop(future.request_id, None)
+            raise MlChainError("Timeout batch coordinator", code="T002", status_code=408)
+
+    async def call_async(self, function_name, *args, **kwargs):
+        concurrent_future = self.submit(function_name, args, kwargs)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(concurrent_future), self.timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(concurrent_future.request_id, None)
+            raise MlChainError("Timeout batch coordinator", code="T002", status_code=408)
+
+
+def wait_for_coordinator(path, timeout=None, interval=0.1, notify=None):
+    """
+    Wait until the coordinator accepts connections on path, it listens once its model is loaded
+    :timeout: Seconds to wait, None is no limit
+    :notify: Called while waiting, e.g. the heartbeat of a gunicorn worker
+    :return: True if the coordinator is ready
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return True
+        except OSError:
+            pass
+        finally:
+            sock.close()
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        if notify is not None:
+            notify()
+        time.sleep(interval)
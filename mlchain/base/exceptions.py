@@ -5,6 +5,7 @@ from sentry_sdk import capture_exception
 import logging 
 from sentry_sdk import add_breadcrumb
 import re 
+import math
 
 class MlChainError(Exception):
     """Base class for all exceptions."""
@@ -15,6 +16,7 @@ class MlChainError(Exception):
         self.message = msg
         self.code = code
         self.status_code = status_code
+        self.headers = {}
         sentry_ignore_logger.error("[{0}]: {1}".format(code, msg))
         sentry_ignore_logger.debug(traceback.format_exc())
 
@@ -47,4 +49,15 @@ class MLChainTimeoutError(MlChainError):
 
 class MLChainConfigError(MlChainError):
     def __init__(self, msg, code="config", status_code=500):
-        MlChainError.__init__(self, msg, code, status_code)
\ No newline at end of file
+        MlChainError.__init__(self, msg, code, status_code)
+
+class MLChainNotReadyError(MlChainError):
+    def __init__(self, msg, code="not_ready", status_code=503):
+        MlChainError.__init__(self, msg, code, status_code)
+
+class MLChainBusyError(MlChainError):
+    def __init__(self, msg, code="T003", status_code=429, retry_after=None):
+        MlChainError.__init__(self, msg, code, status_code)
+        self.retry_after = retry_after
+        if retry_after is not None:
+            self.headers['Retry-After'] = str(max(1, int(math.ceil(retry_after))))
\ No newline at end of file
@@ -0,0 +1,98 @@
+"""
+Bounded thread and process pools that run synchronous served functions off the event loop
+"""
+import asyncio
+import contextvars
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Lock
+from .exceptions import MLChainAssertionError, MLChainBusyError
+
+_process_model = None
+
+
+def _init_process(model):
+    global _process_model
+    _process_model = model
+
+
+def _call_in_process(function_name, args, kwargs):
+    return getattr(_process_model, function_name)(*args, **kwargs)
+
+
+class BoundedExecutor:
+    """
+    A thread or process pool that rejects calls with 429 once max_queue calls wait for a worker
+    :max_workers: Number of threads or processes, None is the default of concurrent.futures
+    :max_queue: Max calls waiting for a free worker, None is no limit
+    :kind: 'thread' or 'process'
+    :model: The model each process calls functions of, required by process pools
+    """
+
+    def __init__(self, max_workers=None, max_queue=None, kind='thread', model=None, name='mlchain'):
+        if kind not in ('thread', 'process'):
+            raise MLChainAssertionError("Executor type must be thread or process, not {0}".format(kind))
+        self.kind = kind
+        self.max_queue = max_queue
+        if kind == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+            self.max_workers = self.executor._max_workers
+        else:
+            if model is None:
+                raise MLChainAssertionError("A process executor needs the model to call")
+            # Forked processes inherit the model instead of unpickling it
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+            self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                                                initializer=_init_process, initargs=(model,))
+            self.max_workers = self.executor._max_workers
+        self.pending = 0
+        self.rejected = 0
+        self.lock = Lock()
+
+    def _done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) in the pool, threads see the mlchain_context of the caller.
+        In a process pool func is the name of a function of the model
+        """
+        with self.lock:
+            if self.max_queue is not None and self.pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise MLChainBusyError("Too many calls are waiting for a worker, please retry later",
+                                       retry_after=1)
+            self.pending += 1
+        try:
+            if self.kind == 'thread':
+                future = self.executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+            else:
+                future = self.executor.submit(_call_in_process, func, args, kwargs)
+        except BaseException:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Await func(*args, **kwargs) running in the pool
+        """
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def status(self):
+        with self.lock:
+            pending = self.pending
+        return {
+            'type': self.kind,
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'running': min(pending, self.max_workers),
+            'queued': max(0, pending - self.max_workers),
+            'rejected': self.rejected
+        }
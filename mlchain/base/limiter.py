@@ -0,0 +1,132 @@
+"""
+Per-function concurrency limits, so a slow function can't take every worker of the server
+"""
+import asyncio
+from collections import deque
+from threading import Event, Lock
+from .exceptions import MLChainAssertionError, MLChainBusyError
+
+
+class ConcurrencyLimiter:
+    """
+    Bulkhead of a function: max_concurrency calls run at once, up to max_queue more wait
+    in arrival order, the others fail fast with 429. Threads and coroutines share the same slots
+    :max_concurrency: Max calls running at once
+    :max_queue: Max calls waiting for a slot, None is no limit
+    :timeout: Seconds a call waits for a slot before 429, None is no limit
+    """
+
+    def __init__(self, max_concurrency=1, max_queue=None, timeout=None):
+        if max_concurrency is None or max_concurrency < 1:
+            raise MLChainAssertionError("max_concurrency must be at least 1")
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.running = 0
+        self.rejected = 0
+        self.waiters = deque()
+        self.lock = Lock()
+
+    def _reject(self, msg):
+        self.rejected += 1
+        return MLChainBusyError(msg, retry_after=self.timeout or 1)
+
+    def _try_acquire(self, waiter):
+        # Called with self.lock held
+        if self.running < self.max_concurrency and len(self.waiters) == 0:
+            self.running += 1
+            return True
+        if self.max_queue is not None and len(self.waiters) >= self.max_queue:
+            raise self._reject("Too many calls of this function, please retry later")
+        self.waiters.append(waiter)
+        return False
+
+    def _grant(self, future):
+        # Runs on the loop of an async waiter, the slot goes back if it stopped waiting
+        if future.done():
+            self.release()
+        else:
+            future.set_result(True)
+
+    def _remove_waiter(self, waiter):
+        with self.lock:
+            try:
+                self.waiters.remove(waiter)
+                return True
+            except ValueError:
+                return False
+
+    def acquire(self):
+        """
+        Take a slot, waiting for one if all are running
+        """
+        event = Event()
+        with self.lock:
+            if self._try_acquire(event):
+                return
+        if not event.wait(self.timeout) and self._remove_waiter(event):
+            with self.lock:
+                raise self._reject("Timeout waiting for a free slot of this function, please retry later")
+
+    async def acquire_async(self):
+        """
+        Take a slot, awaiting one if all are running
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self.lock:
+            if self._try_acquire(waiter):
+                return
+        try:
+            await asyncio.wait_for(future, self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as ex:
+            if not self._remove_waiter(waiter) and future.done() and not future.cancelled():
+                # The slot was given just before the timeout
+                self.release()
+            if isinstance(ex, asyncio.TimeoutError):
+                with self.lock:
+                    raise self._reject("Timeout waiting for a free slot of this function, please retry later")
+            raise
+
+    def release(self):
+        """
+        Give the slot to the first waiting call, or free it
+        """
+        with self.lock:
+            while len(self.waiters) > 0:
+                waiter = self.waiters.popleft()
+                if isinstance(waiter, Event):
+                    waiter.set()
+                    return
+                loop, future = waiter
+                try:
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+                except RuntimeError:
+                    # The loop of this waiter is closed
+                    continue
+            self.running -= 1
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def status(self):
+        return {
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'running': self.running,
+            'waiting': len(self.waiters),
+            'rejected': self.rejected
+        }
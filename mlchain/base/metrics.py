@@ -0,0 +1,348 @@
+"""
+Counters, gauges and histograms exported in the Prometheus text format.
+Processes sharing a metrics directory, like gunicorn workers, write snapshots there and
+the process answering a scrape merges all of them
+"""
+import os
+import json
+import glob
+import math
+import time
+import tempfile
+from contextlib import contextmanager
+from threading import Lock, Thread
+from uuid import uuid4
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Seconds, from sub-millisecond models to slow ones
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Directory of the snapshots of the processes serving one app
+METRICS_DIR_ENV = 'MLCHAIN_METRICS_DIR'
+SNAPSHOT_INTERVAL = 1.0
+# Counters and histograms of the exited processes, folded into one file
+RETIRED_FILE = 'retired.json'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def family(self):
+        with self.lock:
+            values = [[list(key), value] for key, value in self.values.items()]
+        return {'name': self.name, 'type': self.type, 'help': self.documentation,
+                'labelnames': list(self.labelnames), 'values': values}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """
+        Count value in its bucket, values are [count of each bucket..., sum, count]
+        """
+        key = self._key(labels)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self.lock:
+            values = self.values.get(key)
+            if values is None:
+                values = self.values[key] = [0] * (len(self.buckets) + 3)
+            values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def family(self):
+        family = Metric.family(self)
+        family['buckets'] = list(self.buckets)
+        return family
+
+
+class MetricsRegistry:
+    """
+    The metrics of a process, created once by name
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    def _get(self, metric_class, name, documentation, labelnames, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, documentation, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def families(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return [metric.family() for metric in metrics]
+
+
+registry = MetricsRegistry()
+
+
+def make_family(name, metric_type, documentation, labelnames, values):
+    """
+    Get a family of values read at collection, like the counters of a pool
+    :values: List of (label values, value)
+    """
+    return {'name': name, 'type': metric_type, 'help': documentation, 'labelnames': list(labelnames),
+            'values': [[list(key), value] for key, value in values]}
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def merge_families(snapshots):
+    """
+    Sum the families of many processes. Gauges of exited processes are dropped,
+    their counters and histograms are kept so totals never go down
+    :snapshots: List of (alive, families)
+    """
+    merged = {}
+    for alive, families in snapshots:
+        for family in families:
+            if family['type'] == 'gauge' and not alive:
+                continue
+            target = merged.get(family['name'])
+            if target is None:
+                target = merged[family['name']] = dict(family, values={})
+            values = target['values']
+            for key, value in family['values']:
+                key = tuple(key)
+                if key not in values:
+                    values[key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    values[key] = [a + b for a, b in zip(values[key], value)]
+                else:
+                    values[key] += value
+    return [dict(family, values=list(family['values'].items())) for family in merged.values()]
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = ['{0}="{1}"'.format(name, _escape(value)) for name, value in zip(labelnames, key)]
+    if extra is not None:
+        pairs.append('{0}="{1}"'.format(*extra))
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def render(families):
+    """
+    Get the Prometheus text format of metric families
+    """
+    lines = []
+    for family in sorted(families, key=lambda family: family['name']):
+        name, labelnames = family['name'], family['labelnames']
+        lines.append('# HELP {0} {1}'.format(name, family['help']))
+        lines.append('# TYPE {0} {1}'.format(name, family['type']))
+        for key, value in sorted(family['values'], key=lambda item: tuple(item[0])):
+            if family['type'] != 'histogram':
+                lines.append('{0}{1} {2}'.format(name, _format_labels(labelnames, key), _format_value(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(list(family['buckets']) + ['+Inf'], value[:-2]):
+                cumulative += count
+                le = bound if bound == '+Inf' else _format_value(float(bound))
+                lines.append('{0}_bucket{1} {2}'.format(name, _format_labels(labelnames, key, ('le', le)),
+                                                        cumulative))
+            lines.append('{0}_sum{1} {2}'.format(name, _format_labels(labelnames, key), _format_value(value[-2])))
+            lines.append('{0}_count{1} {2}'.format(name, _format_labels(labelnames, key), value[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+class SharedMetrics:
+    """
+    Metrics of the processes sharing a directory. Each process writes the snapshot of its
+    families there every interval seconds, a scrape merges the snapshots of all of them.
+    Snapshots are named by pid and a random id per process, so a reused pid doesn't replace
+    the snapshot of an exited process, which a scrape folds into the retired file
+    :directory: The shared directory, created if needed
+    :collect: Callable getting the families of the process
+    :interval: Seconds between two snapshots of a process
+    """
+
+    def __init__(self, directory, collect, interval=SNAPSHOT_INTERVAL):
+        self.directory = directory
+        self.collect = collect
+        self.interval = interval
+        self._thread = None
+        self._pid = None
+        self._worker_id = None
+        self._worker_pid = None
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self):
+        if self._worker_pid != os.getpid():
+            # A forked process is a new worker
+            self._worker_pid = os.getpid()
+            self._worker_id = uuid4().hex[:12]
+        return os.path.join(self.directory, 'metrics-{0}-{1}.json'.format(self._worker_pid, self._worker_id))
+
+    def _replace(self, path, data):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.metrics-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(data))
+        os.replace(temp_path, path)
+
+    def write(self):
+        """
+        Write the snapshot of this process, replacing its previous one at once
+        """
+        self._replace(self._path(), {'pid': os.getpid(), 'time': time.time(), 'families': self.collect()})
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except Exception:
+                pass
+
+    def ensure_started(self):
+        """
+        Start writing snapshots in this process, again after a fork since threads don't survive it
+        """
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = Thread(target=self._run, name="mlchain-metrics", daemon=True)
+                self._thread.start()
+
+    @contextmanager
+    def _exclusive(self):
+        # One scrape at a time folds the snapshots of exited processes
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, 'metrics.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _remove(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def families(self):
+        """
+        Get the merged families of all processes, this one is written first so it is up to date.
+        Snapshots of exited processes are folded into the retired file and removed
+        """
+        self.ensure_started()
+        self.write()
+        retired_path = os.path.join(self.directory, RETIRED_FILE)
+        with self._exclusive():
+            retired = self._read(retired_path) or {'families': [], 'folded': []}
+            # Snapshots folded by a scrape that stopped before removing them
+            self._remove(retired['folded'])
+            snapshots, exited = [], []
+            for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+                snapshot = self._read(path)
+                if snapshot is None:
+                    continue
+                if _is_alive(snapshot['pid']):
+                    snapshots.append((True, snapshot['families']))
+                else:
+                    exited.append((os.path.basename(path), snapshot['families']))
+            if len(exited) > 0:
+                retired = {
+                    'families': merge_families([(False, retired['families'])] +
+                                               [(False, families) for _, families in exited]),
+                    'folded': [name for name, _ in exited]
+                }
+                self._replace(retired_path, retired)
+                self._remove(retired['folded'])
+        snapshots.append((False, retired['families']))
+        return merge_families(snapshots)
@@ -0,0 +1,268 @@
+"""
+Host many ServeModels in one process, loaded on first use and evicted by a memory budget
+"""
+import os
+import gc
+import time
+import asyncio
+from collections import OrderedDict
+from threading import Lock
+from .exceptions import MlChainError, MLChain404Error, MLChainAssertionError
+from .log import logger
+from .serve_model import ServeModel
+
+
+def get_memory_usage():
+    """
+    Resident memory of this process in bytes, None if it can't be read
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class _HostedModel:
+    __slots__ = ('name', 'factory', 'memory', 'options', 'serve_model', 'size', 'in_use', 'evict_pending', 'lock',
+                 'calls', 'loads', 'load_errors', 'evictions', 'load_time', 'total_load_time', 'last_used')
+
+    def __init__(self, name, factory, memory, options):
+        self.name = name
+        self.factory = factory
+        self.memory = memory
+        self.options = options
+        self.serve_model = None
+        self.size = 0
+        self.in_use = 0
+        self.evict_pending = False
+        self.lock = Lock()
+        self.calls = 0
+        self.loads = 0
+        self.load_errors = 0
+        self.evictions = 0
+        self.load_time = None
+        self.total_load_time = 0.0
+        self.last_used = None
+
+
+class ModelRegistry:
+    """
+    Models served under /models/<name>/call/<function_name>. A model is loaded on its first request,
+    and the least recently used idle models are evicted when the loaded ones exceed memory_budget
+    :memory_budget: Max bytes of all loaded models, None is no limit
+    :name: Name of the server
+    """
+
+    def __init__(self, memory_budget=None, name='mlchain-models'):
+        self.memory_budget = memory_budget
+        self.name = name
+        # Least recently used first
+        self.models = OrderedDict()
+        self.memory = 0
+        self.lock = Lock()
+        # One load at a time, so the memory growth is measured for the right model
+        self.load_lock = Lock()
+
+    def __contains__(self, name):
+        return name in self.models
+
+    def register(self, name, factory, memory=None, **options):
+        """
+        Host a model without loading it
+        :name: Name of the model in the URL
+        :factory: Callable returning the model or a ServeModel
+        :memory: Bytes the model takes, None to measure the resident memory it adds while loading.
+                 The measure is the growth of the whole process, calls running on other models during
+                 the load are counted in, so give the size when models load under traffic
+        :options: Arguments of ServeModel when factory returns a model
+        """
+        if not callable(factory):
+            raise MLChainAssertionError("factory of model {0} must be callable".format(name))
+        with self.lock:
+            if name in self.models:
+                raise MLChainAssertionError("Model {0} is already registered".format(name))
+            self.models[name] = _HostedModel(name, factory, memory, options)
+        return self
+
+    def names(self):
+        return list(self.models.keys())
+
+    def _use(self, name):
+        with self.lock:
+            hosted = self.models.get(name)
+            if hosted is None:
+                raise MLChain404Error("Model {0} is not hosted".format(name), code="model_not_found")
+            hosted.in_use += 1
+            hosted.calls += 1
+            hosted.last_used = time.time()
+            self.models.move_to_end(name)
+            return hosted, hosted.serve_model
+
+    def acquire(self, name):
+        """
+        Get the ServeModel of name, loading it if needed. It won't be evicted until release(name)
+        """
+        hosted, serve_model = self._use(name)
+        if serve_model is None:
+            serve_model = self._load_or_release(hosted)
+        return serve_model
+
+    async def acquire_async(self, name):
+        """
+        Get the ServeModel of name like acquire, loading it in an executor
+        """
+        hosted, serve_model = self._use(name)
+        if serve_model is None:
+            serve_model = await asyncio.get_running_loop().run_in_executor(None, self._load_or_release, hosted)
+        return serve_model
+
+    def release(self, name):
+        serve_model = None
+        with self.lock:
+            hosted = self.models[name]
+            hosted.in_use -= 1
+            if hosted.in_use == 0 and hosted.evict_pending and hosted.serve_model is not None:
+                serve_model = self._unload(hosted)
+        if serve_model is not None:
+            self._close(name, serve_model)
+        self._evict_over_budget()
+
+    def load(self, name):
+        """
+        Load a model before its first request
+        """
+        serve_model = self.acquire(name)
+        self.release(name)
+        return serve_model
+
+    def _load_or_release(self, hosted):
+        try:
+            return self._load(hosted)
+        except Exception:
+            self.release(hosted.name)
+            raise
+
+    def _load(self, hosted):
+        with hosted.lock:
+            if hosted.serve_model is not None:
+                return hosted.serve_model
+            with self.load_lock:
+                start_time = time.time()
+                memory_before = get_memory_usage()
+                try:
+                    serve_model = hosted.factory()
+                    if not isinstance(serve_model, ServeModel):
+                        serve_model = ServeModel(serve_model, name=hosted.name, **hosted.options)
+                    if serve_model.load_error is not None:
+                        raise RuntimeError(serve_model.load_error)
+                except Exception as ex:
+                    hosted.load_errors += 1
+                    raise MlChainError("Can't load model {0}. {1}".format(hosted.name, ex),
+                                       code="load", status_code=500)
+                memory_after = get_memory_usage()
+                if hosted.memory is not None:
+                    size = hosted.memory
+                elif memory_before is not None and memory_after is not None:
+                    size = max(0, memory_after - memory_before)
+                else:
+                    size = 0
+                load_time = time.time() - start_time
+                with self.lock:
+                    hosted.serve_model = serve_model
+                    hosted.size = size
+                    hosted.loads += 1
+                    hosted.load_time = load_time
+                    hosted.total_load_time += load_time
+                    self.memory += size
+                logger.info("Loaded model {0} in {1:.2f}s, {2} bytes".format(hosted.name, load_time, size))
+                self._evict_over_budget()
+            return serve_model
+
+    def _unload(self, hosted):
+        serve_model = hosted.serve_model
+        hosted.serve_model = None
+        self.memory -= hosted.size
+        hosted.size = 0
+        hosted.evictions += 1
+        hosted.evict_pending = False
+        return serve_model
+
+    def _close(self, name, serve_model):
+        serve_model.close()
+        del serve_model
+        gc.collect()
+        logger.info("Evicted model {0}".format(name))
+
+    def evict(self, name):
+        """
+        Unload a model, it will be loaded again on its next request.
+        A model in use is unloaded after its last call is done
+        :return: True if the model is unloaded now
+        """
+        with self.lock:
+            hosted = self.models.get(name)
+            if hosted is None:
+                raise MLChain404Error("Model {0} is not hosted".format(name), code="model_not_found")
+            if hosted.serve_model is None:
+                return False
+            if hosted.in_use > 0:
+                hosted.evict_pending = True
+                logger.info("Model {0} is in use, it will be evicted after its last call".format(name))
+                return False
+            serve_model = self._unload(hosted)
+        self._close(name, serve_model)
+        return True
+
+    def _evict_over_budget(self):
+        if self.memory_budget is None:
+            return
+        evicted = []
+        with self.lock:
+            for hosted in list(self.models.values()):
+                if self.memory <= self.memory_budget:
+                    break
+                if hosted.serve_model is not None and hosted.in_use == 0:
+                    evicted.append((hosted.name, self._unload(hosted)))
+            over_budget = self.memory > self.memory_budget
+        if len(evicted) == 0:
+            if over_budget:
+                logger.warning("Loaded models take {0} bytes over the budget of {1} bytes, "
+                               "all of them are in use".format(self.memory, self.memory_budget))
+            return
+        for name, serve_model in evicted:
+            serve_model.close()
+            logger.info("Evicted model {0} to stay in the memory budget".format(name))
+        del evicted, serve_model
+        gc.collect()
+
+    def status(self):
+        """
+        Memory, loads and evictions of the hosted models
+        """
+        with self.lock:
+            return {
+                'memory': self.memory,
+                'memory_budget': self.memory_budget,
+                'models': {
+                    name: {
+                        'loaded': hosted.serve_model is not None,
+                        'memory': hosted.size,
+                        'in_use': hosted.in_use,
+                        'evict_pending': hosted.evict_pending,
+                        'calls': hosted.calls,
+                        'loads': hosted.loads,
+                        'load_errors': hosted.load_errors,
+                        'evictions': hosted.evictions,
+                        'load_time': hosted.load_time,
+                        'total_load_time': hosted.total_load_time,
+                        'last_used': hosted.last_used
+                    }
+                    for name, hosted in self.models.items()
+                }
+            }
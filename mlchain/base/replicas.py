@@ -0,0 +1,145 @@
+"""
+Pool of model replicas served by one ServeModel
+"""
+import asyncio
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from threading import Event, Lock
+from .exceptions import MlChainError
+
+
+class _ThreadWaiter:
+    __slots__ = ('event', 'replica')
+
+    def __init__(self):
+        self.event = Event()
+        self.replica = None
+
+
+class ReplicaPool:
+    """
+    Hand out model replicas so each one serves a single call at a time.
+    Threads and coroutines wait in the same arrival order, coroutines on a Future of their loop
+    :replicas: List of model instances
+    :timeout: Default seconds to wait for a free replica, None is no limit
+    """
+
+    def __init__(self, replicas, timeout=None):
+        self.replicas = list(replicas)
+        assert len(self.replicas) > 0, "ReplicaPool needs at least one replica"
+        self.size = len(self.replicas)
+        self.timeout = timeout if timeout is not None and timeout > 0 else None
+        self._free = deque(self.replicas)
+        self._waiters = deque()
+        self._lock = Lock()
+
+    @property
+    def available(self):
+        return len(self._free)
+
+    def _timeout_error(self):
+        return MlChainError("Timeout replica", code="T004", status_code=408)
+
+    def _try_get(self, waiter):
+        # Called with self._lock held
+        if len(self._free) > 0 and len(self._waiters) == 0:
+            return self._free.popleft()
+        self._waiters.append(waiter)
+        return None
+
+    def _remove_waiter(self, waiter):
+        with self._lock:
+            try:
+                self._waiters.remove(waiter)
+                return True
+            except ValueError:
+                return False
+
+    def get(self, timeout=-1):
+        """
+        Take a free replica, waiting up to timeout seconds (the pool default if -1)
+        """
+        if timeout == -1:
+            timeout = self.timeout
+        waiter = _ThreadWaiter()
+        with self._lock:
+            replica = self._try_get(waiter)
+        if replica is not None:
+            return replica
+        if not waiter.event.wait(timeout) and self._remove_waiter(waiter):
+            raise self._timeout_error()
+        # A replica may be handed over right after the timeout
+        waiter.event.wait()
+        return waiter.replica
+
+    def _grant(self, future, replica):
+        # Runs on the loop of an async waiter, the replica goes back if it stopped waiting
+        if future.done():
+            self.put(replica)
+        else:
+            future.set_result(replica)
+
+    async def get_async(self, timeout=-1):
+        """
+        Take a free replica, awaiting one without holding a thread
+        """
+        if timeout == -1:
+            timeout = self.timeout
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._lock:
+            replica = self._try_get(waiter)
+        if replica is not None:
+            return replica
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as ex:
+            if not self._remove_waiter(waiter) and future.done() and not future.cancelled():
+                # The replica was given just before the timeout or the cancellation
+                self.put(future.result())
+            if isinstance(ex, asyncio.TimeoutError):
+                raise self._timeout_error()
+            raise
+
+    def put(self, replica):
+        """
+        Give the replica to the first waiting call, or free it
+        """
+        with self._lock:
+            while len(self._waiters) > 0:
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, _ThreadWaiter):
+                    waiter.replica = replica
+                    waiter.event.set()
+                    return
+                loop, future = waiter
+                try:
+                    loop.call_soon_threadsafe(self._grant, future, replica)
+                    return
+                except RuntimeError:
+                    # The loop of this waiter is closed
+                    continue
+            self._free.append(replica)
+
+    @contextmanager
+    def acquire(self, timeout=-1):
+        replica = self.get(timeout)
+        try:
+            yield replica
+        finally:
+            self.put(replica)
+
+    @asynccontextmanager
+    async def acquire_async(self, timeout=-1):
+        replica = await self.get_async(timeout)
+        try:
+            yield replica
+        finally:
+            self.put(replica)
+
+    def status(self):
+        return {
+            'replicas': self.size,
+            'available': self.available
+        }
@@ -1,33 +1,61 @@
 from inspect import signature
 import inspect
-from threading import Lock, Event
-import itertools
+import os
+import copy
+import gc
+import time
+from collections import defaultdict
+from threading import Event, Lock, Thread
+from weakref import WeakKeyDictionary, finalize
 import types
 from mlchain.context import mlchain_context
-from .exceptions import MLChainAssertionError, MlChainError, MLChain404Error
+from .exceptions import MLChainAssertionError, MlChainError, MLChain404Error, MLChainNotReadyError
+from .converter import Converter
+from .log import logger
+from .batching import BatchCollector, AsyncBatchCollector, AdaptiveBatchSize, shape_bucket_key
+from .replicas import ReplicaPool
+from .call_plan import CallPlan
+from .cache import ResultCache, UncacheableError, content_hash
+from .singleflight import SingleFlight
+from .executor import BoundedExecutor
+from .limiter import ConcurrencyLimiter
+from .coordinator import COORDINATOR_ENV
 from thefuzz import process as fuzzywuzzy_process
 
+_MISSING = object()
+_SWAPPED_ATTRIBUTES = ('model', 'all_serve_function', 'all_atrributes', 'batch_functions', 'call_plans',
+                       'caches', 'limiters', 'coalesce_functions', 'replica_pool', 'warmup_samples', 'executors',
+                       'max_content_lengths', 'compressions')
+
 def non_thread(timeout=-1):
     if timeout is None or (isinstance(timeout, (float, int)) and timeout <= 0):
         timeout = -1
     else:
         timeout = float(timeout)
-    lock = Lock()
 
     def wrapper(func):
+        # Methods get one lock per instance, so replicas of a model don't share it
+        is_method = next(iter(signature(func).parameters), None) == 'self'
+        lock = Lock()
+        instance_locks = WeakKeyDictionary()
+
+        def get_lock(args):
+            if not is_method or len(args) == 0:
+                return lock
+            try:
+                with lock:
+                    return instance_locks.setdefault(args[0], Lock())
+            except TypeError:
+                return lock
+
         def f(*args, **kwargs):
-            acquire = lock.acquire(timeout=timeout)
-            if acquire:
-                try:
-                    output = func(*args, **kwargs)
-                except Exception as e:
-                    lock.release()
-                    raise e
-                lock.release()
-            else:
-                lock.release()
+            call_lock = get_lock(args)
+            if not call_lock.acquire(timeout=timeout):
                 raise MlChainError("Timeout nonthread", code="T001", status_code=408)
-            return output
+            try:
+                return func(*args, **kwargs)
+            finally:
+                call_lock.release()
 
         f.__signature__ = signature(func)
         f.__qualname__ = func.__qualname__
@@ -38,7 +66,9 @@ def non_thread(timeout=-1):
 
 
 def get_single_funcion(batch_func, variables, variable_names=None, default=None, timeout=-1,
-                       name='single_func', max_queue=100, max_batch_size=32):
+                       name='single_func', max_queue=100, max_batch_size=32, max_wait_ms=0,
+                       max_queue_bytes=None, max_queue_delay_ms=None, latency_target_ms=None,
+                       bucket_by=None, bucket_granularity=1, pad=None, pad_value=0):
     if timeout is None or (isinstance(timeout, (float, int)) and timeout <= 0):
         timeout = -1
     else:
@@ -56,63 +86,30 @@ def get_single_funcion(batch_func, variables, variable_names=None, default=None,
         if var not in variable_names:
             variable_names[var] = var
     arg_names = list(variable_names.values())
-    queue = []
-    lock = Lock()
-    result = {}
-    job_counter = itertools.count()
-
-    def handler():
-        if len(queue) > 0:
-            pivot = min(max_batch_size, len(queue))
-            kwargs = {variable: [] for variable in variable_names}
-            done_events = []
-            ids = []
-            for sample in queue[:pivot]:
-                if sample['done__'].is_set():
-                    continue
-                for k in kwargs:
-                    kwargs[k].append(sample[variable_names[k]])
-                done_events.append(sample['done__'])
-                ids.append(sample['id__'])
-            if len(ids) > 0:
-                try:
-                    outputs = batch_func(**kwargs, **default)
-                except Exception as e:
-                    outputs = [str(e)] * len(ids)
-                for done, uid, output in zip(done_events, ids, outputs):
-                    result[uid] = output
-                    done.set()
-            for i in range(pivot):
-                queue.pop(0)
+    controller = None
+    if latency_target_ms is not None:
+        controller = AdaptiveBatchSize(latency_target_ms, max_batch_size, max_wait_ms=max_wait_ms)
+    if isinstance(bucket_by, str):
+        assert bucket_by in variable_names, "bucket_by must be one of the batch variables"
+        bucket_key = shape_bucket_key(variable_names[bucket_by], bucket_granularity)
+    else:
+        bucket_key = bucket_by
+    collector_config = dict(default=default, timeout=timeout, name=name, max_queue=max_queue,
+                            max_batch_size=max_batch_size, max_wait_ms=max_wait_ms,
+                            max_queue_bytes=max_queue_bytes, max_queue_delay_ms=max_queue_delay_ms,
+                            controller=controller, bucket_key=bucket_key, pad=pad, pad_value=pad_value)
+    collector = BatchCollector(batch_func, variable_names, **collector_config)
+    async_collector = AsyncBatchCollector(batch_func, variable_names, **collector_config)
 
-    def f(*args, **kwargs):
-        if len(queue) > max_queue:
-            raise MlChainError("Serve busy", code="T003", status_code=429)
+    def get_params(args, kwargs):
         assert len(args) + len(kwargs) == len(arg_names)
-        event = Event()
-        uid = next(job_counter)
-        params = {**{v: arg for v, arg in zip(arg_names, args)}, **kwargs,
-                  'id__': uid, 'done__': event}
-        queue.append(params)
-
-        acquire = lock.acquire(timeout=timeout)
-        if acquire:
-            try:
-                if not event.is_set():
-                    handler()
-            except Exception as ex:
-                lock.release()
-                raise ex
-            lock.release()
-        else:
-            lock.release()
-            raise MlChainError("Timeout batch", code="T002", status_code=408)
+        return {**{v: arg for v, arg in zip(arg_names, args)}, **kwargs}
 
-        if not event.wait(timeout):
-            raise MlChainError("Timeout batch", code="T002", status_code=408)
-        if uid in result:
-            return result.pop(uid)
-        raise MlChainError("Timeout batch", code="T002", status_code=408)
+    def f(*args, **kwargs):
+        return collector.submit(get_params(args, kwargs))
+
+    async def f_async(*args, **kwargs):
+        return await async_collector.submit(get_params(args, kwargs))
 
     if self:
         wrapper = eval('lambda self,{0}: 0'.format(', '.join(arg_names)))
@@ -126,12 +123,37 @@ def get_single_funcion(batch_func, variables, variable_names=None, default=None,
 
     f.__signature__ = signature(wrapper)
     f.__qualname__ = '.'.join(batch_func.__qualname__.split('.')[:-1] + [name])
+    f.__BATCH_COLLECTOR__ = collector
+    f.__ASYNC_BATCH_COLLECTOR__ = async_collector
+    f.__ASYNC_SINGLE_FUNCTION__ = f_async
     del wrapper
     return f
 
 
 def batch(name, variables, default=None, variable_names=None, timeout=-1,
-          max_queue=100, max_batch_size=32):
+          max_queue=100, max_batch_size=32, max_wait_ms=0,
+          max_queue_bytes=None, max_queue_delay_ms=None, latency_target_ms=None,
+          bucket_by=None, bucket_granularity=1, pad=None, pad_value=0):
+    """
+    Serve a batch function as a single-input function named `name`
+    :name: Name of the served single function
+    :variables: Dict of batch variable name to the type of one item
+    :default: Constant keyword arguments passed to every batch call
+    :variable_names: Dict of batch variable name to the single function argument name
+    :timeout: Seconds a single call waits for its result, -1 is no limit
+    :max_queue: Max number of queued calls before rejecting with 429
+    :max_batch_size: A batch is flushed as soon as it has this many items
+    :max_wait_ms: A batch is flushed when its oldest item has waited this long
+    :max_queue_bytes: Max estimated payload bytes of queued calls before rejecting with 429
+    :max_queue_delay_ms: Reject with 429 when the estimated wait is longer, default is timeout
+    :latency_target_ms: If set, adapt the batch size up to max_batch_size to keep p99 under this target
+    :bucket_by: Batch variable whose shape (or length) groups calls into separate batches,
+                or a callable taking the single call kwargs and returning a bucket key
+    :bucket_granularity: Round shapes up to a multiple of this before bucketing
+    :pad: Batch variable (or list of them) padded into one (n, *max_shape) ndarray, the batch
+          function then also gets `<variable>_mask` and `<variable>_shapes` keyword arguments
+    :pad_value: Value used for padding
+    """
     def wrapper(f):
         f.__BATCH_CONFIG__ = {
             'name': name,
@@ -140,67 +162,568 @@ def batch(name, variables, default=None, variable_names=None, timeout=-1,
             'default': default,
             'timeout': timeout,
             'max_queue': max_queue,
-            'max_batch_size': max_batch_size
+            'max_batch_size': max_batch_size,
+            'max_wait_ms': max_wait_ms,
+            'max_queue_bytes': max_queue_bytes,
+            'max_queue_delay_ms': max_queue_delay_ms,
+            'latency_target_ms': latency_target_ms,
+            'bucket_by': bucket_by,
+            'bucket_granularity': bucket_granularity,
+            'pad': pad,
+            'pad_value': pad_value
+        }
+        return f
+
+    return wrapper
+
+
+def cache(max_bytes=64 * 1024 * 1024, max_entries=None, ttl=None):
+    """
+    Cache outputs of a served function by a content hash of its arguments.
+    On a @batch function, the served single function is cached
+    :max_bytes: Max estimated bytes of all cached outputs
+    :max_entries: Max number of cached outputs, None is no limit
+    :ttl: Seconds an output stays valid, None is forever
+    """
+    def wrapper(f):
+        f.__CACHE_CONFIG__ = {
+            'max_bytes': max_bytes,
+            'max_entries': max_entries,
+            'ttl': ttl
+        }
+        return f
+
+    return wrapper
+
+
+def limit(max_concurrency=1, max_queue=None, timeout=None):
+    """
+    Limit the concurrent calls of a served function, so it can't take every worker of the server.
+    On a @batch function, calls of the served single function are limited
+    :max_concurrency: Max calls running at once
+    :max_queue: Max calls waiting for a slot, more calls get 429. None is no limit
+    :timeout: Seconds a call waits for a slot before 429, None is no limit
+    """
+    def wrapper(f):
+        f.__LIMIT_CONFIG__ = {
+            'max_concurrency': max_concurrency,
+            'max_queue': max_queue,
+            'timeout': timeout
         }
         return f
 
     return wrapper
 
 
+def max_content_length(max_bytes):
+    """
+    Reject requests of a served function whose body is larger than max_bytes with 413,
+    from their Content-Length header before the body is read
+    :max_bytes: Max bytes of the request body
+    """
+    def wrapper(f):
+        f.__MAX_CONTENT_LENGTH__ = max_bytes
+        return f
+
+    return wrapper
+
+
+def _compression_config(min_size=None, encodings=None, enabled=True):
+    config = {}
+    if min_size is not None:
+        config['min_size'] = min_size
+    if encodings is not None:
+        config['encodings'] = list(encodings)
+    if not enabled:
+        config['encodings'] = []
+    return config
+
+
+def compression(min_size=None, encodings=None, enabled=True):
+    """
+    Override the response compression of the server for a served function
+    :min_size: Min bytes of a compressed response, None keeps the one of the server
+    :encodings: Encodings offered by preference (zstd, lz4, gzip), None keeps the ones of the server
+    :enabled: False to never compress its responses, like already compressed images or videos
+    """
+    def wrapper(f):
+        f.__COMPRESSION_CONFIG__ = _compression_config(min_size, encodings, enabled)
+        return f
+
+    return wrapper
+
+
+def warmup(*samples):
+    """
+    Run sample inputs through a served function before the model is ready.
+    On a @batch function, the samples are inputs of the served single function
+    :samples: Dicts of kwargs, values are converted like request values
+    """
+    def wrapper(f):
+        f.__WARMUP_SAMPLES__ = list(getattr(f, '__WARMUP_SAMPLES__', [])) + list(samples)
+        return f
+
+    return wrapper
+
+
+def _is_generator_function(func):
+    return inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func)
+
+
+def hold_until_consumed(output, releases):
+    """
+    Run releases (in reverse order) once a generator output is exhausted or closed, instead of when its call
+    returns, so the stream keeps the slots it runs on
+    :return: The wrapped generator, None if output isn't one
+    """
+    lock = Lock()
+
+    def release():
+        with lock:
+            pending = list(releases)
+            releases.clear()
+        for func in reversed(pending):
+            func()
+
+    if inspect.isgenerator(output):
+        def stream():
+            try:
+                yield from output
+            finally:
+                release()
+        wrapped = stream()
+    elif inspect.isasyncgen(output):
+        async def async_stream():
+            try:
+                async for item in output:
+                    yield item
+            finally:
+                try:
+                    await output.aclose()
+                finally:
+                    release()
+        wrapped = async_stream()
+    else:
+        return None
+    # A stream that is never started doesn't run its finally block
+    finalize(wrapped, release)
+    return wrapped
+
+
+def _close_batch_functions(batch_functions):
+    for func in batch_functions:
+        func.__BATCH_COLLECTOR__.close()
+        func.__ASYNC_BATCH_COLLECTOR__.close()
+
+
 class ServeModel:
     def __init__(self, model, name=None, deny_all_function=False,
-                 blacklist=[], whitelist=[], config=None):
+                 blacklist=[], whitelist=[], config=None,
+                 replicas=1, model_factory=None, replica_timeout=None, caches=None,
+                 coalesce=None, warmup=None, background_load=False, executor=None, limits=None,
+                 max_content_lengths=None, compressions=None):
+        """
+        :model: The model instance to serve, None to build it with model_factory
+        :replicas: Number of model replicas, each one serves a single call at a time
+        :model_factory: Callable building the model or one more replica, default replica is a deepcopy of model.
+                        With the batch coordinator, a class isn't built in the HTTP workers, they forward their calls
+        :replica_timeout: Seconds a call waits for a free replica, None is no limit
+        :caches: Dict of function name to the options of @cache (or True for the defaults)
+        :coalesce: List of function names (or True for all) whose identical concurrent requests
+                   share one execution
+        :warmup: Dict of function name to a list of sample kwargs run before the model is ready
+        :background_load: Build and warm up the model in a background thread, the server answers
+                          /api/ping meanwhile and /api/ready once it is done
+        :executor: Options of the pools running sync functions off the event loop of async servers,
+                   dict of type (thread or process), max_workers, max_queue and functions, a dict of
+                   function name to its own options
+        :limits: Dict of function name to the options of @limit
+        :max_content_lengths: Dict of function name to the max bytes of its request body, like @max_content_length
+        :compressions: Dict of function name to the options of @compression
+        """
         if isinstance(model, type):
             raise AssertionError("Your input model must be an instance")
+        if model is None and model_factory is None:
+            raise AssertionError("You need to give a model or a model_factory")
 
         self.model = model
-        self.name = name or model.__class__.__name__
+        self.name = name or (model.__class__.__name__ if model is not None
+                             else getattr(model_factory, '__name__', 'Model'))
+        self.deny_all_function = deny_all_function
+        self.blacklist = blacklist
+        self.whitelist = whitelist
+        self.replicas = replicas
+        self.model_factory = model_factory
+        self.replica_timeout = replica_timeout
+        self.cache_options = caches or {}
+        self.coalesce = coalesce
+        self.warmup_options = defaultdict(list)
+        for function_name, samples in (warmup or {}).items():
+            self.warmup_options[function_name].extend(samples)
+        self.warmup_samples = defaultdict(list, {k: list(v) for k, v in self.warmup_options.items()})
+        self.config = config
+        self.executor_options = executor or {}
+        self.limit_options = limits or {}
+        self.max_content_length_options = max_content_lengths or {}
+        self.compression_options = compressions or {}
+
         self.all_serve_function = set()
         self.all_atrributes = set()
-        blacklist_set = set(self._check_blacklist(deny_all_function, blacklist, whitelist))
-        self._check_all_func(blacklist_set)
-        self._check_all_attribute(blacklist_set)
-        self.config = config
+        self.batch_functions = {}
+        self.call_plans = {}
+        self.caches = {}
+        self.limiters = {}
+        self.max_content_lengths = {}
+        self.compressions = {}
+        self.coalesce_functions = set()
+        self.replica_pool = None
+        self.coordinator = None
+        self.proxy = False
+        self.single_flight = SingleFlight()
+        self.executors = {}
+        self._executor_lock = Lock()
+        self.loaded = False
+        self.load_error = None
+        self.warming = 0
+        self.warmup_error = None
+        self._loaded = Event()
+        self._warming_lock = Lock()
+        self._swap_lock = Lock()
+        self.generation = 0
 
-    def _check_blacklist(self, deny_all_function, blacklist, whitelist):
-        output = []
-        if deny_all_function:
-            for name in dir(self.model):
-                try:
-                    attr = getattr(self.model, name)
+        if background_load:
+            Thread(target=self._load_and_warm_up, daemon=True).start()
+        else:
+            self._load_and_warm_up(raise_error=True)
+
+    def _load_and_warm_up(self, raise_error=False):
+        try:
+            self._load()
+        except Exception as ex:
+            self.load_error = "{0}: {1}".format(type(ex).__name__, ex)
+            logger.error("Can't load model {0}: {1}".format(self.name, self.load_error))
+            self._loaded.set()
+            if raise_error:
+                raise
+            return
+        self.warm_up(background=False)
 
-                    if not name.startswith("__") and (
-                            getattr(attr, "_MLCHAIN_EXCEPT_SERVING", False) or name not in whitelist):
-                        output.append(name)
-                except Exception as e:
-                    pass
+    def _load(self):
+        """
+        Build the model if needed and find all served functions and attributes
+        """
+        if self.model is None and os.environ.get(COORDINATOR_ENV) and isinstance(self.model_factory, type):
+            # The batch coordinator owns the model, this worker only forwards calls to it,
+            # so the instance is never initialized and holds no weights
+            self.model = object.__new__(self.model_factory)
+            self.proxy = True
+        elif self.model is None:
+            model = self.model_factory()
+            if isinstance(model, type):
+                raise AssertionError("Your model_factory must return an instance")
+            self.model = model
+        if self.replicas is not None and self.replicas > 1 and not self.proxy:
+            self.replica_pool = ReplicaPool(self._build_replicas(self.replicas, self.model_factory),
+                                            timeout=self.replica_timeout)
+        attributes = self._get_model_attributes()
+        blacklist_set = set(self._check_blacklist(self.deny_all_function, self.blacklist,
+                                                  self.whitelist, attributes))
+        self._check_all_func(blacklist_set, attributes)
+        self._check_all_attribute(blacklist_set, attributes)
+        for function_name, cache_config in self.cache_options.items():
+            if function_name not in self.all_serve_function:
+                raise MLChainAssertionError("Can't cache {0}, it is not served".format(function_name))
+            self.caches[function_name] = ResultCache(**(cache_config if isinstance(cache_config, dict) else {}))
+        for function_name, limit_config in self.limit_options.items():
+            self.set_limit(function_name, **limit_config)
+        self.max_content_lengths.update(self.max_content_length_options)
+        for function_name, compression_config in self.compression_options.items():
+            self.compressions[function_name] = _compression_config(**compression_config)
+        if self.coalesce is True:
+            self.coalesce_functions = set(self.all_serve_function)
         else:
-            for name in dir(self.model):
-                attr = getattr(self.model, name)
+            self.coalesce_functions = set(self.coalesce or [])
+        # A generator is consumed by one response, it can't be shared by coalesced requests
+        self.coalesce_functions = {name for name in self.coalesce_functions
+                                   if not _is_generator_function(getattr(self.model, name, None))}
+        self.loaded = True
+        self._loaded.set()
 
-                try:
-                    if not name.startswith("__") \
-                            and (getattr(attr, "_MLCHAIN_EXCEPT_SERVING", False)
-                                 or name in blacklist):
-                        output.append(name)
-                except Exception as e:
-                    pass
+    def warm_up(self, samples=None, background=False):
+        """
+        Run sample inputs through the served functions, the model is ready when all of them succeed
+        :samples: Dict of function name to a list of sample kwargs, added to the ones from @warmup
+        :background: Run in a background thread
+        """
+        for function_name, function_samples in (samples or {}).items():
+            self.warmup_options[function_name].extend(function_samples)
+            self.warmup_samples[function_name].extend(function_samples)
+        with self._warming_lock:
+            self.warming += 1
+        if background:
+            Thread(target=self._warm_up, args=(samples,), daemon=True).start()
+        else:
+            self._warm_up(samples)
+
+    def _warm_up(self, samples=None):
+        try:
+            self._loaded.wait()
+            if not self.loaded or self.proxy:
+                # The batch coordinator warms up the model it owns
+                return
+            if samples is None:
+                samples = self.warmup_samples
+            converter = Converter()
+            for function_name, function_samples in samples.items():
+                plan = self.get_call_plan(function_name)
+                for sample in function_samples:
+                    start_time = time.time()
+                    kwargs = plan.bind((), dict(sample), converter)
+                    self.call_function(function_name, None, **kwargs)
+                    logger.debug("Warmed up {0} in {1:.3f}s".format(function_name, time.time() - start_time))
+        except Exception as ex:
+            self.warmup_error = "{0}: {1}".format(type(ex).__name__, ex)
+            logger.error("Can't warm up model {0}: {1}".format(self.name, self.warmup_error))
+        finally:
+            with self._warming_lock:
+                self.warming -= 1
+
+    def swap_model(self, model=None):
+        """
+        Load a new model instance next to the current one, warm it up and switch to it.
+        In-flight calls and batches finish on the old instance
+        :model: The new model instance, None to build it with model_factory
+        """
+        with self._swap_lock:
+            start_time = time.time()
+            self._check_loaded()
+            if self.proxy:
+                raise MLChainAssertionError("This worker forwards its calls, swap the model of the batch coordinator")
+            if model is None:
+                if self.model_factory is None:
+                    raise MLChainAssertionError("You need a model_factory to reload the model")
+                model = self.model_factory()
+            staged = ServeModel(model, name=self.name, deny_all_function=self.deny_all_function,
+                                blacklist=self.blacklist, whitelist=self.whitelist, config=self.config,
+                                replicas=self.replicas, model_factory=self.model_factory,
+                                replica_timeout=self.replica_timeout, caches=self.cache_options,
+                                coalesce=self.coalesce, warmup=self.warmup_options,
+                                executor=self.executor_options, limits=self.limit_options,
+                                max_content_lengths=self.max_content_length_options,
+                                compressions=self.compression_options)
+            if staged.warmup_error is not None:
+                raise MlChainError("New model failed to warm up. {0}".format(staged.warmup_error),
+                                   code="swap", status_code=500)
+
+            old_batch_functions = list(self.batch_functions.values())
+            old_executors = list(self.executors.values())
+            # A single dict update, so each attribute is swapped at once
+            self.__dict__.update({key: staged.__dict__[key] for key in _SWAPPED_ATTRIBUTES})
+            self.generation += 1
+            del staged, model
+
+        _close_batch_functions(old_batch_functions)
+        # Process pools hold a copy of the old model, queued calls still finish on it
+        for executor in old_executors:
+            executor.shutdown(wait=False)
+        del old_batch_functions, old_executors
+        # Release the old instance as soon as the last in-flight call is done with it
+        gc.collect()
+        logger.info("Swapped model {0} to generation {1} in {2:.2f}s".format(
+            self.name, self.generation, time.time() - start_time))
+        return {
+            'generation': self.generation,
+            'swap_time': time.time() - start_time
+        }
+
+    def close(self):
+        """
+        Stop the batch collectors and executors once their queued calls are done, before dropping the model
+        """
+        _close_batch_functions(self.batch_functions.values())
+        self._shutdown_executors()
+
+    def use_executor(self, options):
+        """
+        Replace the options of the pools running sync functions, see executor of ServeModel
+        """
+        self.executor_options = options or {}
+        self._shutdown_executors()
+
+    def _shutdown_executors(self):
+        with self._executor_lock:
+            executors, self.executors = list(self.executors.values()), {}
+        for executor in executors:
+            executor.shutdown(wait=False)
+
+    def get_executor(self, function_name):
+        """
+        Get the pool running function_name, pools are created on first use
+        """
+        function_options = (self.executor_options.get('functions') or {}).get(function_name)
+        key = function_name if function_options else None
+        executor = self.executors.get(key)
+        if executor is None:
+            with self._executor_lock:
+                executor = self.executors.get(key)
+                if executor is None:
+                    options = {k: v for k, v in self.executor_options.items() if k != 'functions'}
+                    options.update(function_options or {})
+                    executor = BoundedExecutor(max_workers=options.get('max_workers'),
+                                               max_queue=options.get('max_queue'),
+                                               kind=options.get('type') or 'thread',
+                                               model=self.model,
+                                               name="{0}-{1}".format(self.name, key or 'default'))
+                    self.executors[key] = executor
+        return executor
+
+    async def run_sync(self, function_name, func, args, kwargs):
+        """
+        Await a sync function of function_name running in its executor
+        """
+        executor = self.get_executor(function_name)
+        if executor.kind == 'process':
+            return await executor.run(function_name or '__call__', *args, **kwargs)
+        return await executor.run(func, *args, **kwargs)
+
+    def set_limit(self, function_name, max_concurrency=1, max_queue=None, timeout=None):
+        """
+        Limit the concurrent calls of function_name like @limit
+        """
+        if function_name not in self.all_serve_function:
+            raise MLChainAssertionError("Can't limit {0}, it is not served".format(function_name))
+        self.limiters[function_name] = ConcurrencyLimiter(max_concurrency=max_concurrency,
+                                                          max_queue=max_queue, timeout=timeout)
+
+    def use_limits(self, limits):
+        """
+        Set the limits of many functions, dict of function name to the options of @limit
+        """
+        for function_name, limit_config in (limits or {}).items():
+            self.limit_options[function_name] = limit_config
+            self.set_limit(function_name, **limit_config)
+
+    def check_content_length(self, function_name, content_length):
+        """
+        Reject a request of function_name with 413 if its Content-Length is over the limit of the function
+        """
+        max_bytes = self.max_content_lengths.get(function_name)
+        if max_bytes is None or content_length is None:
+            return
+        try:
+            content_length = int(content_length)
+        except ValueError:
+            raise MLChainAssertionError("Invalid Content-Length {0}".format(content_length))
+        if content_length > max_bytes:
+            raise MlChainError("Request too large, {0} accepts at most {1} bytes".format(function_name, max_bytes),
+                               code="too_large", status_code=413)
+
+    def _get_limit_status(self):
+        """
+        Get running, waiting and rejected calls of the functions with a concurrency limit
+        """
+        return {name: limiter.status() for name, limiter in self.limiters.items()}
+
+    def _get_executor_status(self):
+        """
+        Get workers, running and queued calls of the executors of sync functions
+        """
+        return {key or 'default': executor.status() for key, executor in list(self.executors.items())}
+
+    def _check_ready(self):
+        """
+        Check the model is loaded and warmed up, for load balancers and readiness probes
+        """
+        if self.load_error is not None:
+            raise MLChainNotReadyError("Model failed to load. {0}".format(self.load_error))
+        if not self.loaded:
+            raise MLChainNotReadyError("Model is loading")
+        if self.warmup_error is not None:
+            raise MLChainNotReadyError("Model failed to warm up. {0}".format(self.warmup_error))
+        if self.warming > 0:
+            raise MLChainNotReadyError("Model is warming up")
+        return "ready"
+
+    def _check_loaded(self):
+        if not self.loaded:
+            if self.load_error is not None:
+                raise MLChainNotReadyError("Model failed to load. {0}".format(self.load_error))
+            raise MLChainNotReadyError("Model is loading")
+
+    def _build_replicas(self, replicas, model_factory):
+        output = [self.model]
+        for _ in range(replicas - 1):
+            if model_factory is not None:
+                replica = model_factory()
+            else:
+                replica = copy.deepcopy(self.model)
+            if isinstance(replica, type):
+                raise AssertionError("Your model_factory must return an instance")
+            output.append(replica)
+        return output
+
+    def _get_model_attributes(self):
+        """
+        Get all attributes of the model in a single pass
+        """
+        output = {}
+        for name in dir(self.model):
+            try:
+                output[name] = getattr(self.model, name)
+            except Exception as e:
+                pass
+        return output
+
+    def _check_blacklist(self, deny_all_function, blacklist, whitelist, attributes):
+        output = []
+        for name, attr in attributes.items():
+            try:
+                if name.startswith("__"):
+                    continue
+                if getattr(attr, "_MLCHAIN_EXCEPT_SERVING", False):
+                    output.append(name)
+                elif deny_all_function and name not in whitelist:
+                    output.append(name)
+                elif not deny_all_function and name in blacklist:
+                    output.append(name)
+            except Exception as e:
+                pass
 
         return output
 
-    def _check_all_func(self, blacklist_set):
+    def _check_all_func(self, blacklist_set, attributes):
         """
         Check all available function of class to serve
         """
 
         self.all_serve_function = set()
-        for name in dir(self.model):
-            attr = getattr(self.model, name)
-
+        self.batch_functions = {}
+        self.call_plans = {}
+        self.caches = {}
+        for name, attr in attributes.items():
+            if name in self.batch_functions:
+                continue
             if (not name.startswith("__") or name == '__call__') \
                     and callable(attr) and name not in blacklist_set:
                 self.all_serve_function.add(name)
+                self.call_plans[name] = CallPlan(name, attr)
                 batch_config = getattr(attr, '__BATCH_CONFIG__', None)
+                served_name = batch_config['name'] if batch_config else name
+                cache_config = getattr(attr, '__CACHE_CONFIG__', None)
+                if cache_config:
+                    self.caches[served_name] = ResultCache(**cache_config)
+                limit_config = getattr(attr, '__LIMIT_CONFIG__', None)
+                if limit_config:
+                    self.limiters[served_name] = ConcurrencyLimiter(**limit_config)
+                max_bytes = getattr(attr, '__MAX_CONTENT_LENGTH__', None)
+                if max_bytes is not None:
+                    self.max_content_lengths[served_name] = max_bytes
+                compression_config = getattr(attr, '__COMPRESSION_CONFIG__', None)
+                if compression_config is not None:
+                    self.compressions[served_name] = compression_config
+                warmup_samples = getattr(attr, '__WARMUP_SAMPLES__', None)
+                if warmup_samples:
+                    self.warmup_samples[served_name].extend(warmup_samples)
                 if batch_config:
                     single_func = get_single_funcion(attr, variables=batch_config['variables'],
                                                      default=batch_config['default'],
@@ -208,24 +731,35 @@ class ServeModel:
                                                      timeout=batch_config['timeout'],
                                                      name=batch_config['name'],
                                                      max_queue=batch_config['max_queue'],
-                                                     max_batch_size=batch_config['max_batch_size'])
+                                                     max_batch_size=batch_config['max_batch_size'],
+                                                     max_wait_ms=batch_config.get('max_wait_ms', 0),
+                                                     max_queue_bytes=batch_config.get('max_queue_bytes'),
+                                                     max_queue_delay_ms=batch_config.get('max_queue_delay_ms'),
+                                                     latency_target_ms=batch_config.get('latency_target_ms'),
+                                                     bucket_by=batch_config.get('bucket_by'),
+                                                     bucket_granularity=batch_config.get('bucket_granularity', 1),
+                                                     pad=batch_config.get('pad'),
+                                                     pad_value=batch_config.get('pad_value', 0))
+                    if self.replica_pool is not None:
+                        single_func.__BATCH_COLLECTOR__.use_replicas(self.replica_pool, name)
+                        single_func.__ASYNC_BATCH_COLLECTOR__.use_replicas(self.replica_pool, name)
                     setattr(self.model, batch_config['name'], single_func)
                     self.all_serve_function.add(batch_config['name'])
+                    self.batch_functions[batch_config['name']] = single_func
+                    self.call_plans[batch_config['name']] = CallPlan(batch_config['name'], single_func)
 
     def _list_all_atrributes(self):
         return list(self.all_atrributes)
 
-    def _check_all_attribute(self, blacklist_set):
+    def _check_all_attribute(self, blacklist_set, attributes):
         """
         Check all available function of class to serve
         """
 
         self.all_atrributes = set()
-        for name in dir(self.model):
-            attr = getattr(self.model, name)
-
+        for name, attr in attributes.items():
             try:
-                if not name.startswith("__") and not callable(attr):
+                if not name.startswith("__") and not callable(attr) and name not in self.batch_functions:
                     if not getattr(attr, "_MLCHAIN_EXCEPT_SERVING", False) \
                             and name not in blacklist_set:
                         self.all_atrributes.add(name)
@@ -255,7 +789,7 @@ class ServeModel:
         output = {}
 
         for name in self.all_serve_function:
-            output[name] = str(signature(getattr(self.model, name)))
+            output[name] = str(self.call_plans[name].signature)
         return output
 
     def _get_description_of_func(self, function_name):
@@ -276,7 +810,7 @@ class ServeModel:
                 or function_name not in self.all_serve_function:
             return "No parameters for unknown function"
 
-        return str(signature(getattr(self.model, function_name)))
+        return str(self.call_plans[function_name].signature)
 
     def _get_all_description(self):
         """
@@ -290,12 +824,113 @@ class ServeModel:
         }
         return output
     
+    def _get_batch_status(self):
+        """
+        Get queue, batch size and fitted latency curve of all batched functions
+        """
+        output = {}
+
+        for name, func in self.batch_functions.items():
+            collector = func.__BATCH_COLLECTOR__
+            async_collector = func.__ASYNC_BATCH_COLLECTOR__
+            status = collector.status()
+            status['queue'] += len(async_collector.queue)
+            status['queued_bytes'] += async_collector.queued_bytes
+            if collector.controller is not None:
+                status['adaptive'] = collector.controller.status()
+            output[name] = status
+        return output
+
+    def _get_cache_status(self):
+        """
+        Get entries, bytes and hit/miss stats of all cached functions
+        """
+        return {name: result_cache.status() for name, result_cache in self.caches.items()}
+
+    def _get_cached(self, function_name, args, kwargs):
+        """
+        Get (cache key, cached output or _MISSING) of a call, the key is None if it isn't cached
+        """
+        result_cache = self.caches.get(function_name)
+        if result_cache is None:
+            return None, _MISSING
+        try:
+            key = content_hash(function_name, args, kwargs)
+        except UncacheableError:
+            mlchain_context['MLCHAIN_CACHE_STATUS'] = 'mlchain; fwd=bypass'
+            return None, _MISSING
+        hit, output = result_cache.get(key)
+        if hit:
+            mlchain_context['MLCHAIN_CACHE_STATUS'] = 'mlchain; hit'
+            return key, output
+        return key, _MISSING
+
+    def _set_cached(self, function_name, key, output):
+        if key is None:
+            return
+        if inspect.isgenerator(output) or inspect.isasyncgen(output):
+            mlchain_context['MLCHAIN_CACHE_STATUS'] = 'mlchain; fwd=bypass'
+            return
+        if self.caches[function_name].put(key, output):
+            mlchain_context['MLCHAIN_CACHE_STATUS'] = 'mlchain; fwd=miss; stored'
+        else:
+            mlchain_context['MLCHAIN_CACHE_STATUS'] = 'mlchain; fwd=miss'
+
+    def get_coalesce_key(self, function_name, kwargs):
+        """
+        Get the key grouping identical requests of function_name, None if they aren't coalesced
+        """
+        if function_name not in self.coalesce_functions:
+            return None
+        try:
+            return content_hash(function_name, (), kwargs)
+        except UncacheableError:
+            return None
+
+    def use_coordinator(self, coordinator):
+        """
+        Forward calls of batched functions to a BatchCoordinator through a CoordinatorClient,
+        None to batch in this process again. A proxy forwards the calls of all functions
+        """
+        self.coordinator = coordinator
+
+    def _use_coordinator(self, function_name):
+        return self.coordinator is not None and (self.proxy or function_name in self.batch_functions)
+
+    def _use_replica(self, function_name):
+        """
+        Plain functions run on a free replica, batched ones are dispatched by their collector
+        """
+        return self.replica_pool is not None and function_name not in self.batch_functions
+
+    def _get_replica_status(self):
+        """
+        Get number of replicas and how many are free
+        """
+        if self.replica_pool is None:
+            return {'replicas': 1}
+        return self.replica_pool.status()
+
     def _check_similar_function(self, function_name): 
         """
         Check the most similar function of a function_name
         """
         return [x[0] for x in fuzzywuzzy_process.extract(function_name, self.all_serve_function, limit=3)]
 
+    def get_call_plan(self, function_name):
+        """
+        Get the CallPlan binding request values of function_name
+        """
+        plan = self.call_plans.get(function_name or '__call__')
+        if plan is not None:
+            return plan
+        self._check_loaded()
+        if len(function_name) == 0:
+            raise MLChainAssertionError("You need to specify the function name (API name)")
+        if function_name in self.all_atrributes:
+            return CallPlan(function_name, getattr(self.model, function_name))
+        raise MLChain404Error("This function or attribute hasn't been served or in blacklist. Do you mean: {0}".format(self._check_similar_function(function_name)))
+
     def get_function(self, function_name):
         if len(function_name) == 0:
             if hasattr(self.model, '__call__') and callable(getattr(self.model, '__call__')):
@@ -317,6 +952,7 @@ class ServeModel:
         function_name, uid = function_name_, id_
         if function_name is None:
             raise AssertionError("You need to specify the function name (API name)")
+        self._check_loaded()
 
         if isinstance(function_name, str):
             if len(function_name) == 0:
@@ -332,8 +968,33 @@ class ServeModel:
 
                 func_ = getattr(self.model, function_name)
 
-            # Call function
-            output = func_(*args, **kwargs)
+            cache_key, output = self._get_cached(function_name, args, kwargs)
+            if output is not _MISSING:
+                return output
+
+            releases = []
+            limiter = self.limiters.get(function_name)
+            if limiter is not None:
+                limiter.acquire()
+                releases.append(limiter.release)
+            try:
+                # Call function
+                if self._use_coordinator(function_name):
+                    output = self.coordinator.call(function_name, *args, **kwargs)
+                elif self._use_replica(function_name):
+                    replica_pool = self.replica_pool
+                    replica = replica_pool.get()
+                    releases.append(lambda: replica_pool.put(replica))
+                    output = getattr(replica, function_name or '__call__')(*args, **kwargs)
+                else:
+                    output = func_(*args, **kwargs)
+                stream = hold_until_consumed(output, releases)
+                if stream is not None:
+                    output, releases = stream, []
+            finally:
+                for release in reversed(releases):
+                    release()
+            self._set_cached(function_name, cache_key, output)
         else:
             raise MLChainAssertionError("function_name must be str")
         return output
@@ -345,6 +1006,7 @@ class ServeModel:
         function_name, uid = function_name_, id_
         if function_name is None:
             raise MLChainAssertionError("You need to specify the function name (API name)")
+        self._check_loaded()
 
         if isinstance(function_name, str):
             if len(function_name) == 0:
@@ -360,10 +1022,43 @@ class ServeModel:
                 
                 func_ = getattr(self.model, function_name)
 
-            if inspect.iscoroutinefunction(func_):
-                output = await func_(*args, **kwargs)
-            else:
-                output = func_(*args, **kwargs)
+            cache_key, output = self._get_cached(function_name, args, kwargs)
+            if output is not _MISSING:
+                return output
+
+            releases = []
+            limiter = self.limiters.get(function_name)
+            if limiter is not None:
+                await limiter.acquire_async()
+                releases.append(limiter.release)
+            try:
+                async_single_func = getattr(func_, '__ASYNC_SINGLE_FUNCTION__', None)
+                if self._use_coordinator(function_name):
+                    output = await self.coordinator.call_async(function_name, *args, **kwargs)
+                elif async_single_func is not None:
+                    # Batch on the event loop instead of blocking it in the threaded collector
+                    output = await async_single_func(*args, **kwargs)
+                elif self._use_replica(function_name):
+                    replica_pool = self.replica_pool
+                    replica = await replica_pool.get_async()
+                    releases.append(lambda: replica_pool.put(replica))
+                    replica_func = getattr(replica, function_name or '__call__')
+                    if inspect.iscoroutinefunction(replica_func):
+                        output = await replica_func(*args, **kwargs)
+                    else:
+                        output = await self.run_sync(function_name, replica_func, args, kwargs)
+                elif inspect.iscoroutinefunction(func_):
+                    output = await func_(*args, **kwargs)
+                else:
+                    # Keep the event loop serving other requests while a sync function runs
+                    output = await self.run_sync(function_name, func_, args, kwargs)
+                stream = hold_until_consumed(output, releases)
+                if stream is not None:
+                    output, releases = stream, []
+            finally:
+                for release in reversed(releases):
+                    release()
+            self._set_cached(function_name, cache_key, output)
         else:
             raise MLChainAssertionError("function_name must be str")
         return output
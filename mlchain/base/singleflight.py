@@ -0,0 +1,108 @@
+"""
+Coalesce identical in-flight calls so concurrent duplicates share one execution
+"""
+import asyncio
+from threading import Event, Lock
+
+
+class _Call:
+    __slots__ = ('event', 'done', 'output', 'exception')
+
+    def __init__(self):
+        self.event = Event()
+        self.done = False
+        self.output = None
+        self.exception = None
+
+
+def _is_cancelling():
+    # Python 3.11+ tells if the current task itself is being cancelled
+    task = asyncio.current_task()
+    cancelling = getattr(task, 'cancelling', None)
+    return cancelling is not None and cancelling() > 0
+
+
+class SingleFlight:
+    """
+    Run one call per key at a time, duplicates wait for it and get its output or exception.
+    If the running call is interrupted without an output, like a cancelled coroutine,
+    its duplicates run again with a new leader
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+        self.async_calls = {}
+        self.coalesced = 0
+
+    def do(self, key, func):
+        """
+        Call func(), or wait for the running call with the same key
+        """
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = _Call()
+                else:
+                    self.coalesced += 1
+            if leader:
+                break
+            call.event.wait()
+            if not call.done:
+                continue
+            if call.exception is not None:
+                raise call.exception
+            return call.output
+
+        try:
+            call.output = func()
+            call.done = True
+            return call.output
+        except Exception as ex:
+            call.exception = ex
+            call.done = True
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call.event.set()
+
+    async def do_async(self, key, func):
+        """
+        Await func(), or the running call with the same key on this event loop
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            future = self.async_calls.get((loop, key))
+            if future is None:
+                break
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if future.cancelled() and not _is_cancelling():
+                    continue
+                raise
+
+        future = self.async_calls[(loop, key)] = loop.create_future()
+        try:
+            output = await func()
+            future.set_result(output)
+            return output
+        except Exception as ex:
+            future.set_exception(ex)
+            # Mark it as retrieved when nobody waited for it
+            future.exception()
+            raise
+        finally:
+            self.async_calls.pop((loop, key), None)
+            if not future.done():
+                future.cancel()
+
+    def status(self):
+        return {
+            'in_flight': len(self.calls) + len(self.async_calls),
+            'coalesced': self.coalesced
+        }
@@ -0,0 +1,82 @@
+"""
+Wire format of streamed outputs and request attachments: length-prefixed frames, or Server-Sent Events
+"""
+import struct
+
+STREAM_CONTENT_TYPE = 'application/mlchain-stream'
+EVENT_STREAM_CONTENT_TYPE = 'text/event-stream'
+_HEADER = struct.Struct('>I')
+
+
+def encode_frame(payload):
+    """
+    Prefix an encoded chunk with its length
+    """
+    return _HEADER.pack(len(payload)) + payload
+
+
+def encode_frames(payloads):
+    """
+    Join payloads into one body of frames, copying each payload once
+    """
+    chunks = []
+    for payload in payloads:
+        chunks.append(_HEADER.pack(len(payload)))
+        chunks.append(payload)
+    return b''.join(chunks)
+
+
+def encode_event(data, event=None):
+    """
+    Encode one Server-Sent Event, data is a str without blank lines
+    """
+    lines = [] if event is None else ['event: {0}'.format(event)]
+    lines.extend('data: {0}'.format(line) for line in data.split('\n'))
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+def decode_frames(data):
+    """
+    Split a whole body of frames into memoryview slices of their payloads, without copying them
+    """
+    view = memoryview(data)
+    payloads = []
+    offset = 0
+    while offset < len(view):
+        if offset + _HEADER.size > len(view):
+            raise ValueError("Body ended in the middle of a frame")
+        size = _HEADER.unpack_from(view, offset)[0]
+        start = offset + _HEADER.size
+        offset = start + size
+        if offset > len(view):
+            raise ValueError("Body ended in the middle of a frame")
+        payloads.append(view[start:offset])
+    return payloads
+
+
+class FrameDecoder:
+    """
+    Split received bytes into the payloads of frames, whatever the chunking of the transport
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Add received bytes and get the payloads of the completed frames
+        """
+        self.buffer.extend(data)
+        payloads = []
+        while len(self.buffer) >= _HEADER.size:
+            size = _HEADER.unpack_from(self.buffer)[0]
+            end = _HEADER.size + size
+            if len(self.buffer) < end:
+                break
+            payloads.append(bytes(self.buffer[_HEADER.size:end]))
+            del self.buffer[:end]
+        return payloads
+
+    def close(self):
+        if len(self.buffer) > 0:
+            raise ValueError("Stream ended in the middle of a frame")
@@ -0,0 +1,105 @@
+"""
+Uploaded files kept on disk: spooled while parsed, passed to functions as a file handle or a path
+"""
+import io
+import os
+import shutil
+import tempfile
+import typing
+from pathlib import Path, PurePath
+
+# Uploads from this size are written to a temporary file instead of memory
+SPOOL_MAX_SIZE = 1024 * 1024
+_FILE_TYPES = (io.IOBase, typing.IO, typing.BinaryIO)
+
+
+def spool_file(total_content_length=None):
+    """
+    Get the stream an upload is parsed into, a named temporary file when the request is large
+    so the file can be given by path without copying it
+    """
+    if total_content_length is None or total_content_length > SPOOL_MAX_SIZE:
+        return tempfile.NamedTemporaryFile('wb+')
+    return io.BytesIO()
+
+
+def spool_body():
+    """
+    Get the file a decompressed request body is written to, in memory until it is over SPOOL_MAX_SIZE
+    """
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+
+def _origin(annotation):
+    return getattr(annotation, '__origin__', None) or annotation
+
+
+def is_file_type(annotation):
+    origin = _origin(annotation)
+    try:
+        return origin in _FILE_TYPES or issubclass(origin, io.IOBase)
+    except TypeError:
+        return False
+
+
+def is_path_type(annotation):
+    origin = _origin(annotation)
+    try:
+        return issubclass(origin, PurePath)
+    except TypeError:
+        return False
+
+
+def get_stream(storage):
+    """
+    Get the file object of an uploaded file, from its start
+    """
+    stream = getattr(storage, 'stream', None) or storage.file
+    stream.seek(0)
+    return stream
+
+
+def get_path(storage):
+    """
+    Get a path of an uploaded file on disk, written there if it was spooled in memory.
+    The file lives until the uploaded file is released, at the end of the request
+    """
+    stream = get_stream(storage)
+    name = getattr(stream, 'name', None)
+    if isinstance(name, str) and os.path.isfile(name):
+        return Path(name)
+    _, ext = os.path.splitext(storage.filename or '')
+    copy = tempfile.NamedTemporaryFile('wb+', suffix=ext)
+    shutil.copyfileobj(stream, copy)
+    copy.flush()
+    stream.seek(0)
+    # Deleted with the uploaded file
+    storage.mlchain_spool = copy
+    return Path(copy.name)
+
+
+def get_size(storage):
+    stream = get_stream(storage)
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(0)
+    return size
+
+
+class FileArgument:
+    """
+    A file sent by the mlchain client for an argument. The function gets its handle or path
+    if the parameter is annotated as a file or a Path, else its bytes like any value
+    """
+    __slots__ = ('storage',)
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def accepts_storage(self, annotation):
+        return is_file_type(annotation) or is_path_type(annotation)
+
+    def read(self):
+        return get_stream(self.storage).read()
+
+    def size(self):
+        return get_size(self.storage)
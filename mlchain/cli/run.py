@@ -3,11 +3,16 @@ import click
 import importlib
 import sys
 import copy
+import time
+import signal
+import tempfile
 import GPUtil
 import logging
 from mlchain import logger
 from mlchain.server import MLServer
-from mlchain.base import ServeModel
+from mlchain.base import ServeModel, ModelRegistry
+from mlchain.base.converter import DEFAULT_OFFLOAD_THRESHOLD
+from mlchain.base.metrics import METRICS_DIR_ENV
 from mlchain.server.authentication import Authentication
 import traceback
 from starlette.middleware.cors import CORSMiddleware
@@ -264,6 +269,64 @@ def run_command(
     # End Get API format and keys
     ############
 
+    ############
+    # Get batch coordinator
+    ############
+    coordinator_config = config.get("batch_coordinator", None) or {}
+    coordinator_enable = coordinator_config.get("enable", False) in [True, 'True', 'true']
+    coordinator_socket = coordinator_config.get("socket", None) or "/tmp/mlchain-batch.sock"
+    coordinator_timeout = coordinator_config.get("timeout", None)
+    if coordinator_timeout in ['None', '']:
+        coordinator_timeout = None
+    if coordinator_timeout is not None:
+        coordinator_timeout = float(coordinator_timeout)
+    coordinator_ready_timeout = coordinator_config.get("ready_timeout", None)
+    if coordinator_ready_timeout in ['None', '']:
+        coordinator_ready_timeout = None
+    elif coordinator_ready_timeout is not None:
+        coordinator_ready_timeout = float(coordinator_ready_timeout)
+    ############
+    # End Get batch coordinator
+    ############
+
+    ############
+    # Get warmup samples
+    ############
+    warmup = config.get("warmup", None) or {}
+    ############
+    # End Get warmup samples
+    ############
+
+    ############
+    # Get request path mode
+    ############
+    lean = mlconfig.get_value(None, config, "lean", False) in [True, 'True', 'true']
+    trace_sample_rate = mlconfig.get_value(None, config, "trace_sample_rate", None)
+    if trace_sample_rate in ['None', '']:
+        trace_sample_rate = None
+    if trace_sample_rate is not None:
+        trace_sample_rate = float(trace_sample_rate)
+    ############
+    # End Get request path mode
+    ############
+
+    ############
+    # Get executor of sync functions
+    ############
+    executor = get_executor_options(config.get("executor", None))
+    offload_threshold = executor.pop("offload_threshold", DEFAULT_OFFLOAD_THRESHOLD)
+    ############
+    # End Get executor of sync functions
+    ############
+
+    ############
+    # Get concurrency limits
+    ############
+    limits = config.get("limits", None) or {}
+    ############
+    # End Get concurrency limits
+    ############
+
     if debug: 
         logger.setLevel(logging.DEBUG)
 
@@ -310,6 +373,70 @@ def run_command(
 
                 self.cfg.set("post_worker_init", post_worker_init)
 
+                if coordinator_enable:
+                    self.cfg.set("on_starting", self.start_coordinator)
+                    self.cfg.set("on_exit", self.stop_coordinator)
+                    self.cfg.set("post_worker_init", self.wait_coordinator)
+
+            def start_coordinator(self, arbiter):
+                import threading
+
+                # One process owns the model and forms batches across all workers
+                self.coordinator_stopping = threading.Event()
+                self.coordinator = self.spawn_coordinator()
+                threading.Thread(target=self.supervise_coordinator, daemon=True).start()
+
+            def spawn_coordinator(self):
+                # A plain fork, the workers forked later must not inherit a multiprocessing child
+                pid = os.fork()
+                if pid == 0:
+                    status = 1
+                    try:
+                        run_coordinator(entry_file, coordinator_socket)
+                        status = 0
+                    except BaseException:
+                        logger.error(traceback.format_exc())
+                    finally:
+                        os._exit(status)
+                self.coordinator_start_time = time.time()
+                return pid
+
+            def supervise_coordinator(self):
+                # Restart the coordinator when it dies, backing off while it keeps crashing at start
+                delay = 1
+                while not self.coordinator_stopping.wait(delay):
+                    if is_running(self.coordinator):
+                        continue
+                    logger.error("Batch coordinator (pid: {0}) exited, restarting it".format(self.coordinator))
+                    if time.time() - self.coordinator_start_time < 60:
+                        delay = min(delay * 2, 60)
+                    else:
+                        delay = 1
+                    self.coordinator = self.spawn_coordinator()
+
+            def stop_coordinator(self, arbiter):
+                stopping = getattr(self, "coordinator_stopping", None)
+                if stopping is not None:
+                    stopping.set()
+                coordinator = getattr(self, "coordinator", None)
+                if coordinator is not None and is_running(coordinator):
+                    os.kill(coordinator, signal.SIGTERM)
+                    deadline = time.time() + 5
+                    while is_running(coordinator) and time.time() < deadline:
+                        time.sleep(0.1)
+                    if is_running(coordinator):
+                        os.kill(coordinator, signal.SIGKILL)
+
+            def wait_coordinator(self, worker):
+                from mlchain.base.gunicorn_config import post_worker_init
+                from mlchain.base.coordinator import wait_for_coordinator
+
+                post_worker_init(worker)
+                # Don't accept requests before the coordinator has loaded the model
+                if not wait_for_coordinator(coordinator_socket, coordinator_ready_timeout, notify=worker.notify):
+                    logger.error("Batch coordinator isn't ready after {0}s, calls fail until it is".format(
+                        coordinator_ready_timeout))
+
             def load(self):
                 original_cuda_variable = os.environ.get("CUDA_VISIBLE_DEVICES")
                 if original_cuda_variable is None:
@@ -318,15 +445,27 @@ def run_command(
                     logger.info(
                         f"Skipping automatic GPU selection for gunicorn worker since CUDA_VISIBLE_DEVICES environment variable is already set to {original_cuda_variable}"
                     )
-                serve_model = get_model(entry_file, serve_model=True)
+                if coordinator_enable:
+                    from mlchain.base.coordinator import COORDINATOR_ENV
+
+                    os.environ[COORDINATOR_ENV] = coordinator_socket
+                serve_model = get_model(entry_file, serve_model=True, warmup=warmup, executor=executor, limits=limits)
 
                 if serve_model is None:
                     raise Exception(
                         f"Can not init model class from {entry_file}. Please check mlconfig.yaml or {entry_file} or mlchain run -m {{mode}}!"
                     )
 
-                if isinstance(serve_model, ServeModel):
-                    if (not self.autofrontend) and model_id is not None:
+                if isinstance(serve_model, (ServeModel, ModelRegistry)):
+                    if coordinator_enable and isinstance(serve_model, ServeModel):
+                        from mlchain.base.coordinator import CoordinatorClient
+
+                        serve_model.use_coordinator(CoordinatorClient(coordinator_socket, timeout=coordinator_timeout))
+                        if not serve_model.proxy:
+                            logger.warning("Each worker loads its own model, build the ServeModel with "
+                                           "model_factory=<model class> to load it only in the batch coordinator")
+
+                    if (not self.autofrontend) and model_id is not None and isinstance(serve_model, ServeModel):
                         from mlchain.server.autofrontend import register_autofrontend
 
                         register_autofrontend(
@@ -349,6 +488,8 @@ def run_command(
                             static_url_path=static_url_path,
                             static_folder=static_folder,
                             template_folder=template_folder,
+                            lean=lean,
+                            trace_sample_rate=trace_sample_rate,
                         )
                         if cors:
                             from flask_cors import CORS
@@ -367,6 +508,9 @@ def run_command(
                             static_url_path=static_url_path,
                             static_folder=static_folder,
                             template_folder=template_folder,
+                            lean=lean,
+                            trace_sample_rate=trace_sample_rate,
+                            offload_threshold=offload_threshold,
                         )
                         if debug:
                             app.app._debug = debug
@@ -417,6 +561,9 @@ def run_command(
                 logger.warning("Using uvicorn.workers.UvicornWorker with Starlette")
                 gunicorn_config["worker_class"] = "uvicorn.workers.UvicornWorker"
 
+        # Each worker builds its own app, they merge their metrics through this directory
+        if METRICS_DIR_ENV not in os.environ:
+            os.environ[METRICS_DIR_ENV] = tempfile.mkdtemp(prefix="mlchain-metrics-")
         GunicornWrapper(server, bind=bind, **gunicorn_config).run()
     elif server == "starlette":
         ############
@@ -424,7 +571,7 @@ def run_command(
         ############
         from mlchain.server.starlette_server import StarletteServer
 
-        app = get_model(entry_file, serve_model=True)
+        app = get_model(entry_file, serve_model=True, warmup=warmup, executor=executor, limits=limits)
 
         if app is None:
             raise Exception(
@@ -442,10 +589,13 @@ def run_command(
             static_url_path=static_url_path,
             static_folder=static_folder,
             template_folder=template_folder,
+            lean=lean,
+            trace_sample_rate=trace_sample_rate,
+            offload_threshold=offload_threshold,
         )
         app.run(host, port, bind=bind, cors=cors, cors_allow_origins=cors_allow_origins, gunicorn=True, debug=debug, model_id=model_id)
 
-    app = get_model(entry_file)
+    app = get_model(entry_file, warmup=warmup, executor=executor, limits=limits)
 
     if app is None:
         raise Exception(
@@ -461,7 +611,7 @@ def run_command(
             app.run(host, port, cors=cors, cors_allow_origins=cors_allow_origins, debug=debug)
         elif app.__class__.__name__ == "GrpcServer":
             app.run(host, port, debug=debug)
-    elif isinstance(app, ServeModel):
+    elif isinstance(app, (ServeModel, ModelRegistry)):
         if server != "starlette":
             server = "flask"
         if server == "flask":
@@ -476,6 +626,8 @@ def run_command(
                 static_url_path=static_url_path,
                 static_folder=static_folder,
                 template_folder=template_folder,
+                lean=lean,
+                trace_sample_rate=trace_sample_rate,
             )
             app.run(
                 host,
@@ -499,6 +651,9 @@ def run_command(
                 static_url_path=static_url_path,
                 static_folder=static_folder,
                 template_folder=template_folder,
+                lean=lean,
+                trace_sample_rate=trace_sample_rate,
+                offload_threshold=offload_threshold,
             )
             app.run(
                 host,
@@ -512,10 +667,90 @@ def run_command(
                 debug=debug
             )
 
-def get_model(module, serve_model=False):
+def is_running(pid):
+    """
+    Whether a child process still runs, the gunicorn arbiter may reap it first
+    """
+    try:
+        wpid, _ = os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        return False
+    return wpid == 0
+
+
+def run_coordinator(entry_file, path):
+    """
+    Load the serve_model from entry_file and serve its batched functions on path
+    """
+    from mlchain.base.coordinator import BatchCoordinator, COORDINATOR_ENV
+
+    # Forked from the gunicorn arbiter, its signal handlers would keep this process from stopping
+    for name in ["SIGTERM", "SIGINT", "SIGQUIT", "SIGHUP", "SIGUSR1", "SIGUSR2", "SIGTTIN", "SIGTTOU",
+                 "SIGWINCH", "SIGCHLD"]:
+        signal.signal(getattr(signal, name), signal.SIG_DFL)
+    # With preload_app the arbiter has imported the worker proxy, the coordinator loads the real model
+    os.environ.pop(COORDINATOR_ENV, None)
+    sys.modules.pop(prepare_import(entry_file), None)
+    serve_model = get_model(entry_file, serve_model=True)
+    if serve_model is None:
+        raise SystemExit(f"Can not init model class from {entry_file} for the batch coordinator")
+    BatchCoordinator(serve_model, path).serve_forever()
+
+
+def get_executor_options(options):
+    """
+    Normalize the executor section of mlconfig.yaml, None values may be written as strings
+    """
+    def normalize(values):
+        values = dict(values or {})
+        for key in ['max_workers', 'max_queue', 'offload_threshold']:
+            if values.get(key) in ['None', 'none', '']:
+                values[key] = None
+            elif values.get(key) is not None:
+                values[key] = int(values[key])
+        return values
+
+    options = normalize(options)
+    options['functions'] = {name: normalize(values)
+                            for name, values in (options.get('functions') or {}).items()}
+    return options
+
+
+def get_limit_options(limits):
+    """
+    Normalize the limits section of mlconfig.yaml, None values may be written as strings
+    """
+    output = {}
+    for function_name, values in limits.items():
+        values = dict(values or {})
+        for key in ['max_concurrency', 'max_queue', 'timeout']:
+            if values.get(key) in ['None', 'none', '']:
+                values[key] = None
+            elif values.get(key) is not None:
+                values[key] = float(values[key]) if key == 'timeout' else int(values[key])
+        output[function_name] = values
+    return output
+
+
+def get_model(module, serve_model=False, warmup=None, executor=None, limits=None):
     """
     Get the serve_model from entry_file
+    :warmup: Dict of function name to a list of sample kwargs, run in background before the model is ready
+    :executor: Options of the executors of sync functions, used if the ServeModel doesn't set its own
+    :limits: Dict of function name to its concurrency limit
     """
+    app = _get_model(module, serve_model=serve_model)
+    model = app.model if isinstance(app, MLServer) else app
+    if warmup and isinstance(model, ServeModel):
+        model.warm_up(warmup, background=True)
+    if executor and isinstance(model, ServeModel) and not model.executor_options:
+        model.use_executor(executor)
+    if limits and isinstance(model, ServeModel):
+        model.use_limits(get_limit_options(limits))
+    return app
+
+
+def _get_model(module, serve_model=False):
     import_name = prepare_import(module)
 
     try:
@@ -533,6 +768,9 @@ def get_model(module, serve_model=False):
         return apps[0]
     if len(serve_models) > 0:
         return serve_models[0]
+    registries = [v for v in module.__dict__.values() if isinstance(v, ModelRegistry)]
+    if len(registries) > 0:
+        return registries[0]
 
     # Could not find model
     logger.debug("Could not find ServeModel")
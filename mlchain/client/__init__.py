@@ -1,6 +1,7 @@
 from mlchain import mlconfig
 from mlchain.base import logger
 from .http_client import HttpClient
+from .ws_client import WebSocketClient
 
 class Client(HttpClient):
     def __init__(self, api_key=None, api_address=None, serializer='json', timeout=5 * 60, headers={},
@@ -193,6 +193,23 @@ class MLClient:
         else: 
             return _call_post()
 
+    def _post_stream(self, function_name, headers=None, args=None, kwargs=None):
+        raise NotImplementedError
+
+    def post_stream(self, function_name, headers=None, args=None, kwargs=None):
+        """
+        Iterate the outputs of a function returning a generator as the server streams them
+        """
+        context = {key: value
+                   for (key, value) in mlchain_context.items() if key.startswith('MLCHAIN_CONTEXT_')}
+        context.update(**self.headers)
+        try:
+            yield from self._post_stream(function_name, context, args, kwargs)
+        except ConnectError:
+            raise MLChainConnectionError(msg="Client call can not connect into Server: {0}. Function: {1}. POST".format(self.api_address, function_name))
+        except (TimeoutError, ReadTimeout, WriteTimeout):
+            raise MLChainTimeoutError(msg="Client call timeout into Server: {0}. Function: {1}. POST".format(self.api_address, function_name))
+
     def _get(self, api_name, headers=None, timeout=None):
         raise NotImplementedError
 
@@ -247,3 +264,9 @@ class BaseFunction:
                         output.get('code', None), output['error']))
 
         return output['output']
+
+    def stream(self, *args, **kwargs):
+        """
+        Iterate the outputs of a generator function while the server produces them
+        """
+        return self.client.post_stream(function_name=self.function_name, args=args, kwargs=kwargs)
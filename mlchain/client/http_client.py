@@ -6,6 +6,9 @@ from mlchain.base.log import except_handler, logger
 from mlchain.server.base import RawResponse, JsonResponse
 from .base import MLClient
 from mlchain.base.exceptions import MlChainError
+from mlchain.base.stream import FrameDecoder, STREAM_CONTENT_TYPE, encode_frames
+from mlchain.server.format import ATTACHMENTS_CONTENT_TYPE, ATTACHMENT_PREFIX
+from mlchain.base.content_encoding import available_encodings, compress, decompress, DEFAULT_MIN_SIZE
 
 HTTP_ERROR_CODE = {
     400: "Bad Request",
@@ -20,10 +23,31 @@ HTTP_ERROR_CODE = {
     511: "Network Authentication Required"
 }
 
+def _is_file(value):
+    return isinstance(value, Path) or callable(getattr(value, 'read', None))
+
+
 class HttpClient(MLClient):
     def __init__(self, api_key=None, api_address=None, serializer='msgpack',
                  image_encoder=None, name=None, version='lastest',
-                 check_status=False, headers=None, **kwargs):
+                 check_status=False, headers=None, multipart=True,
+                 compression=None, compression_min_size=DEFAULT_MIN_SIZE, **kwargs):
+        """
+        :multipart: Send calls as multipart forms, which every server accepts. False sends a single body,
+                    faster but only accepted by servers with single-body calls.
+                    Calls with files or paths are always sent as multipart forms, streamed from disk
+        :compression: Content-Encoding of call bodies (gzip, zstd or lz4), None to send them as is.
+                      Calls are then sent as a single body, whatever multipart
+                      Responses are compressed with any encoding available here, whatever this option
+        :compression_min_size: Min bytes of a compressed call body
+        """
+        self.multipart = multipart
+        if compression is not None and compression not in available_encodings():
+            raise AssertionError("Compression {0} is not available, use one of {1}".format(
+                compression, ', '.join(available_encodings())))
+        self.compression = compression
+        self.compression_min_size = compression_min_size
+        self.accept_encoding = ', '.join(available_encodings())
         MLClient.__init__(self, api_key=api_key, api_address=api_address,
                           serializer=serializer, image_encoder=image_encoder,
                           name=name, version=version,
@@ -120,7 +144,10 @@ class HttpClient(MLClient):
         output_decoded = self.serializer.decode(output.content)
         return output_decoded
 
-    def _post(self, function_name, headers=None, args=None, kwargs=None):
+    def _prepare_files(self, headers, args, kwargs):
+        """
+        Move bytes and files of args and kwargs to multipart files, with the encoded parameters
+        """
         files = []
         args = list(args)
         for idx, value in enumerate(args):
@@ -137,6 +164,11 @@ class HttpClient(MLClient):
                 files.append((file_name, (os.path.basename(value), open(value, 'rb'),
                                           'application/octet-stream')))
                 args[idx] = file_name
+            elif callable(getattr(value, 'read', None)):
+                file_name = '__file__{0}'.format(idx)
+                files.append((file_name, (os.path.basename(str(getattr(value, 'name', file_name))), value,
+                                          'application/octet-stream')))
+                args[idx] = file_name
         for key, value in kwargs.items():
             if isinstance(value, bytes):
                 file_name = '__file__{0}'.format(key)
@@ -151,39 +183,145 @@ class HttpClient(MLClient):
                 files.append((file_name, (os.path.basename(value), open(value, 'rb'),
                                           'application/octet-stream')))
                 kwargs[key] = file_name
+            elif callable(getattr(value, 'read', None)):
+                file_name = '__file__{0}'.format(key)
+                files.append((file_name, (os.path.basename(str(getattr(value, 'name', file_name))), value,
+                                          'application/octet-stream')))
+                kwargs[key] = file_name
+
+        input_encoded = self.serializer.encode((args, kwargs))
+        files.append(("__parameters__", ('parameters', BytesIO(input_encoded),
+                                         'application/octet-stream')))
+        headers['mlchain-serializer'] = self.serializer_type
+        if self.api_key is not None:
+            headers['api-key'] = self.api_key
+        return dict(files)
+
+    def _prepare_body(self, headers, args, kwargs):
+        """
+        Encode args and kwargs as a single body. Msgpack carries bytes as they are,
+        with JSON they are sent after the parameters as length-prefixed attachments
+        """
+        args = list(args)
+        kwargs = dict(kwargs)
+        attachments = []
+        if self.serializer_type == 'json':
+            def attach(value):
+                if isinstance(value, (bytes, bytearray)):
+                    attachments.append(value)
+                    return '{0}{1}'.format(ATTACHMENT_PREFIX, len(attachments) - 1)
+                return value
+            args = [attach(value) for value in args]
+            kwargs = {key: attach(value) for key, value in kwargs.items()}
+        content = self.serializer.encode([args, kwargs])
+        if len(attachments) > 0:
+            content = encode_frames([content] + attachments)
+            headers['Content-Type'] = ATTACHMENTS_CONTENT_TYPE
+        else:
+            headers['Content-Type'] = 'application/{0}'.format(self.serializer_type)
+        headers['mlchain-serializer'] = self.serializer_type
+        if self.api_key is not None:
+            headers['api-key'] = self.api_key
+        return content
+
+    def _prepare_request(self, headers, args, kwargs):
+        """
+        Get the body arguments of httpx for a call, a single body unless it has files
+        """
+        if (self.multipart and self.compression is None) or any(_is_file(value) for value in args) \
+                or any(_is_file(value) for value in kwargs.values()):
+            return {'files': self._prepare_files(headers, args, kwargs)}
+        content = self._prepare_body(headers, args, kwargs)
+        if self.compression is not None and len(content) >= self.compression_min_size:
+            content = compress(content, self.compression)
+            headers['Content-Encoding'] = self.compression
+        return {'content': content}
 
+    def _read_content(self, output):
+        """
+        Get the body of a response, httpx only decodes gzip and deflate by itself
+        """
+        encoding = output.headers.get('Content-Encoding', 'identity').strip().lower()
+        if encoding in ('identity', 'gzip', 'deflate'):
+            return output.content
+        return decompress(output.content, encoding)
+
+    def _raise_for_status(self, output, function_name):
+        if output.status_code == 500:
+            raise MlChainError(msg="Client call into Server {0}. But function {1} raised an error: {2}".format(
+                self.api_address, function_name, self._read_content(output).decode(errors='replace')),
+                status_code=500)
+        error_code = HTTP_ERROR_CODE.get(output.status_code, None)
+        if error_code is not None:
+            raise MlChainError(msg="Client call into Server {0}. But function {1} receive this error code {2}: {3} {4}".format(
+                self.api_address, function_name, output.status_code, error_code,
+                self._read_content(output).decode(errors='replace')), status_code=output.status_code)
+
+    def _decode_stream(self, output, chunks):
+        """
+        Decode the outputs of a streamed response from its chunks of bytes
+        """
+        if output.headers.get('mlchain-serializer') == self.serializer_type:
+            serializer = self.serializer
+        else:
+            serializer = self.json_serializer
+        decoder = FrameDecoder()
+        for chunk in chunks:
+            for payload in decoder.feed(chunk):
+                frame = serializer.decode(payload)
+                if 'error' in frame:
+                    raise MlChainError(msg=frame['error'], code=frame.get('code', 'exception'))
+                yield frame['output']
+        decoder.close()
+
+    def _post_stream(self, function_name, headers=None, args=None, kwargs=None):
+        body = self._prepare_request(headers, args, kwargs)
+        headers['Accept'] = STREAM_CONTENT_TYPE
+        with httpx.Client(timeout=self.timeout, verify=False) as client:
+            with client.stream('POST', "{0}/call/{1}".format(self.api_address, function_name),
+                               headers=headers, **body) as output:
+                if output.status_code != 200:
+                    output.read()
+                    self._raise_for_status(output, function_name)
+                if output.headers.get('response-type') == 'mlchain/stream':
+                    yield from self._decode_stream(output, output.iter_bytes())
+                    return
+                output.read()
+        if 'response-type' in output.headers:
+            if output.headers['response-type'] == 'mlchain/json':
+                yield self.json_serializer.decode(output.content)['output']
+            else:
+                yield output.content
+            return
+        output = self.serializer.decode(output.content)
+        if 'error' in output:
+            raise MlChainError(msg=output['error'], code=output.get('code', 'exception'))
+        yield output['output']
+
+    def _post(self, function_name, headers=None, args=None, kwargs=None):
+        body = self._prepare_request(headers, args, kwargs)
+        headers['Accept-Encoding'] = self.accept_encoding
         with httpx.Client(timeout=self.timeout, verify=False) as client:
-            input_encoded = self.serializer.encode((args, kwargs))
-            files.append(("__parameters__", ('parameters', BytesIO(input_encoded),
-                                             'application/octet-stream')))
-            headers['mlchain-serializer'] = self.serializer_type
-            if self.api_key is not None:
-                headers['api-key'] = self.api_key
-            files = dict(files)
             output = client.post("{0}/call/{1}".format(self.api_address, function_name),
                                  headers=headers,
-                                 files=files)
+                                 **body)
             if output.status_code != 200:
-                if output.status_code == 500:
-                    raise MlChainError(msg="Client call into Server {0}. But function {1} raised an error: {2}".format(
-                        self.api_address, function_name, output.text), status_code=500)
-                else:
-                    error_code = HTTP_ERROR_CODE.get(output.status_code, None)
-                    if error_code is not None:
-                        raise MlChainError(msg="Client call into Server {0}. But function {1} receive this error code {2}: {3} {4}".format(
-                            self.api_address, function_name, output.status_code, error_code, output.text), status_code=output.status_code)
+                self._raise_for_status(output, function_name)
+        content = self._read_content(output)
 
         if 'response-type' in output.headers:
             response_type = output.headers.get('response-type', 'mlchain/raw')
+            if response_type == 'mlchain/stream':
+                return RawResponse(list(self._decode_stream(output, [content])))
             if response_type == 'mlchain/json':
-                return JsonResponse(self.json_serializer.decode(output.content))
-            return RawResponse(output.content)
+                return JsonResponse(self.json_serializer.decode(content))
+            return RawResponse(content)
         if not self.check_response_ok(output):
             if output.status_code == 404:
                 raise Exception("This request url is not found")
             else: 
-                raise Exception("There 's some error when calling, please check: \n HTTP ERROR: {0} \n DETAIL: ".format(output.status_code, output.content))
+                raise Exception("There 's some error when calling, please check: \n HTTP ERROR: {0} \n DETAIL: ".format(output.status_code, content))
 
-            return output.content
+            return content
 
-        return output.content
+        return content
@@ -0,0 +1,126 @@
+import itertools
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from pathlib import Path
+from mlchain.base.log import logger
+from mlchain.base.serializer import MsgpackSerializer
+from mlchain.base.exceptions import MlChainError, MLChainConnectionError, MLChainTimeoutError
+from mlchain.server.base import RawResponse
+from .http_client import HttpClient
+
+
+def _read_file(value):
+    # Files are sent in the message, the socket has no multipart parts
+    if isinstance(value, Path):
+        return value.read_bytes()
+    if callable(getattr(value, 'read', None)):
+        return value.read()
+    return value
+
+
+class WebSocketClient(HttpClient):
+    """
+    Client calling functions through one persistent WebSocket to /ws/call of a StarletteServer.
+    Threads share the socket, their calls run concurrently and are matched to replies by id.
+    Other requests, like description or ping, are sent over HTTP
+    """
+
+    def __init__(self, api_key=None, api_address=None, serializer='msgpack',
+                 image_encoder=None, name=None, version='lastest',
+                 check_status=False, headers=None, **kwargs):
+        HttpClient.__init__(self, api_key=api_key, api_address=api_address, serializer=serializer,
+                            image_encoder=image_encoder, name=name, version=version,
+                            check_status=check_status, headers=headers if headers is not None else {},
+                            **kwargs)
+        self.ws_address = '{0}/ws/call'.format(self.api_address.replace('http', 'ws', 1))
+        self.ws_serializer = MsgpackSerializer()
+        self.connection = None
+        self.pending = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """
+        Open the socket if it isn't open, and get it
+        """
+        with self.lock:
+            if self.connection is not None:
+                return self.connection
+            try:
+                from websockets.sync.client import connect
+            except ImportError:
+                raise ImportError("please install websockets>=11 to use WebSocketClient")
+            headers = {}
+            if self.api_key is not None:
+                headers['api-key'] = self.api_key
+            try:
+                connection = connect(self.ws_address, additional_headers=headers, max_size=None,
+                                     open_timeout=self.timeout)
+            except OSError as ex:
+                raise MLChainConnectionError(msg="Client can not connect into Server: {0}. {1}".format(
+                    self.ws_address, ex))
+            self.connection = connection
+            threading.Thread(target=self._receive, args=(connection,), daemon=True,
+                             name='mlchain-websocket').start()
+            return connection
+
+    def _receive(self, connection):
+        try:
+            for message in connection:
+                reply = self.ws_serializer.decode(message)
+                future = self.pending.pop(reply.get('id'), None)
+                if future is not None:
+                    future.set_result(reply)
+        except Exception as ex:
+            logger.debug("WebSocket {0} closed: {1}".format(self.ws_address, ex))
+        finally:
+            with self.lock:
+                if self.connection is connection:
+                    self.connection = None
+            for call_id in list(self.pending):
+                future = self.pending.pop(call_id, None)
+                if future is not None and not future.done():
+                    future.set_exception(MLChainConnectionError(
+                        msg="Connection to Server {0} was closed".format(self.ws_address)))
+
+    def close(self):
+        with self.lock:
+            connection, self.connection = self.connection, None
+        if connection is not None:
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _post(self, function_name, headers=None, args=None, kwargs=None):
+        args = [_read_file(value) for value in args]
+        kwargs = {key: _read_file(value) for key, value in kwargs.items()}
+        connection = self.connect()
+        call_id = next(self.ids)
+        future = Future()
+        self.pending[call_id] = future
+        message = self.ws_serializer.encode({
+            'id': call_id,
+            'function': function_name,
+            'args': args,
+            'kwargs': kwargs,
+            'headers': headers
+        })
+        try:
+            try:
+                connection.send(message)
+            except Exception as ex:
+                raise MLChainConnectionError(msg="Client can not send to Server: {0}. Function: {1}. {2}".format(
+                    self.ws_address, function_name, ex))
+            reply = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise MLChainTimeoutError(msg="Client call timeout into Server: {0}. Function: {1}. WebSocket".format(
+                self.ws_address, function_name))
+        finally:
+            self.pending.pop(call_id, None)
+        if 'error' in reply:
+            raise MlChainError(msg=reply['error'], code=reply.get('code', 'exception'))
+        return RawResponse(reply['output'])
@@ -4,8 +4,10 @@ Borrowed a little from: https://github.com/tomwojcik/starlette-context. Thanks f
 """
 import contextvars
 import copy
+import time
 
 from collections import UserDict
+from contextlib import contextmanager
 from contextvars import copy_context
 from typing import Any
 from mlchain import _request_scope_context_storage
@@ -61,4 +63,28 @@ class MLChainContext(UserDict):
         self.update({"MLCHAIN_CONTEXT_ID": value})
         return value
 
+    def add_timing(self, name: str, seconds: float):
+        """
+        Add a span to the Server-Timing of the current call
+        """
+        self.data.setdefault('MLCHAIN_TIMINGS', []).append((name, seconds))
+
+    def pop_timings(self) -> list:
+        """
+        Get and clear the spans added to the current call, as a list of (name, seconds)
+        """
+        return self.data.pop('MLCHAIN_TIMINGS', None) or []
+
+    @contextmanager
+    def timer(self, name: str):
+        """
+        Time a block of model code as a span of the Server-Timing of the current call.
+        Spans of the same name in a call are summed
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing(name, time.perf_counter() - start)
+
 mlchain_context = MLChainContext()
\ No newline at end of file
@@ -1,16 +1,36 @@
 import os
+import asyncio
+import inspect
 import importlib
+from functools import partial
 import warnings
-from inspect import signature, _empty
 from collections import defaultdict
-from thefuzz.fuzz import ratio
 from mlchain.base import ServeModel
+from mlchain.base.call_plan import CallPlan
+from mlchain.base.registry import ModelRegistry
 from mlchain.base.log import logger
 from mlchain.base.serializer import JsonSerializer, MsgpackSerializer, MsgpackBloscSerializer
 from mlchain.base.converter import Converter, AsyncConverter
+from mlchain.base.content_encoding import Compression
+from .tracing import RequestTracer
+from .metrics import ServerMetrics
+from .profiler import SamplingProfiler
+from mlchain.base.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
 from mlchain.base.exceptions import MLChainAssertionError
 import numpy as np 
-from mlchain import mlchain_context
+from mlchain import mlchain_context, mlconfig
+
+def get_query_params(action):
+    """
+    Get the names of the parameters of an endpoint action, which a GET request can pass in its query string
+    """
+    try:
+        parameters = inspect.signature(action).parameters
+    except (TypeError, ValueError):
+        return set()
+    return {name for name, parameter in parameters.items()
+            if name != 'serializer' and parameter.kind in (parameter.POSITIONAL_OR_KEYWORD, parameter.KEYWORD_ONLY)}
+
 
 class MLChainResponse:
     '''
@@ -54,6 +74,19 @@ class FileResponse(MLChainResponse):
         self.headers = headers
 
 
+class StreamResponse(MLChainResponse):
+    """
+    Output of a generator function, each chunk is encoded while it is produced
+    :chunks: Iterator or async iterator of encoded bytes
+    """
+    def __init__(self, chunks, content_type, headers=None):
+        self.chunks = chunks
+        self.content_type = content_type
+        if headers is None:
+            headers = {}
+        self.headers = headers
+
+
 class TemplateResponse(MLChainResponse):
     def __init__(self, template_name, **context):
         self.template_name = template_name
@@ -64,14 +97,35 @@ class MLServer:
     convert_dict = defaultdict(dict)
     file_converters = {}
 
-    def __init__(self, model: ServeModel, name=None, version=None, api_format=None, authentication=None):
-        if not isinstance(model, ServeModel):
+    def __init__(self, model: ServeModel, name=None, version=None, api_format=None, authentication=None,
+                 models: ModelRegistry = None, compression=None, lean=False, trace_sample_rate=None):
+        if isinstance(model, ModelRegistry):
+            model, models = None, model
+        elif not isinstance(model, ServeModel):
             model = ServeModel(model)
         self.model = model
-        self.name = name or model.name
+        self.models = models
+        self.name = name or (model.name if model is not None else models.name)
         self.version = version
         self.api_format = api_format
         self.authentication = authentication
+        if compression is None:
+            # Off unless configured, most clients accept gzip and would get every response compressed
+            compression = mlconfig.compression
+            if isinstance(compression, str):
+                compression = compression.strip().lower() in ('true', '1')
+        # Bodies are decompressed unless compression is disabled explicitly
+        self.decompress_requests = compression is not False
+        if compression is True:
+            compression = Compression()
+        elif isinstance(compression, dict):
+            compression = Compression(**compression)
+        elif not isinstance(compression, Compression):
+            compression = None
+        self.compression = compression
+        self.tracer = RequestTracer(lean=lean, sample_rate=trace_sample_rate)
+        self.metrics = ServerMetrics(self)
+        self.profiler = SamplingProfiler()
 
         self.serializers_dict = {
             'application/json': JsonSerializer(),
@@ -93,6 +147,41 @@ class MLServer:
         """
         return "pong"
 
+    def _get_metrics(self):
+        """
+        Get the metrics of the server in the Prometheus text format
+        """
+        return RawResponse(self.metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+    def _profile(self, seconds=10, format='collapsed', rate=None):
+        """
+        Sample the stacks of all threads of the worker answering, while it keeps serving
+        :seconds: Duration of the profile
+        :format: collapsed stacks as text, or speedscope JSON
+        :rate: Samples per second
+        """
+        output = self.profiler.profile(seconds, rate, format)
+        if format == 'speedscope':
+            return JsonResponse(output)
+        return RawResponse(output, content_type='text/plain; charset=utf-8')
+
+    def get_body_limit(self, path):
+        """
+        Get the max content length of the function called at path, None if it has none
+        """
+        parts = path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] in ('call', 'call_raw'):
+            model, function_name = self.model, parts[1]
+        elif len(parts) == 4 and parts[0] == 'models' and parts[2] in ('call', 'call_raw') \
+                and self.models is not None:
+            hosted = self.models.models.get(parts[1])
+            model, function_name = (hosted.serve_model if hosted is not None else None), parts[3]
+        else:
+            return None
+        if model is None:
+            return None
+        return model.max_content_lengths.get(function_name)
+
     def _add_endpoint(self, endpoint=None, endpoint_name=None,
                       handler=None, methods=['GET', 'POST']):
         """
@@ -114,20 +203,41 @@ class MLServer:
         """
         Add Swagger to URL
         """
-        if not self._swaggered:
+        if not self._swaggered and self.model is not None:
             self._register_swagger()
         self._swaggered = True
 
     def add_endpoint(self, endpoint=None, endpoint_name=None,
-                      handler=None, methods=['GET', 'POST']):
+                      handler=None, methods=['GET', 'POST'], api_keys=None):
         """
         Add one endpoint to the flask application. Accept GET, POST and PUT.
         :param endpoint: Callable URL.
         :param endpoint_name: Name of the Endpoint
         :param handler: function to execute on call on the URL
+        :param api_keys: List of keys, one of them must be in the x-api-key header
         :return: Nothing
         """
-        return self._add_endpoint(endpoint=endpoint, endpoint_name=endpoint_name, handler=handler, methods=methods)
+        if api_keys is None:
+            return self._add_endpoint(endpoint=endpoint, endpoint_name=endpoint_name, handler=handler, methods=methods)
+        return self._add_endpoint(endpoint=endpoint, endpoint_name=endpoint_name, handler=handler, methods=methods,
+                                  api_keys=api_keys)
+
+    def get_admin_keys(self):
+        """
+        Get keys of the admin APIs from ADMIN_KEYS (separated by ;), None disables the admin APIs
+        """
+        admin_keys = mlconfig.admin_keys
+        if isinstance(admin_keys, str):
+            admin_keys = [key for key in admin_keys.split(';') if len(key) > 0]
+        if not admin_keys:
+            return None
+        return list(admin_keys)
+
+    def _swap_model(self, serializer=None):
+        """
+        Load a new model instance with the model_factory, warm it up and switch to it
+        """
+        return self.model.swap_model()
 
     def _initialize_app(self):
         """
@@ -154,9 +264,9 @@ class MLServer:
         """
         return self._initialize_app()
 
-    def initialize_endpoint(self): 
+    def _add_model_endpoints(self):
         """
-        Initialize Server Endpoint
+        Add the endpoints of the served model
         """
         self.add_endpoint('/api/get_params/<function_name>',
                            '_get_parameters_of_func',
@@ -164,9 +274,24 @@ class MLServer:
         self.add_endpoint('/api/des_func/<function_name>',
                            '_get_description_of_func',
                            handler=self.model._get_description_of_func, methods=['GET'])
-        self.add_endpoint('/api/ping',
-                           '_check_status',
-                           handler=self._check_status, methods=['GET'])
+        self.add_endpoint('/api/ready',
+                           '_check_ready',
+                           handler=self.model._check_ready, methods=['GET'])
+        self.add_endpoint('/api/batch_status',
+                           '_get_batch_status',
+                           handler=self.model._get_batch_status, methods=['GET'])
+        self.add_endpoint('/api/replicas',
+                           '_get_replica_status',
+                           handler=self.model._get_replica_status, methods=['GET'])
+        self.add_endpoint('/api/cache_status',
+                           '_get_cache_status',
+                           handler=self.model._get_cache_status, methods=['GET'])
+        self.add_endpoint('/api/limits',
+                           '_get_limit_status',
+                           handler=self.model._get_limit_status, methods=['GET'])
+        self.add_endpoint('/api/executors',
+                           '_get_executor_status',
+                           handler=self.model._get_executor_status, methods=['GET'])
         self.add_endpoint('/api/description',
                            '_get_all_description',
                            handler=self.model._get_all_description, methods=['GET'])
@@ -177,7 +302,33 @@ class MLServer:
                            '_list_all_function_and_description',
                            handler=self.model._list_all_function_and_description, methods=['GET'])
 
-        
+    def initialize_endpoint(self): 
+        """
+        Initialize Server Endpoint
+        """
+        self.add_endpoint('/api/ping',
+                           '_check_status',
+                           handler=self._check_status, methods=['GET'])
+        self.add_endpoint('/api/metrics',
+                           '_get_metrics',
+                           handler=self._get_metrics, methods=['GET'])
+        if self.models is not None:
+            self.add_endpoint('/api/models',
+                               '_get_models_status',
+                               handler=self.models.status, methods=['GET'])
+        if self.model is not None:
+            self._add_model_endpoints()
+
+        admin_keys = self.get_admin_keys()
+        if admin_keys is not None and self.model is not None:
+            self.add_endpoint('/api/admin/swap_model',
+                               '_swap_model',
+                               handler=self._swap_model, methods=['POST'], api_keys=admin_keys)
+        if admin_keys is not None:
+            self.add_endpoint('/api/admin/profile',
+                               '_profile',
+                               handler=self._profile, methods=['GET'], api_keys=admin_keys)
+
         self._register_home()
 
         try:
@@ -193,99 +344,48 @@ class MLServer:
         """
         return self.converter.convert(value, out_type)
 
+    def bind(self, plan, args, kwargs):
+        """
+        Bind request values to a function by running its CallPlan
+        :plan: CallPlan from ServeModel.get_call_plan
+        """
+        return plan.bind(args, kwargs, self.converter)
+
     def _normalize_kwargs_to_valid_format(self, kwargs, func_):
         """
         Normalize data into right formats of func_
         """
-        inspect_func_ = signature(func_)
-
-        accept_kwargs = "**" in str(inspect_func_)
-
-        # Check valid parameters
-        for key, value in list(kwargs.items()):
-            mlchain_context['CONVERT_VARIABLE'] = key
-            if key in inspect_func_.parameters:
-                req_type = inspect_func_.parameters[key].annotation
-                the_default = inspect_func_.parameters[key].default
-
-                if type(value) != req_type: 
-                    eq = value == the_default
-                    
-                    if isinstance(eq, np.ndarray): 
-                        if not np.all(eq): 
-                            kwargs[key] = self.convert(value, req_type)
-                    elif not eq: 
-                        kwargs[key] = self.convert(value, req_type)
-            elif not accept_kwargs:
-                suggest = None
-                fuzz = 0
-                for k in inspect_func_.parameters:
-                    if suggest is None:
-                        suggest = k
-                        fuzz = ratio(k.lower(), key.lower())
-                    elif ratio(k.lower(), key.lower()) > fuzz:
-                        suggest = k
-                        fuzz = ratio(k.lower(), key.lower())
-                kwargs.pop(key)
-
-        missing = []
-        for key, parameter in inspect_func_.parameters.items():
-            if key not in kwargs and parameter.default == _empty:
-                missing.append(key)
-        if len(missing) > 0:
-            raise MLChainAssertionError("Missing params {0}".format(missing))
-        return kwargs
+        return CallPlan(None, func_).bind((), kwargs, self.converter)
 
     def get_kwargs(self, func, *args, **kwargs):
-        sig = signature(func)
-        parameters = sig.parameters
-
-        kwgs = {}
-        for key, value in zip(parameters.keys(), args):
-            kwgs[key] = value
-        kwgs.update(kwargs)
-        return kwgs
+        return CallPlan(None, func).get_kwargs(args, kwargs)
 
 class AsyncMLServer(MLServer):
+    async def _swap_model(self, serializer=None):
+        """
+        Load a new model instance with the model_factory, warm it up and switch to it
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.model.swap_model)
+
+    async def _profile(self, seconds=10, format='collapsed', rate=None):
+        """
+        Sample the stacks of all threads of the worker answering, in a thread so the event loop keeps serving
+        :seconds: Duration of the profile
+        :format: collapsed stacks as text, or speedscope JSON
+        :rate: Samples per second
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            None, partial(MLServer._profile, self, seconds, format, rate))
+
+    async def bind(self, plan, args, kwargs):
+        """
+        Bind request values to a function by running its CallPlan
+        :plan: CallPlan from ServeModel.get_call_plan
+        """
+        return await plan.bind_async(args, kwargs, self.converter)
+
     async def _normalize_kwargs_to_valid_format(self, kwargs, func_):
         """
         Normalize data into right formats of func_
         """
-        inspect_func_ = signature(func_)
-
-        accept_kwargs = "**" in str(inspect_func_)
-
-        # Check valid parameters
-        for key, value in list(kwargs.items()):
-            mlchain_context['CONVERT_VARIABLE'] = key
-            if key in inspect_func_.parameters:
-                req_type = inspect_func_.parameters[key].annotation
-                the_default = inspect_func_.parameters[key].default
-
-                if type(value) != req_type: 
-                    eq = value == the_default
-                    
-                    if isinstance(eq, np.ndarray): 
-                        if not np.all(eq): 
-                            kwargs[key] = await self.convert(value, req_type)
-                    elif not eq: 
-                        kwargs[key] = await self.convert(value, req_type)
-            elif not accept_kwargs:
-                suggest = None
-                fuzz = 0
-                for k in inspect_func_.parameters:
-                    if suggest is None:
-                        suggest = k
-                        fuzz = ratio(k.lower(), key.lower())
-                    elif ratio(k.lower(), key.lower()) > fuzz:
-                        suggest = k
-                        fuzz = ratio(k.lower(), key.lower())
-                kwargs.pop(key)
-
-        missing = []
-        for key, parameter in inspect_func_.parameters.items():
-            if key not in kwargs and parameter.default == _empty:
-                missing.append(key)
-        if len(missing) > 0:
-            raise MLChainAssertionError("Missing params {0}".format(missing))
-        return kwargs
\ No newline at end of file
+        return await CallPlan(None, func_).bind_async((), kwargs, self.converter)
@@ -1,26 +1,31 @@
 import os
 import time
+import asyncio
+import inspect
 import json
 import re
 from typing import Union
 from werkzeug.datastructures import FileStorage
 from werkzeug.exceptions import RequestEntityTooLarge
-from flask import Flask, request, jsonify, Response, send_file, render_template, Blueprint, send_from_directory
+from flask import Flask, Request, request, jsonify, Response, send_file, render_template, Blueprint, send_from_directory, \
+    stream_with_context
 from flask_cors import CORS
 import mlchain
 from mlchain.base.serve_model import ServeModel
+from mlchain.base.registry import ModelRegistry
 from mlchain.base.wrapper import GunicornWrapper
 from mlchain.base.log import logger, format_exc
 from mlchain.base.exceptions import MlChainError
+from mlchain.base.uploads import spool_file, spool_body
+from mlchain.base.content_encoding import StreamDecompressor, CHUNK_SIZE, get_max_size, error_body
 from .swagger import SwaggerTemplate
 from .autofrontend import register_autofrontend
-from .base import MLServer, Converter, RawResponse, FileResponse, TemplateResponse
+from .tracing import RequestTracer
+from .base import MLServer, Converter, RawResponse, FileResponse, TemplateResponse, StreamResponse, \
+    get_query_params
 from .format import RawFormat
 from .view import View
 from mlchain import mlchain_context
-from sentry_sdk import push_scope, start_transaction
-from mlchain import mlconfig
-from uuid import uuid4
 
 APP_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 TEMPLATE_PATH = os.path.join(APP_PATH, 'server/templates')
@@ -32,7 +37,7 @@ class FlaskEndpointAction:
     Defines an Flask Endpoint for a specific action for any client.
     """
 
-    def __init__(self, action, serializers_dict, version='latest', api_keys=None):
+    def __init__(self, action, serializers_dict, version='latest', api_keys=None, tracer=None):
         """
         Create the endpoint by specifying which action we want the endpoint to perform, at each call
         :param action: The function to execute on endpoint call
@@ -47,6 +52,8 @@ class FlaskEndpointAction:
         self.msgpack_serializer = self.serializers_dict['application/msgpack']
         self.msgpack_blosc_serializer = self.serializers_dict['application/msgpack_blosc']
         self.api_keys = api_keys
+        self.tracer = tracer or RequestTracer()
+        self.query_params = get_query_params(action)
 
     def __get_json_response(self, output, status=200):
         """
@@ -73,7 +80,7 @@ class FlaskEndpointAction:
                         status=status)
 
     def init_context(self): 
-        uid = str(uuid4())
+        uid = self.tracer.new_request_id()
         mlchain_context['MLCHAIN_CONTEXT_ID'] = uid
         return uid 
 
@@ -86,121 +93,189 @@ class FlaskEndpointAction:
         """
         start_time = time.time()
 
-        with push_scope() as sentry_scope:
-            transaction_name = "{0}  ||  {1}".format(mlconfig.MLCHAIN_SERVER_NAME, self.action.__name__)
-            sentry_scope.transaction = transaction_name
-            
-            with start_transaction(op="task", name=transaction_name):
-                uid = self.init_context()
+        with self.tracer.trace(self.action.__name__):
+            uid = self.init_context()
 
-                # If data POST is in msgpack format
-                serializer = self.serializers_dict.get(
-                    request.content_type,
-                    self.serializers_dict[request.headers.get('serializer', 'application/json')]
-                )
-                if request.content_type == 'application/msgpack':
-                    response_function = self.__get_msgpack_response
-                elif request.content_type == 'application/msgpack_blosc':
-                    response_function = self.__get_msgpack_blosc_response
-                else:
-                    response_function = self.__get_json_response
-                if request.method == 'POST' and self.api_keys is not None or (
-                        isinstance(self.api_keys, (list, dict)) and len(self.api_keys) > 0):
-                    authorized = False
-                    has_key = False
-                    for key in ['x-api-key', 'apikey', 'apiKey', 'api-key']:
-                        apikey = request.headers.get(key, '')
-                        if apikey != '':
-                            has_key = True
-                        if apikey in self.api_keys:
-                            authorized = True
-                            break
-                    if not authorized:
-                        if has_key:
-                            error = 'Unauthorized. Api-key incorrect.'
-                        else:
-                            error = 'Unauthorized. Lack of x-api-key or apikey or api-key in headers.'
-                        output = {
-                            'error': error,
-                            'api_version': self.version,
-                            'mlchain_version': mlchain.__version__,
-                            "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
-                        }
-                        return response_function(output, 401)
-                try:
-                    # Perform the action
-                    if request.method == 'POST':
-                        output = self.action(*args, **kwargs, serializer=serializer)
+            # If data POST is in msgpack format
+            serializer = self.serializers_dict.get(
+                request.content_type,
+                self.serializers_dict[request.headers.get('serializer', 'application/json')]
+            )
+            if request.content_type == 'application/msgpack':
+                response_function = self.__get_msgpack_response
+            elif request.content_type == 'application/msgpack_blosc':
+                response_function = self.__get_msgpack_blosc_response
+            else:
+                response_function = self.__get_json_response
+            if request.method == 'POST' and self.api_keys is not None or (
+                    isinstance(self.api_keys, (list, dict)) and len(self.api_keys) > 0):
+                authorized = False
+                has_key = False
+                for key in ['x-api-key', 'apikey', 'apiKey', 'api-key']:
+                    apikey = request.headers.get(key, '')
+                    if apikey != '':
+                        has_key = True
+                    if apikey in self.api_keys:
+                        authorized = True
+                        break
+                if not authorized:
+                    if has_key:
+                        error = 'Unauthorized. Api-key incorrect.'
                     else:
-                        output = self.action(*args, **kwargs)
-                    if isinstance(output, RawResponse):
-                        output = Response(output.response, status=output.status,
-                                        headers=output.headers,
-                                        mimetype=output.mimetype,
-                                        content_type=output.content_type)
-                        output.headers['mlchain_version'] = mlchain.__version__
-                        output.headers['api_version'] = self.version
-                        output.headers['request_id'] = mlchain_context.MLCHAIN_CONTEXT_ID
-                        return output
-                    if isinstance(output, FileResponse):
-                        file = send_file(output.path, mimetype=output.mimetype)
-                        for k, v in output.headers.items():
-                            file.headers[k] = v
-                        file.headers['mlchain_version'] = mlchain.__version__
-                        file.headers['api_version'] = self.version
-                        file.headers['request_id'] = mlchain_context.MLCHAIN_CONTEXT_ID
-                        return file
-                    if isinstance(output, Response):
-                        return output
-
+                        error = 'Unauthorized. Lack of x-api-key or apikey or api-key in headers.'
                     output = {
-                        'output': output,
-                        'time': round(time.time() - start_time, 2),
+                        'error': error,
                         'api_version': self.version,
                         'mlchain_version': mlchain.__version__,
                         "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
                     }
-                    return response_function(output, 200)
-                except MlChainError as ex:
-                    err = ex.msg
+                    return response_function(output, 401)
+            try:
+                # Perform the action
+                if request.method == 'POST':
+                    output = self.action(*args, **kwargs, serializer=serializer)
+                else:
+                    for name in self.query_params.intersection(request.args.keys()).difference(kwargs):
+                        kwargs[name] = request.args.get(name)
+                    output = self.action(*args, **kwargs)
+                if isinstance(output, RawResponse):
+                    output = Response(output.response, status=output.status,
+                                    headers=output.headers,
+                                    mimetype=output.mimetype,
+                                    content_type=output.content_type)
+                    output.headers['mlchain_version'] = mlchain.__version__
+                    output.headers['api_version'] = self.version
+                    output.headers['request_id'] = mlchain_context.MLCHAIN_CONTEXT_ID
+                    return output
+                if isinstance(output, FileResponse):
+                    file = send_file(output.path, mimetype=output.mimetype)
+                    for k, v in output.headers.items():
+                        file.headers[k] = v
+                    file.headers['mlchain_version'] = mlchain.__version__
+                    file.headers['api_version'] = self.version
+                    file.headers['request_id'] = mlchain_context.MLCHAIN_CONTEXT_ID
+                    return file
+                if isinstance(output, Response):
+                    return output
+
+                output = {
+                    'output': output,
+                    'time': round(time.time() - start_time, 2),
+                    'api_version': self.version,
+                    'mlchain_version': mlchain.__version__,
+                    "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
+                }
+                return response_function(output, 200)
+            except MlChainError as ex:
+                err = ex.msg
+
+                output = {
+                    'error': err,
+                    'time': round(time.time() - start_time, 2),
+                    'code': ex.code,
+                    'api_version': self.version,
+                    'mlchain_version': mlchain.__version__,
+                    "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
+                }
+                return response_function(output, ex.status_code)
+            except AssertionError as ex:
+                err = str(ex)
+
+                output = {
+                    'error': err,
+                    'time': round(time.time() - start_time, 2),
+                    'api_version': self.version,
+                    'mlchain_version': mlchain.__version__,
+                    "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
+                }
+                return response_function(output, 422)
+            except Exception:
+                err = format_exc(name='mlchain.serve.server', return_str=False)
+
+                output = {
+                    'error': err,
+                    'time': round(time.time() - start_time, 2),
+                    'api_version': self.version,
+                    'mlchain_version': mlchain.__version__,
+                    "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
+                }
+                return response_function(output, 500)
+
+
+class SpoolingRequest(Request):
+    """
+    Request parsing large uploads into named temporary files, so they can be given to functions by path
+    """
 
-                    output = {
-                        'error': err,
-                        'time': round(time.time() - start_time, 2),
-                        'code': ex.code,
-                        'api_version': self.version,
-                        'mlchain_version': mlchain.__version__,
-                        "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
-                    }
-                    return response_function(output, ex.status_code)
-                except AssertionError as ex:
-                    err = str(ex)
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return spool_file(total_content_length)
 
-                    output = {
-                        'error': err,
-                        'time': round(time.time() - start_time, 2),
-                        'api_version': self.version,
-                        'mlchain_version': mlchain.__version__,
-                        "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
-                    }
-                    return response_function(output, 422)
-                except Exception:
-                    err = format_exc(name='mlchain.serve.server', return_str=False)
 
-                    output = {
-                        'error': err,
-                        'time': round(time.time() - start_time, 2),
-                        'api_version': self.version,
-                        'mlchain_version': mlchain.__version__,
-                        "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
-                    }
-                    return response_function(output, 500)
+class DecompressionMiddleware:
+    """
+    WSGI middleware decompressing request bodies sent with a Content-Encoding, chunk by chunk
+    into a spooled temporary file
+    :max_size: Max bytes of a decompressed body, larger requests get 413
+    :get_limit: Callable giving the max content length of the function called at a path, or None
+    """
+
+    def __init__(self, wsgi_app, max_size=None, get_limit=None):
+        self.wsgi_app = wsgi_app
+        self.max_size = max_size
+        self.get_limit = get_limit
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING')
+        if encoding is None or encoding.strip().lower() == 'identity':
+            return self.wsgi_app(environ, start_response)
+        limit = self.get_limit(environ.get('PATH_INFO', '')) if self.get_limit is not None else None
+        body = spool_body()
+        try:
+            decompressor = StreamDecompressor(encoding, body, get_max_size(self.max_size, limit))
+            remaining = int(environ.get('CONTENT_LENGTH') or -1)
+            stream = environ['wsgi.input']
+            while remaining != 0:
+                chunk = stream.read(CHUNK_SIZE if remaining < 0 else min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if remaining > 0:
+                    remaining -= len(chunk)
+                decompressor.write(chunk)
+            decompressor.close()
+        except MlChainError as ex:
+            body.close()
+            response = Response(error_body(ex), status=ex.status_code, mimetype='application/json')
+            return response(environ, start_response)
+        body.seek(0)
+        environ['wsgi.input'] = body
+        environ['CONTENT_LENGTH'] = str(decompressor.size)
+        del environ['HTTP_CONTENT_ENCODING']
+        return self.wsgi_app(environ, start_response)
+
+
+def _iterate_async(chunks):
+    """
+    Iterate an async generator from a WSGI worker thread
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(chunks.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(chunks.aclose())
+        loop.close()
 
 
 class FlaskView(View):
     def __init__(self, server, formatter=None, authentication=None):
         View.__init__(self, server, formatter, authentication)
 
+    def get_content_length(self):
+        return request.headers.get('Content-Length')
+
     def parse_data(self):
         try:
             headers = request.headers
@@ -234,6 +309,17 @@ class FlaskView(View):
             file.headers['request_id'] = mlchain_context.MLCHAIN_CONTEXT_ID
             return file
 
+        if isinstance(response, StreamResponse):
+            chunks = response.chunks
+            if inspect.isasyncgen(chunks):
+                chunks = _iterate_async(chunks)
+            output = Response(stream_with_context(chunks), headers=response.headers,
+                              content_type=response.content_type)
+            output.headers['mlchain_version'] = mlchain.__version__
+            output.headers['api_version'] = self.server.version
+            output.headers['request_id'] = mlchain_context.MLCHAIN_CONTEXT_ID
+            return output
+
         if isinstance(response, TemplateResponse):
             return render_template(response.template_name, **response.context)
 
@@ -245,8 +331,17 @@ class FlaskView(View):
 class FlaskServer(MLServer):
     def __init__(self, model: ServeModel, name=None, version='0.0',
                  authentication=None, api_format=None,
-                 static_folder=None, template_folder=None, static_url_path:str="static"):
-        MLServer.__init__(self, model, name, version, api_format, authentication)
+                 static_folder=None, template_folder=None, static_url_path:str="static",
+                 models: ModelRegistry = None, compression=None, lean=False, trace_sample_rate=None):
+        """
+        :compression: True or the options (min_size, encodings) of the response compression, None reads
+                      the compression config and is off by default. False also disables the decompression of requests
+        :lean: Lean request path, with sampled tracing, counter request ids and only the mlchain-context-*
+               headers in the context
+        :trace_sample_rate: Fraction of the requests traced in lean mode, default is the Sentry traces_sample_rate
+        """
+        MLServer.__init__(self, model, name, version, api_format, authentication, models=models,
+                          compression=compression, lean=lean, trace_sample_rate=trace_sample_rate)
 
         if not isinstance(static_url_path, str): 
             static_url_path = "static"
@@ -256,6 +351,11 @@ class FlaskServer(MLServer):
 
         self.app.url_map.strict_slashes = False
         self.app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024
+        self.app.request_class = SpoolingRequest
+        if self.decompress_requests:
+            self.app.wsgi_app = DecompressionMiddleware(self.app.wsgi_app,
+                                                        max_size=self.app.config['MAX_CONTENT_LENGTH'],
+                                                        get_limit=self.get_body_limit)
         self.app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
 
         self.converter = Converter(FileStorage, self._get_file_name, self._get_data)
@@ -266,6 +366,13 @@ class FlaskServer(MLServer):
         self.app.add_url_rule('/call_raw/<function_name>', 'call_raw',
                               FlaskView(self, RawFormat(), self.authentication),
                               methods=['POST', 'GET'], strict_slashes=False)
+        if self.models is not None:
+            self.app.add_url_rule('/models/<model_name>/call/<function_name>', 'models_call',
+                                  FlaskView(self, self.api_format_class, self.authentication),
+                                  methods=['POST', 'GET'], strict_slashes=False)
+            self.app.add_url_rule('/models/<model_name>/call_raw/<function_name>', 'models_call_raw',
+                                  FlaskView(self, RawFormat(), self.authentication),
+                                  methods=['POST', 'GET'], strict_slashes=False)
         
         self.initialize_endpoint()
 
@@ -276,19 +383,21 @@ class FlaskServer(MLServer):
         return storage.read()
 
     def _add_endpoint(self, endpoint=None, endpoint_name=None,
-                      handler=None, methods=['GET', 'POST']):
+                      handler=None, methods=['GET', 'POST'], api_keys=None):
         """
         Add one endpoint to the flask application. Accept GET, POST and PUT.
         :param endpoint: Callable URL.
         :param endpoint_name: Name of the Endpoint
         :param handler: function to execute on call on the URL
+        :param api_keys: List of keys, one of them must be in the x-api-key header
         :return: Nothing
         """
         self.app.add_url_rule(endpoint, endpoint_name,
                               FlaskEndpointAction(handler,
                                                   self.serializers_dict,
                                                   version=self.version,
-                                                  api_keys=None),
+                                                  api_keys=api_keys,
+                                                  tracer=self.tracer),
                               methods=methods)
 
     def _register_swagger(self):
@@ -307,6 +416,14 @@ class FlaskServer(MLServer):
         swagger_template.add_core_endpoint(self.model._get_parameters_of_func, '/api/get_params/{function_name}', tags=["MlChain Core APIs"])
         swagger_template.add_core_endpoint(self.model._get_description_of_func, '/api/des_func/{function_name}', tags=["MlChain Core APIs"])
         swagger_template.add_core_endpoint(self._check_status, '/api/ping', tags=["MlChain Core APIs"])
+        swagger_template.add_core_endpoint(self.model._check_ready, '/api/ready', tags=["MlChain Core APIs"])
+        swagger_template.add_core_endpoint(self.model._get_batch_status, '/api/batch_status', tags=["MlChain Core APIs"])
+        swagger_template.add_core_endpoint(self.model._get_replica_status, '/api/replicas', tags=["MlChain Core APIs"])
+        swagger_template.add_core_endpoint(self.model._get_cache_status, '/api/cache_status', tags=["MlChain Core APIs"])
+        swagger_template.add_core_endpoint(self.model._get_limit_status, '/api/limits', tags=["MlChain Core APIs"])
+        swagger_template.add_core_endpoint(self.model._get_executor_status, '/api/executors', tags=["MlChain Core APIs"])
+        if self.models is not None:
+            swagger_template.add_core_endpoint(self.models.status, '/api/models', tags=["MlChain Core APIs"])
         swagger_template.add_core_endpoint(self.model._get_all_description, '/api/description', tags=["MlChain Core APIs"])
         swagger_template.add_core_endpoint(self.model._list_all_function, '/api/list_all_function', tags=["MlChain Core APIs"])
         swagger_template.add_core_endpoint(self.model._list_all_function_and_description, '/api/list_all_function_and_description', tags=["MlChain Core APIs"])
@@ -434,6 +551,8 @@ class FlaskServer(MLServer):
             logger.info("Debug = {}".format(debug))
             logger.info("-" * 80)
 
+            # Workers are forked after the app is built, they merge their metrics through a directory
+            self.metrics.share()
             loglevel = kwargs.get('loglevel', 'warning' if debug else 'info')
             
             GunicornWrapper(self.app, bind=bind, workers=workers, timeout=timeout,
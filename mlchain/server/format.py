@@ -1,9 +1,13 @@
 from typing import List, Tuple, Dict
+import asyncio
 import traceback
 from mlchain import logger, __version__
 from mlchain.base.log import sentry_ignore_logger
 from mlchain.base.serializer import JsonSerializer, MsgpackSerializer, MsgpackBloscSerializer
 from mlchain.base.exceptions import MLChainSerializationError, MlChainError
+from mlchain.base.uploads import FileArgument
+from mlchain.base.stream import decode_frames
+from mlchain.base.converter import DEFAULT_OFFLOAD_THRESHOLD
 from .base import RawResponse, JsonResponse, MLChainResponse
 from sentry_sdk import add_breadcrumb, capture_exception
 import re
@@ -68,6 +72,8 @@ class BaseFormat:
                 'mlchain_version': __version__,
                 "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
             }
+            if 'timings' in request_context:
+                output['timings'] = request_context['timings']
             return JsonResponse(output, 200)
         else:
             if isinstance(exception, MlChainError):
@@ -80,7 +86,7 @@ class BaseFormat:
                     "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
                 }
                 logging_error([error], true_exception = exception)
-                return JsonResponse(output, exception.status_code)
+                return JsonResponse(output, exception.status_code, headers=dict(exception.headers))
             elif isinstance(exception, Exception):
                 error = traceback.format_exception(etype=type(exception), value=exception, tb=exception.__traceback__)
                 output = {
@@ -132,12 +138,12 @@ class MLchainFormat(BaseFormat):
         for idx, value in enumerate(args):
             if isinstance(value, str) and value.startswith('__file__') \
                     and value in files:
-                args[idx] = files[value][0].read()
+                args[idx] = FileArgument(files[value][0])
 
         for key, value in kwargs.items():
             if isinstance(value, str) and value.startswith('__file__') \
                     and value in files:
-                kwargs[key] = files[value][0].read()
+                kwargs[key] = FileArgument(files[value][0])
         return args, kwargs
 
     def make_response(self, function_name, headers, output,
@@ -154,6 +160,8 @@ class MLchainFormat(BaseFormat):
                 'mlchain_version': __version__,
                 "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
             }
+            if 'timings' in request_context:
+                output['timings'] = request_context['timings']
             status = 200
         else:
             if isinstance(exception, MlChainError):
@@ -166,7 +174,7 @@ class MLchainFormat(BaseFormat):
                     "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
                 }
                 logging_error([error], true_exception = exception)
-                return JsonResponse(output, exception.status_code)
+                return JsonResponse(output, exception.status_code, headers=dict(exception.headers))
             elif isinstance(exception, Exception):
                 error = traceback.format_exception(etype=type(exception), value=exception, tb=exception.__traceback__)
                 output = {
@@ -214,14 +222,119 @@ class AsyncMLchainFormat(MLchainFormat):
         for idx, value in enumerate(args):
             if isinstance(value, str) and value.startswith('__file__') \
                     and value in files:
-                args[idx] = await files[value][0].read()
+                args[idx] = FileArgument(files[value][0])
 
         for key, value in kwargs.items():
             if isinstance(value, str) and value.startswith('__file__') \
                     and value in files:
-                kwargs[key] = await files[value][0].read()
+                kwargs[key] = FileArgument(files[value][0])
         return args, kwargs
 
+ATTACHMENTS_CONTENT_TYPE = 'application/mlchain-attachments'
+ATTACHMENT_PREFIX = '__attachment__'
+BODY_CONTENT_TYPES = {
+    'application/json': 'json',
+    'application/msgpack': 'msgpack',
+    'application/msgpack_blosc': 'msgpack_blosc'
+}
+
+
+def get_content_type(headers):
+    return headers.get('Content-Type', '').split(';')[0].strip().lower()
+
+
+def is_body_request(headers):
+    """
+    Check the parameters of a request are its whole body instead of a form
+    """
+    content_type = get_content_type(headers)
+    return content_type in BODY_CONTENT_TYPES or content_type == ATTACHMENTS_CONTENT_TYPE
+
+
+class BodyFormat(MLchainFormat):
+    """
+    Calls sent in a single body, without multipart.
+    The body of application/json, application/msgpack or application/msgpack_blosc is the parameters,
+    [args, kwargs] or a dict of kwargs with the optional __args__.
+    The body of application/mlchain-attachments is length-prefixed frames: the parameters encoded
+    by the mlchain-serializer header, then the binary values they refer to as __attachment__<index>
+    """
+
+    def check(self, headers, form, files, data):
+        return is_body_request(headers)
+
+    def decode(self, headers, data):
+        content_type = get_content_type(headers)
+        if content_type == ATTACHMENTS_CONTENT_TYPE:
+            serializer_type = headers.get('mlchain-serializer', 'json')
+            try:
+                frames = decode_frames(data)
+            except ValueError as ex:
+                raise MLChainSerializationError(str(ex))
+            if len(frames) == 0:
+                raise MLChainSerializationError("The body has no parameters")
+            # Serializers take bytes, the parameters are small. Attachments stay views of the body
+            # until a converter needs their bytes
+            data, attachments = bytes(frames[0]), frames[1:]
+        else:
+            serializer_type = BODY_CONTENT_TYPES[content_type]
+            attachments = []
+        serializer = self.serializers.get(serializer_type, None)
+        if serializer is None:
+            raise MLChainSerializationError("Not found serializer {0}".format(serializer_type))
+        if not data:
+            return [], {}
+        parameters = serializer.decode(data)
+
+        if isinstance(parameters, (list, tuple)) and len(parameters) == 2 \
+                and isinstance(parameters[0], (list, tuple)) and isinstance(parameters[1], dict):
+            args, kwargs = list(parameters[0]), parameters[1]
+        elif isinstance(parameters, dict):
+            kwargs = parameters
+            args = list(kwargs.pop('__args__', []))
+        else:
+            raise MLChainSerializationError("The body must be [args, kwargs] or a dict of kwargs")
+
+        if len(attachments) > 0:
+            def attach(value):
+                if isinstance(value, str) and value.startswith(ATTACHMENT_PREFIX):
+                    try:
+                        return attachments[int(value[len(ATTACHMENT_PREFIX):])]
+                    except (ValueError, IndexError):
+                        pass
+                return value
+            args = [attach(value) for value in args]
+            kwargs = {key: attach(value) for key, value in kwargs.items()}
+        return args, kwargs
+
+    def parse_request(self, function_name, headers, form,
+                      files, data, request_context):
+        args, kwargs = self.decode(headers, data)
+        # Query parameters, for calls like curl -d '{"a": 1}' /call/f?b=2
+        for key, value in form.items():
+            kwargs.setdefault(key, value if len(value) > 1 else value[0])
+        return args, kwargs
+
+
+class AsyncBodyFormat(BodyFormat):
+    """
+    BodyFormat decoding bodies of offload_threshold bytes or more in executor
+    """
+
+    def __init__(self, offload_threshold=DEFAULT_OFFLOAD_THRESHOLD):
+        BodyFormat.__init__(self)
+        self.offload_threshold = offload_threshold
+
+    async def parse_request(self, function_name, headers, form,
+                            files, data, request_context):
+        if self.offload_threshold is not None and len(data) >= self.offload_threshold:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, BodyFormat.parse_request, self, function_name, headers, form,
+                files, data, request_context)
+        return BodyFormat.parse_request(self, function_name, headers, form,
+                                        files, data, request_context)
+
+
 class RawFormat(BaseFormat):
     def check(self, headers, form, files, data):
         return True
@@ -0,0 +1,139 @@
+"""
+Metrics of the calls of a server, exported at /api/metrics
+"""
+import os
+import tempfile
+from mlchain.base.metrics import registry, make_family, render, SharedMetrics, METRICS_DIR_ENV
+
+def get_status(output):
+    """
+    Get the HTTP status code of a normalized output
+    """
+    status = getattr(output, 'status', None)
+    if status is None:
+        status = getattr(output, 'status_code', None)
+    return int(status or 200)
+
+
+class ServerMetrics:
+    """
+    Counts, status codes, durations by stage and in-flight calls of each served function,
+    with the queues of the batch collectors and the saturation of the executors read at scrape.
+    With gunicorn, workers merge their metrics through the directory of MLCHAIN_METRICS_DIR
+    :server: The MLServer
+    :directory: Directory shared by the processes of the server, default is MLCHAIN_METRICS_DIR
+    """
+
+    def __init__(self, server, directory=None):
+        self.server = server
+        self.requests = registry.counter('mlchain_requests_total', 'Calls by function and status code',
+                                         ['model', 'function', 'status'])
+        self.duration = registry.histogram('mlchain_request_duration_seconds', 'Duration of the calls',
+                                           ['model', 'function'])
+        self.stages = registry.histogram('mlchain_request_stage_seconds',
+                                         'Duration of the parse, convert, execute and serialize stages of the calls',
+                                         ['model', 'function', 'stage'])
+        self.in_flight = registry.gauge('mlchain_requests_in_flight', 'Calls being served',
+                                        ['model', 'function'])
+        directory = directory or os.environ.get(METRICS_DIR_ENV)
+        self.shared = SharedMetrics(directory, self.families) if directory else None
+
+    def share(self, directory=None):
+        """
+        Merge the metrics of the processes of this server, like gunicorn workers forked after it is built
+        :directory: The shared directory, default is MLCHAIN_METRICS_DIR or a new temporary directory
+        """
+        if self.shared is None:
+            directory = directory or os.environ.get(METRICS_DIR_ENV) or tempfile.mkdtemp(prefix='mlchain-metrics-')
+            self.shared = SharedMetrics(directory, self.families)
+        return self.shared.directory
+
+    def _get_model(self, model_name):
+        if model_name is None:
+            return self.server.model
+        hosted = self.server.models.models.get(model_name) if self.server.models is not None else None
+        return hosted.serve_model if hosted is not None else None
+
+    def get_labels(self, function_name, model_name=None):
+        """
+        Get the labels of a call, functions that aren't served are counted as unknown
+        """
+        model = self._get_model(model_name)
+        if model is None or function_name not in model.all_serve_function:
+            function_name = 'unknown'
+        return {'model': model_name or '', 'function': function_name}
+
+    def start(self, labels):
+        if self.shared is not None:
+            self.shared.ensure_started()
+        self.in_flight.inc(**labels)
+
+    def finish(self, labels, status, timings, duration):
+        """
+        Record a served call
+        :timings: Dict of stage to its seconds
+        """
+        self.in_flight.dec(**labels)
+        self.requests.inc(status=status, **labels)
+        self.duration.observe(duration, **labels)
+        for stage, seconds in timings.items():
+            self.stages.observe(seconds, stage=stage, **labels)
+
+    def _served_models(self):
+        if self.server.model is not None:
+            yield '', self.server.model
+        if self.server.models is not None:
+            for name, hosted in list(self.server.models.models.items()):
+                if hosted.serve_model is not None:
+                    yield name, hosted.serve_model
+
+    def collect(self):
+        """
+        Get the families read from the batch collectors and executors of the served models
+        """
+        queues, workers, running, queued, rejected = [], [], [], [], []
+        for model_name, model in self._served_models():
+            for function_name, func in list(model.batch_functions.items()):
+                depth = len(func.__BATCH_COLLECTOR__.queue) + len(func.__ASYNC_BATCH_COLLECTOR__.queue)
+                queues.append(((model_name, function_name), depth))
+            for key, executor in list(model.executors.items()):
+                status = executor.status()
+                labels = (model_name, key or 'default')
+                workers.append((labels, status['max_workers']))
+                running.append((labels, status['running']))
+                queued.append((labels, status['queued']))
+                rejected.append((labels, status['rejected']))
+        executor_labels = ['model', 'executor']
+        return [
+            make_family('mlchain_batch_queue_depth', 'gauge', 'Calls waiting in the queue of a batch function',
+                        ['model', 'function'], queues),
+            make_family('mlchain_executor_workers', 'gauge', 'Workers of an executor of sync functions',
+                        executor_labels, workers),
+            make_family('mlchain_executor_running', 'gauge', 'Calls running in an executor',
+                        executor_labels, running),
+            make_family('mlchain_executor_queued', 'gauge', 'Calls waiting for a worker of an executor',
+                        executor_labels, queued),
+            make_family('mlchain_executor_rejected_total', 'counter', 'Calls rejected by a full executor',
+                        executor_labels, rejected),
+        ]
+
+    def families(self):
+        return registry.families() + self.collect()
+
+    def render(self):
+        """
+        Get the metrics in the Prometheus text format, of all workers if they share a directory
+        """
+        families = self.shared.families() if self.shared is not None else self.families()
+        return render(families + [self._saturation(families)])
+
+    def _saturation(self, families):
+        """
+        Get the fraction of the workers in use of each executor, from the workers and running calls of all processes
+        """
+        families = {family['name']: family for family in families}
+        workers = {tuple(key): value for key, value in families['mlchain_executor_workers']['values']}
+        values = [(key, value / float(workers[tuple(key)] or 1))
+                  for key, value in families['mlchain_executor_running']['values'] if tuple(key) in workers]
+        return make_family('mlchain_executor_saturation', 'gauge', 'Fraction of the workers of an executor in use',
+                           ['model', 'executor'], values)
@@ -0,0 +1,145 @@
+"""
+Statistical profiler of the threads of a running server, exported at /api/admin/profile
+"""
+import os
+import sys
+import time
+import threading
+from collections import Counter
+import mlchain
+from mlchain.base.exceptions import MlChainError
+
+DEFAULT_RATE = 100
+MAX_RATE = 1000
+MAX_SECONDS = 300
+FORMATS = ('collapsed', 'speedscope')
+SPEEDSCOPE_SCHEMA = 'https://www.speedscope.app/file-format-schema.json'
+
+
+def _frame_key(frame):
+    code = frame.f_code
+    return code.co_name, code.co_filename, code.co_firstlineno
+
+
+def _frame_name(key):
+    name, filename, line = key
+    return '{0} ({1}:{2})'.format(name, os.path.basename(filename), line)
+
+
+class SamplingProfiler:
+    """
+    Sample the stacks of all threads of the process but the sampling one.
+    A single profile runs at a time in a process
+    :rate: Samples per second
+    :max_seconds: Longest profile allowed
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, rate=DEFAULT_RATE, max_seconds=MAX_SECONDS):
+        self.rate = rate
+        self.max_seconds = max_seconds
+
+    def _check(self, seconds, rate, output_format):
+        try:
+            seconds, rate = float(seconds), float(rate)
+        except (TypeError, ValueError):
+            raise MlChainError("seconds and rate must be numbers", code="bad_profile", status_code=400)
+        if not 0 < seconds <= self.max_seconds:
+            raise MlChainError("seconds must be in (0, {0}]".format(self.max_seconds),
+                               code="bad_profile", status_code=400)
+        if not 0 < rate <= MAX_RATE:
+            raise MlChainError("rate must be in (0, {0}]".format(MAX_RATE), code="bad_profile", status_code=400)
+        if output_format not in FORMATS:
+            raise MlChainError("format must be one of {0}".format(', '.join(FORMATS)),
+                               code="bad_profile", status_code=400)
+        return seconds, rate
+
+    def sample(self, seconds, rate=None):
+        """
+        Sample the threads for seconds in the calling thread, which blocks meanwhile
+        :return: Dict of thread name to a Counter of stacks, each a tuple of frame keys from the root,
+        and the real duration
+        """
+        interval = 1.0 / (rate or self.rate)
+        own_ident = threading.get_ident()
+        stacks = {}
+        start = time.perf_counter()
+        deadline = start + seconds
+        next_sample = start
+        while True:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_key(frame))
+                    frame = frame.f_back
+                name = names.get(ident, 'thread-{0}'.format(ident))
+                stacks.setdefault(name, Counter())[tuple(reversed(stack))] += 1
+            next_sample += interval
+            now = time.perf_counter()
+            if next_sample >= deadline:
+                break
+            if next_sample > now:
+                time.sleep(next_sample - now)
+            else:
+                # Sampling can't keep up, skip the missed samples
+                next_sample = now
+        return stacks, time.perf_counter() - start
+
+    def profile(self, seconds, rate=None, output_format='collapsed'):
+        """
+        Profile the process and format the samples
+        :seconds: Duration of the profile
+        :rate: Samples per second, default is the rate of the profiler
+        :output_format: collapsed for the stacks of flamegraph.pl, or speedscope for its JSON format
+        """
+        seconds, rate = self._check(seconds, rate or self.rate, output_format)
+        if not self._lock.acquire(blocking=False):
+            raise MlChainError("A profile is already running in this process", code="profile_running",
+                               status_code=409)
+        try:
+            stacks, duration = self.sample(seconds, rate)
+        finally:
+            self._lock.release()
+        if output_format == 'speedscope':
+            return to_speedscope(stacks, 1.0 / rate, duration)
+        return to_collapsed(stacks)
+
+
+def to_collapsed(stacks):
+    """
+    Format stacks as lines of frames separated by ; followed by their number of samples, rooted at the thread name
+    """
+    lines = []
+    for thread_name, counter in sorted(stacks.items()):
+        for stack, count in counter.most_common():
+            frames = [thread_name.replace(';', ':').replace(' ', '_')]
+            frames.extend(_frame_name(key).replace(';', ':') for key in stack)
+            lines.append('{0} {1}'.format(';'.join(frames), count))
+    return '\n'.join(lines) + '\n'
+
+
+def to_speedscope(stacks, interval, duration):
+    """
+    Format stacks as a speedscope file with a sampled profile of each thread, weighted in seconds
+    """
+    frames, indices, profiles = [], {}, []
+    for thread_name, counter in sorted(stacks.items()):
+        samples, weights = [], []
+        for stack, count in counter.most_common():
+            sample = []
+            for key in stack:
+                if key not in indices:
+                    indices[key] = len(frames)
+                    frames.append({'name': key[0], 'file': key[1], 'line': key[2]})
+                sample.append(indices[key])
+            samples.append(sample)
+            weights.append(count * interval)
+        profiles.append({'type': 'sampled', 'name': thread_name, 'unit': 'seconds',
+                         'startValue': 0, 'endValue': max(duration, sum(weights)),
+                         'samples': samples, 'weights': weights})
+    return {'$schema': SPEEDSCOPE_SCHEMA, 'shared': {'frames': frames}, 'profiles': profiles,
+            'name': 'mlchain pid {0}'.format(os.getpid()), 'activeProfileIndex': 0,
+            'exporter': 'mlchain {0}'.format(mlchain.__version__)}
@@ -8,27 +8,32 @@ from starlette.applications import Starlette
 from starlette.routing import Mount
 from starlette.staticfiles import StaticFiles
 from starlette.responses import JSONResponse
-from starlette.routing import Route
+from starlette.routing import Route, WebSocketRoute
 from starlette.requests import Request
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
 from starlette.templating import Jinja2Templates
 from starlette.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 import mlchain
 from mlchain.base.serve_model import ServeModel
+from mlchain.base.registry import ModelRegistry
+from mlchain.base.converter import DEFAULT_OFFLOAD_THRESHOLD
 from mlchain.base.log import logger, format_exc
 from mlchain.base.exceptions import MlChainError, MLChainConfigError
 from mlchain.base.wrapper import GunicornWrapper
-from .base import AsyncMLServer, AsyncConverter, RawResponse, FileResponse, TemplateResponse
-from .format import RawFormat
+from mlchain.base.content_encoding import StreamDecompressor, CHUNK_SIZE, DEFAULT_MAX_SIZE, get_max_size, \
+    error_body
+from mlchain.base.uploads import spool_body
+from .tracing import RequestTracer
+from .base import AsyncMLServer, AsyncConverter, RawResponse, FileResponse, TemplateResponse, StreamResponse, \
+    get_query_params
+from .format import RawFormat, is_body_request
 from .swagger import SwaggerTemplate
-from .view import StarletteAsyncView
+from .view import StarletteAsyncView, StarletteWebSocketView
 from .autofrontend import register_autofrontend
 from starlette.datastructures import UploadFile
 from mlchain import mlchain_context
 from starlette.responses import FileResponse as StarletteFileResponse
-from sentry_sdk import push_scope, start_transaction
-from mlchain import mlconfig
-from uuid import uuid4
 
 APP_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 TEMPLATE_PATH = os.path.join(APP_PATH, 'server/templates')
@@ -40,7 +45,7 @@ class StarletteEndpointAction:
     Defines an Starlette Endpoint for a specific action for any client.
     """
 
-    def __init__(self, action, serializers_dict, version='latest', api_keys=None):
+    def __init__(self, action, serializers_dict, version='latest', api_keys=None, tracer=None):
         """
         Create the endpoint by specifying which action we want the endpoint to perform, at each call
         :param action: The function to execute on endpoint call
@@ -55,6 +60,8 @@ class StarletteEndpointAction:
         self.msgpack_serializer = self.serializers_dict['application/msgpack']
         self.msgpack_blosc_serializer = self.serializers_dict['application/msgpack_blosc']
         self.api_keys = api_keys
+        self.tracer = tracer or RequestTracer()
+        self.query_params = get_query_params(action)
 
     def __get_json_response(self, output, status=200):
         """
@@ -78,7 +85,7 @@ class StarletteEndpointAction:
         return Response(output_encoded, media_type='application/msgpack_blosc', status_code=status)
 
     def init_context(self): 
-        uid = str(uuid4())
+        uid = self.tracer.new_request_id()
         mlchain_context['MLCHAIN_CONTEXT_ID'] = uid
         return uid 
 
@@ -91,139 +98,137 @@ class StarletteEndpointAction:
         """
         start_time = time.time()
 
-        with push_scope() as sentry_scope:
-            transaction_name = "{0}  ||  {1}".format(mlconfig.MLCHAIN_SERVER_NAME, self.action.__name__)
-            sentry_scope.transaction = transaction_name
-            
-            with start_transaction(op="task", name=transaction_name):
-                uid = self.init_context()
+        with self.tracer.trace(self.action.__name__):
+            uid = self.init_context()
 
-                request = Request(scope, receive)
-                kwargs.update(request.path_params)
+            request = Request(scope, receive)
+            kwargs.update(request.path_params)
+            if request.method == 'GET':
+                for name in self.query_params.intersection(request.query_params.keys()).difference(kwargs):
+                    kwargs[name] = request.query_params[name]
 
-                # If data POST is in msgpack format
-                content_type = request.headers.get('content-type', 'application/json')
-                if content_type not in self.serializers_dict:
-                    headers = {k.upper(): v for k, v in request.headers.items()}
+            # If data POST is in msgpack format
+            content_type = request.headers.get('content-type', 'application/json')
+            if content_type not in self.serializers_dict:
+                headers = {k.upper(): v for k, v in request.headers.items()}
 
-                    if 'SERIALIZER'.upper() in headers:
-                        content_type = headers['SERIALIZER']
-                    else:
-                        content_type = 'application/json'
-
-                serializer = self.serializers_dict.get(content_type,
-                                                    self.serializers_dict['application/json'])
-                if content_type == 'application/msgpack':
-                    response_function = self.__get_msgpack_response
-                elif content_type == 'application/msgpack_blosc':
-                    response_function = self.__get_msgpack_blosc_response
+                if 'SERIALIZER'.upper() in headers:
+                    content_type = headers['SERIALIZER']
                 else:
-                    response_function = self.__get_json_response
-                if request.method == 'POST' and self.api_keys is not None or (
-                        isinstance(self.api_keys, (list, dict)) and len(self.api_keys) > 0):
-                    authorized = False
-                    has_key = False
-                    for key in ['x-api-key', 'apikey', 'apiKey', 'api-key']:
-                        apikey = request.headers.get(key, '')
-                        if apikey != '':
-                            has_key = True
-                        if apikey in self.api_keys:
-                            authorized = True
-                            break
-                    if not authorized:
-                        if has_key:
-                            error = 'Unauthorized. Api-key incorrect.'
-                        else:
-                            error = 'Unauthorized. Lack of x-api-key or apikey or api-key in headers.'
-                        output = {
-                            'error': error,
-                            'api_version': self.version,
-                            'mlchain_version': mlchain.__version__,
-                            "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
-                        }
-                        return await response_function(output, 401)(scope, receive, send)
-                try:
-                    # Perform the action
-                    if inspect.iscoroutinefunction(self.action) \
-                            or (not inspect.isfunction(self.action)
-                                and hasattr(self.action, '__call__')
-                                and inspect.iscoroutinefunction(self.action.__call__)):
-                        if request.method == 'POST':
-                            output = await self.action(*args, **kwargs, serializer=serializer)
-                        else:
-                            output = await self.action(*args, **kwargs)
+                    content_type = 'application/json'
+
+            serializer = self.serializers_dict.get(content_type,
+                                                self.serializers_dict['application/json'])
+            if content_type == 'application/msgpack':
+                response_function = self.__get_msgpack_response
+            elif content_type == 'application/msgpack_blosc':
+                response_function = self.__get_msgpack_blosc_response
+            else:
+                response_function = self.__get_json_response
+            if request.method == 'POST' and self.api_keys is not None or (
+                    isinstance(self.api_keys, (list, dict)) and len(self.api_keys) > 0):
+                authorized = False
+                has_key = False
+                for key in ['x-api-key', 'apikey', 'apiKey', 'api-key']:
+                    apikey = request.headers.get(key, '')
+                    if apikey != '':
+                        has_key = True
+                    if apikey in self.api_keys:
+                        authorized = True
+                        break
+                if not authorized:
+                    if has_key:
+                        error = 'Unauthorized. Api-key incorrect.'
                     else:
-                        if request.method == 'POST':
-                            output = self.action(*args, **kwargs, serializer=serializer)
-                        else:
-                            output = self.action(*args, **kwargs)
-
-                    if isinstance(output, RawResponse):
-                        output = Response(output.response, status_code=output.status,
-                                        headers=output.headers,
-                                        media_type=output.mimetype,
-                                        content_type=output.content_type)
-                        output.headers['mlchain_version'] = mlchain.__version__
-                        output.headers['api_version'] = self.version
-                        output.headers['request_id'] = mlchain_context.MLCHAIN_CONTEXT_ID
-                        return await output(scope, receive, send)
-
-                    if isinstance(output, FileResponse):
-                        file = await StarletteFileResponse(output.path)
-                        for k, v in output.headers.items():
-                            file.headers[k] = v
-                        file.headers['mlchain_version'] = mlchain.__version__
-                        file.headers['api_version'] = self.version
-                        file.headers['request_id'] = mlchain_context.MLCHAIN_CONTEXT_ID
-                        return await file(scope, receive, send)
-
-                    if isinstance(output, Response):
-                        return await output(scope, receive, send)
-
-                    output = {
-                        'output': output,
-                        'time': round(time.time() - start_time, 2),
-                        'api_version': self.version,
-                        'mlchain_version': mlchain.__version__,
-                        "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
-                    }
-                    
-                    return await response_function(output, 200)(scope, receive, send)
-                except MlChainError as ex:
-                    err = ex.msg
-                    # logger.error("code: {0} msg: {1}".format(ex.code, ex.msg))
-
-                    output = {
-                        'error': err,
-                        'time': round(time.time() - start_time, 2),
-                        'code': ex.code,
-                        'api_version': self.version,
-                        'mlchain_version': mlchain.__version__,
-                        "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
-                    }
-                    return await response_function(output, ex.status_code)(scope, receive, send)
-                except AssertionError as ex:
-                    err = str(ex)
-
-                    output = {
-                        'error': err,
-                        'time': round(time.time() - start_time, 2),
-                        'api_version': self.version,
-                        'mlchain_version': mlchain.__version__,
-                        "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
-                    }
-                    return await response_function(output, 422)(scope, receive, send)
-                except Exception as ex:
-                    err = format_exc(name='mlchain.serve.server')
-
+                        error = 'Unauthorized. Lack of x-api-key or apikey or api-key in headers.'
                     output = {
-                        'error': err,
-                        'time': round(time.time() - start_time, 2),
+                        'error': error,
                         'api_version': self.version,
                         'mlchain_version': mlchain.__version__,
                         "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
                     }
-                    return await response_function(output, 500)(scope, receive, send)
+                    return await response_function(output, 401)(scope, receive, send)
+            try:
+                # Perform the action
+                if inspect.iscoroutinefunction(self.action) \
+                        or (not inspect.isfunction(self.action)
+                            and hasattr(self.action, '__call__')
+                            and inspect.iscoroutinefunction(self.action.__call__)):
+                    if request.method == 'POST':
+                        output = await self.action(*args, **kwargs, serializer=serializer)
+                    else:
+                        output = await self.action(*args, **kwargs)
+                else:
+                    if request.method == 'POST':
+                        output = self.action(*args, **kwargs, serializer=serializer)
+                    else:
+                        output = self.action(*args, **kwargs)
+
+                if isinstance(output, RawResponse):
+                    output = Response(output.response, status_code=output.status or 200,
+                                    headers=output.headers,
+                                    media_type=output.content_type or output.mimetype)
+                    output.headers['mlchain_version'] = mlchain.__version__
+                    output.headers['api_version'] = self.version
+                    output.headers['request_id'] = mlchain_context.MLCHAIN_CONTEXT_ID
+                    return await output(scope, receive, send)
+
+                if isinstance(output, FileResponse):
+                    file = await StarletteFileResponse(output.path)
+                    for k, v in output.headers.items():
+                        file.headers[k] = v
+                    file.headers['mlchain_version'] = mlchain.__version__
+                    file.headers['api_version'] = self.version
+                    file.headers['request_id'] = mlchain_context.MLCHAIN_CONTEXT_ID
+                    return await file(scope, receive, send)
+
+                if isinstance(output, Response):
+                    return await output(scope, receive, send)
+
+                output = {
+                    'output': output,
+                    'time': round(time.time() - start_time, 2),
+                    'api_version': self.version,
+                    'mlchain_version': mlchain.__version__,
+                    "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
+                }
+                
+                return await response_function(output, 200)(scope, receive, send)
+            except MlChainError as ex:
+                err = ex.msg
+                # logger.error("code: {0} msg: {1}".format(ex.code, ex.msg))
+
+                output = {
+                    'error': err,
+                    'time': round(time.time() - start_time, 2),
+                    'code': ex.code,
+                    'api_version': self.version,
+                    'mlchain_version': mlchain.__version__,
+                    "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
+                }
+                return await response_function(output, ex.status_code)(scope, receive, send)
+            except AssertionError as ex:
+                err = str(ex)
+
+                output = {
+                    'error': err,
+                    'time': round(time.time() - start_time, 2),
+                    'api_version': self.version,
+                    'mlchain_version': mlchain.__version__,
+                    "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
+                }
+                return await response_function(output, 422)(scope, receive, send)
+            except Exception as ex:
+                err = format_exc(name='mlchain.serve.server')
+
+                output = {
+                    'error': err,
+                    'time': round(time.time() - start_time, 2),
+                    'api_version': self.version,
+                    'mlchain_version': mlchain.__version__,
+                    "request_id": mlchain_context.MLCHAIN_CONTEXT_ID
+                }
+                return await response_function(output, 500)(scope, receive, send)
 
 
 class StarletteView(StarletteAsyncView):
@@ -234,12 +239,17 @@ class StarletteView(StarletteAsyncView):
         headers = request.headers
         files = defaultdict(list)
         form = defaultdict(list)
+        data = ""
 
-        # Parse form and files
-        try:
-            temp = await request.form()
-        except:
+        # Parse form and files, or read the body of a single-body call
+        if is_body_request(headers):
             temp = {}
+            data = await request.body()
+        else:
+            try:
+                temp = await request.form()
+            except:
+                temp = {}
 
         for k, v in temp.items():
             if isinstance(v, UploadFile):
@@ -252,13 +262,14 @@ class StarletteView(StarletteAsyncView):
         for k, v in temp.items():
             form[k].append(v)
 
-        data = ""
         return headers, form, files, data
 
     async def __call__(self, scope, receive, send, *args, **kwargs): 
         request = Request(scope, receive)
         function_name = request.path_params['function_name']
-        return await self.call_function(function_name, request, scope, receive, send, **kwargs)
+        model_name = request.path_params.get('model_name')
+        return await self.call_function(function_name, request, scope, receive, send,
+                                        model_name=model_name, **kwargs)
 
     async def make_response(self, response: Union[RawResponse, FileResponse], request, scope, receive, send):
         if isinstance(response, RawResponse):
@@ -279,6 +290,14 @@ class StarletteView(StarletteAsyncView):
             file.headers['request_id'] = mlchain_context.MLCHAIN_CONTEXT_ID
             return await file(scope, receive, send)
 
+        if isinstance(response, StreamResponse):
+            output = StreamingResponse(response.chunks, headers=response.headers,
+                                       media_type=response.content_type)
+            output.headers['mlchain_version'] = mlchain.__version__
+            output.headers['api_version'] = self.server.version
+            output.headers['request_id'] = mlchain_context.MLCHAIN_CONTEXT_ID
+            return await output(scope, receive, send)
+
         if isinstance(response, TemplateResponse):
             if self.templates is None: 
                 raise MLChainConfigError("Not found 'template_folder', please check the mlconfig.yaml!")
@@ -289,11 +308,89 @@ class StarletteView(StarletteAsyncView):
 
         raise Exception("make_response must return RawResponse or FileResponse")
 
+class DecompressionMiddleware:
+    """
+    ASGI middleware decompressing request bodies sent with a Content-Encoding, chunk by chunk
+    into a spooled temporary file
+    :max_size: Max bytes of a decompressed body, larger requests get 413
+    :offload_threshold: Min bytes of a chunk decompressed in a thread, None to decompress everything inline
+    :get_limit: Callable giving the max content length of the function called at a path, or None
+    """
+
+    def __init__(self, app, max_size=DEFAULT_MAX_SIZE, offload_threshold=None, get_limit=None):
+        self.app = app
+        self.max_size = max_size
+        self.offload_threshold = offload_threshold
+        self.get_limit = get_limit
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        encoding = None
+        headers = []
+        for key, value in scope['headers']:
+            if key == b'content-encoding':
+                encoding = value.decode('latin-1')
+            elif key != b'content-length':
+                headers.append((key, value))
+        if encoding is None or encoding.strip().lower() == 'identity':
+            return await self.app(scope, receive, send)
+
+        limit = self.get_limit(scope['path']) if self.get_limit is not None else None
+        body = spool_body()
+        try:
+            decompressor = StreamDecompressor(encoding, body, get_max_size(self.max_size, limit))
+            more_body = True
+            while more_body:
+                message = await receive()
+                chunk = message.get('body', b'')
+                if self.offload_threshold is not None and len(chunk) >= self.offload_threshold:
+                    await run_in_threadpool(decompressor.write, chunk)
+                else:
+                    decompressor.write(chunk)
+                more_body = message.get('more_body', False)
+            decompressor.close()
+        except MlChainError as ex:
+            body.close()
+            response = Response(error_body(ex), status_code=ex.status_code, media_type='application/json')
+            return await response(scope, receive, send)
+
+        size = decompressor.size
+        headers.append((b'content-length', str(size).encode('latin-1')))
+        body.seek(0)
+        done = False
+
+        async def receive_body():
+            nonlocal done
+            if done:
+                return await receive()
+            chunk = body.read(CHUNK_SIZE)
+            done = body.tell() >= size
+            return {'type': 'http.request', 'body': chunk, 'more_body': not done}
+        try:
+            await self.app(dict(scope, headers=headers), receive_body, send)
+        finally:
+            body.close()
+
+
 class StarletteServer(AsyncMLServer):
     def __init__(self, model: ServeModel, name=None, version='0.0',
                  authentication=None, api_format=None,
-                 static_folder=None, template_folder=None, static_url_path:str="static"):
-        AsyncMLServer.__init__(self, model, name, version, api_format)
+                 static_folder=None, template_folder=None, static_url_path:str="static",
+                 models: ModelRegistry = None, offload_threshold=DEFAULT_OFFLOAD_THRESHOLD,
+                 ws_max_inflight=64, compression=None, lean=False, trace_sample_rate=None):
+        """
+        :offload_threshold: Min bytes of a request value or output decoded or encoded off the event loop,
+                            None to keep everything on the event loop
+        :ws_max_inflight: Max calls running at once on one /ws/call socket
+        :compression: True or the options (min_size, encodings) of the response compression, None reads
+                      the compression config and is off by default. False also disables the decompression of requests
+        :lean: Lean request path, with sampled tracing, counter request ids and only the mlchain-context-*
+               headers in the context
+        :trace_sample_rate: Fraction of the requests traced in lean mode, default is the Sentry traces_sample_rate
+        """
+        AsyncMLServer.__init__(self, model, name, version, api_format, authentication, models=models,
+                               compression=compression, lean=lean, trace_sample_rate=trace_sample_rate)
 
         if not isinstance(static_url_path, str): 
             static_url_path = "static"
@@ -306,8 +403,17 @@ class StarletteServer(AsyncMLServer):
                 Mount('/call_raw', routes=[
                     Route('/{function_name:path}', StarletteView(self, RawFormat(), self.authentication), methods=['POST', 'GET'], name="call_raw")
                 ]),
+                WebSocketRoute('/ws/call', StarletteWebSocketView(self, self.authentication, max_inflight=ws_max_inflight), name="ws_call"),
             ],
         )
+        if self.decompress_requests:
+            self.app.add_middleware(DecompressionMiddleware, offload_threshold=offload_threshold,
+                                    get_limit=self.get_body_limit)
+        if self.models is not None:
+            self.app.router.routes.append(Mount('/models', routes=[
+                Route('/{model_name}/call/{function_name:path}', StarletteView(self, self.api_format_class, self.authentication), methods=['POST', 'GET'], name="models_call"),
+                Route('/{model_name}/call_raw/{function_name:path}', StarletteView(self, RawFormat(), self.authentication), methods=['POST', 'GET'], name="models_call_raw")
+            ]))
 
         if template_folder is not None and isinstance(template_folder, str) and len(template_folder) > 0: 
             self.templates = Jinja2Templates(directory=template_folder)
@@ -315,7 +421,8 @@ class StarletteServer(AsyncMLServer):
             self.templates = None
         self.mlchain_template = Jinja2Templates(directory=TEMPLATE_PATH)
 
-        self.converter = AsyncConverter(UploadFile, self._get_file_name, self._get_data)
+        self.converter = AsyncConverter(UploadFile, self._get_file_name, self._get_data,
+                                        offload_threshold=offload_threshold)
 
         self.initialize_endpoint()
 
@@ -341,19 +448,21 @@ class StarletteServer(AsyncMLServer):
         return await self.converter.convert(value, out_type)
         
     def _add_endpoint(self, endpoint=None, endpoint_name=None,
-                      handler=None, methods=['GET', 'POST']):
+                      handler=None, methods=['GET', 'POST'], api_keys=None):
         """
         Add one endpoint to the flask application. Accept GET, POST and PUT.
         :param endpoint: Callable URL.
         :param endpoint_name: Name of the Endpoint
         :param handler: function to execute on call on the URL
+        :param api_keys: List of keys, one of them must be in the x-api-key header
         :return: Nothing
         """
         self.app.add_route(path=endpoint.replace("<", "{").replace(">", "}").replace("{function_name}", "{function_name:path}"), name=endpoint_name,
                               route=StarletteEndpointAction(handler,
                                                   self.serializers_dict,
                                                   version=self.version,
-                                                  api_keys=None),
+                                                  api_keys=api_keys,
+                                                  tracer=self.tracer),
                               methods=methods)
 
     def _register_swagger(self):
@@ -369,6 +478,14 @@ class StarletteServer(AsyncMLServer):
         swagger_template.add_core_endpoint(self.model._get_parameters_of_func, '/api/get_params/{function_name}', tags=["MlChain Core APIs"])
         swagger_template.add_core_endpoint(self.model._get_description_of_func, '/api/des_func/{function_name}', tags=["MlChain Core APIs"])
         swagger_template.add_core_endpoint(self._check_status, '/api/ping', tags=["MlChain Core APIs"])
+        swagger_template.add_core_endpoint(self.model._check_ready, '/api/ready', tags=["MlChain Core APIs"])
+        swagger_template.add_core_endpoint(self.model._get_batch_status, '/api/batch_status', tags=["MlChain Core APIs"])
+        swagger_template.add_core_endpoint(self.model._get_replica_status, '/api/replicas', tags=["MlChain Core APIs"])
+        swagger_template.add_core_endpoint(self.model._get_cache_status, '/api/cache_status', tags=["MlChain Core APIs"])
+        swagger_template.add_core_endpoint(self.model._get_limit_status, '/api/limits', tags=["MlChain Core APIs"])
+        swagger_template.add_core_endpoint(self.model._get_executor_status, '/api/executors', tags=["MlChain Core APIs"])
+        if self.models is not None:
+            swagger_template.add_core_endpoint(self.models.status, '/api/models', tags=["MlChain Core APIs"])
         swagger_template.add_core_endpoint(self.model._get_all_description, '/api/description', tags=["MlChain Core APIs"])
         swagger_template.add_core_endpoint(self.model._list_all_function, '/api/list_all_function', tags=["MlChain Core APIs"])
         swagger_template.add_core_endpoint(self.model._list_all_function_and_description, '/api/list_all_function_and_description', tags=["MlChain Core APIs"])
@@ -464,6 +581,8 @@ class StarletteServer(AsyncMLServer):
         logger.info("Debug = {}".format(debug))
         logger.info("-" * 80)
 
+        # Workers are forked after the app is built, they merge their metrics through a directory
+        self.metrics.share()
         loglevel = kwargs.get('loglevel', 'warning' if debug else 'info')
         GunicornWrapper(self.app, bind=bind, workers=workers, timeout=timeout,
                         keepalive=keepalive, max_requests=max_requests,
@@ -0,0 +1,116 @@
+"""
+Per-request bookkeeping of the servers: request ids, Sentry transactions, the mlchain context and Server-Timing
+"""
+import os
+import re
+import random
+import itertools
+from contextlib import contextmanager, nullcontext
+from uuid import uuid4
+from sentry_sdk import push_scope, start_transaction
+from mlchain import mlconfig
+
+_request_prefix = None
+_request_counter = None
+
+
+def _reset_request_ids():
+    global _request_prefix, _request_counter
+    _request_prefix = '{0}-{1}-'.format(uuid4().hex[:8], os.getpid())
+    _request_counter = itertools.count(1)
+
+
+_reset_request_ids()
+if hasattr(os, 'register_at_fork'):
+    # Workers forked from a preloaded app get their own prefix
+    os.register_at_fork(after_in_child=_reset_request_ids)
+
+
+def next_request_id():
+    """
+    Get a request id unique across processes, a prefix of the process and a counter
+    """
+    return '{0}{1:x}'.format(_request_prefix, next(_request_counter))
+
+
+def _configured_sample_rate():
+    dsn = mlconfig.MLCHAIN_SENTRY_DSN
+    if dsn is None or dsn == 'None':
+        return 0.0
+    return float(mlconfig.MLCHAIN_SENTRY_TRACES_SAMPLE_RATE or 0.0)
+
+
+class RequestTracer:
+    """
+    Tracing of the requests of a server. By default every request gets a Sentry scope and transaction,
+    a uuid4 id and a context with all its headers. In lean mode, for models of a few milliseconds
+    where this is most of the latency, the config is read once, only sampled requests are traced,
+    ids come from a counter and only the mlchain-context-* headers are copied into the context
+    :lean: Use the lean mode
+    :sample_rate: Fraction of the requests traced in lean mode, default is the traces_sample_rate
+                  of the Sentry config, 0 if Sentry isn't configured
+    """
+
+    def __init__(self, lean=False, sample_rate=None):
+        self.lean = lean
+        if lean:
+            self.server_name = mlconfig.MLCHAIN_SERVER_NAME
+            self.sample_rate = _configured_sample_rate() if sample_rate is None else float(sample_rate)
+        else:
+            self.server_name = None
+            self.sample_rate = 1.0
+
+    @contextmanager
+    def _transaction(self, name):
+        server_name = self.server_name if self.lean else mlconfig.MLCHAIN_SERVER_NAME
+        with push_scope() as sentry_scope:
+            transaction_name = "{0}  ||  {1}".format(server_name, name)
+            sentry_scope.transaction = transaction_name
+
+            with start_transaction(op="task", name=transaction_name):
+                yield sentry_scope
+
+    def trace(self, name):
+        """
+        Get the context of a request of function or endpoint name, giving its Sentry scope
+        or None if the request isn't sampled
+        """
+        if self.lean and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            return nullcontext()
+        return self._transaction(name)
+
+    def new_request_id(self):
+        if self.lean:
+            return next_request_id()
+        return str(uuid4())
+
+    def context_from_headers(self, headers):
+        """
+        Get the mlchain context of a request, mlchain-context-* headers are also set as MLCHAIN_CONTEXT_* keys
+        """
+        context = {} if self.lean else {key: value for (key, value) in headers.items()}
+        for key, value in headers.items():
+            lower_key = key.lower()
+            if lower_key.startswith("mlchain-context") or lower_key.startswith("mlchain_context"):
+                context[key.upper().replace("-", "_")] = value
+        return context
+
+
+def merge_timings(timings, spans):
+    """
+    Merge the stage timings of a call with the spans added by its model code, spans of the same name are summed
+    :timings: Dict of stage to its seconds
+    :spans: List of (name, seconds)
+    """
+    merged = dict(timings)
+    for name, seconds in spans:
+        merged[name] = merged.get(name, 0) + seconds
+    return merged
+
+
+def format_server_timing(timings):
+    """
+    Get the Server-Timing header of a dict of name to seconds, durations are in milliseconds
+    """
+    return ', '.join('{0};dur={1:.3f}'.format(re.sub(r'[^A-Za-z0-9_.-]', '_', str(name)), seconds * 1000)
+                     for name, seconds in timings.items())
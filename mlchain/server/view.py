@@ -1,18 +1,52 @@
 import time
+import asyncio
 from typing import Union
-from uuid import uuid4
 from mlchain import mlchain_context,logger
-from mlchain.base.exceptions import MlChainError
-from .format import BaseFormat, MLchainFormat, AsyncMLchainFormat
-from .base import RawResponse, FileResponse, JsonResponse, MLChainResponse
+from mlchain.base.exceptions import MlChainError, MLChain404Error
+from mlchain.base.converter import AsyncConverter
+from mlchain.base.serve_model import hold_until_consumed
+from .format import BaseFormat, MLchainFormat, AsyncMLchainFormat, BodyFormat, AsyncBodyFormat
+from .base import RawResponse, FileResponse, JsonResponse, MLChainResponse, StreamResponse
+from mlchain.base.stream import encode_frame, encode_event, STREAM_CONTENT_TYPE, EVENT_STREAM_CONTENT_TYPE
 from flask import Response as FlaskResponse 
 from starlette.responses import Response as StarletteResponse
 from .authentication import Authentication
+from .metrics import get_status
+from .tracing import merge_timings, format_server_timing
 import traceback
-from sentry_sdk import push_scope, start_transaction
-from mlchain import mlconfig
 import inspect
 from starlette.requests import Request
+from starlette.websockets import WebSocket, WebSocketDisconnect
+from starlette.concurrency import run_in_threadpool
+
+def _stream_error(exception):
+    if isinstance(exception, MlChainError):
+        return {'error': exception.msg, 'code': exception.code}
+    logger.error(traceback.format_exc())
+    return {'error': "{0}: {1}".format(type(exception).__name__, exception), 'code': 'exception'}
+
+
+def _encode_stream(output, encode, encode_error, end):
+    try:
+        for item in output:
+            yield encode(item)
+    except Exception as ex:
+        yield encode_error(_stream_error(ex))
+        return
+    if end is not None:
+        yield end
+
+
+async def _encode_async_stream(output, encode, encode_error, end):
+    try:
+        async for item in output:
+            yield encode(item)
+    except Exception as ex:
+        yield encode_error(_stream_error(ex))
+        return
+    if end is not None:
+        yield end
+
 
 class View:
     def __init__(self, server, formatter: BaseFormat = None,
@@ -20,7 +54,7 @@ class View:
         self.server = server
         self.base_format = BaseFormat()
         self.mlchain_format = MLchainFormat()
-        self.formats = [self.mlchain_format]
+        self.formats = [BodyFormat(), self.mlchain_format]
         if isinstance(formatter, BaseFormat):
             self.formats.insert(0, formatter)
         self.authentication = authentication
@@ -28,6 +62,21 @@ class View:
     def parse_data(self):
         raise NotImplementedError
 
+    def get_content_length(self):
+        return None
+
+    def check_content_length(self, function_name, model_name, content_length):
+        """
+        Reject a request over the max content length of its function before its body is read
+        """
+        if model_name is None:
+            model = self.server.model
+        else:
+            hosted = self.server.models.models.get(model_name) if self.server.models is not None else None
+            model = hosted.serve_model if hosted is not None else None
+        if model is not None:
+            model.check_content_length(function_name, content_length)
+
     def make_response(self, response: Union[RawResponse, FileResponse]):
         raise NotImplementedError
 
@@ -41,13 +90,7 @@ class View:
         return formatter
 
     def init_context_with_headers(self, headers, context_id:str = None):
-        context = {key: value
-                   for (key, value) in headers.items()}
-        new_context = {}
-        for key, value in context.items(): 
-            if key.lower().startswith("mlchain-context") or key.lower().startswith("mlchain_context"): 
-                new_context[key.upper().replace("-", "_")] = value
-        context.update(new_context)
+        context = self.server.tracer.context_from_headers(headers)
 
         mlchain_context.set(context)
 
@@ -59,12 +102,12 @@ class View:
         return context_id
 
     def init_context(self): 
-        uid = str(uuid4())
+        uid = self.server.tracer.new_request_id()
         mlchain_context['MLCHAIN_CONTEXT_ID'] = uid
         return uid 
         
     def normalize_output(self, formatter, function_name, headers,
-                         output, exception, request_context):
+                         output, exception, request_context, model=None):
         if isinstance(output, FileResponse):
             output.headers['response-type'] = 'mlchain/file'
         elif isinstance(output, JsonResponse):
@@ -77,12 +120,135 @@ class View:
             output.headers['response-type'] = 'mlchain/starlette_raw'
         elif isinstance(output, MLChainResponse):
             pass
+        elif exception is None and (inspect.isgenerator(output) or inspect.isasyncgen(output)):
+            output = self.make_stream(headers, output)
         else:
             output = formatter.make_response(function_name, headers, output,
                                              exception=exception,
                                              request_context=request_context)
+
+        cache_status = mlchain_context.pop('MLCHAIN_CACHE_STATUS', None)
+        if cache_status is not None and exception is None:
+            output.headers['Cache-Status'] = cache_status
+        return self.compress_output(function_name, headers, output, model)
+
+    def compress_output(self, function_name, headers, output, model=None):
+        """
+        Compress a body response with the encoding negotiated from the Accept-Encoding of the request,
+        files, streams and already compressed types are sent as is
+        """
+        compression = getattr(self.server, 'compression', None)
+        if compression is None or type(output) not in (RawResponse, JsonResponse) \
+                or 'Content-Encoding' in output.headers:
+            return output
+        if model is not None:
+            compression = compression.override(model.compressions.get(function_name))
+        content_type = output.content_type or next(
+            (value for key, value in output.headers.items() if key.lower() == 'content-type'), None)
+        body, encoding = compression.compress(output.response, headers.get('Accept-Encoding'), content_type)
+        output.headers['Vary'] = 'Accept-Encoding'
+        if encoding is not None:
+            output.response = body
+            output.headers['Content-Encoding'] = encoding
         return output
 
+    def get_spans(self, headers, timings, request_context):
+        """
+        Get the stage timings of a call with the spans of its model code, also set in the envelope
+        if the client sends mlchain-timings: true
+        """
+        spans = merge_timings(timings, mlchain_context.pop_timings())
+        if str(headers.get('mlchain-timings', '')).lower() in ('1', 'true'):
+            request_context['timings'] = {name: round(seconds * 1000, 3) for name, seconds in spans.items()}
+        return spans
+
+    def add_server_timing(self, output, spans, serialize):
+        """
+        Set the Server-Timing header of a response, in milliseconds
+        """
+        spans['serialize'] = serialize
+        if getattr(output, 'headers', None) is not None:
+            output.headers['Server-Timing'] = format_server_timing(spans)
+        return output
+
+    def acquire_model(self, model_name=None):
+        """
+        Get the ServeModel of a request, a hosted model is loaded if needed and kept until release_model
+        :model_name: Name of a model hosted in server.models, None is the served model
+        """
+        if model_name is None:
+            if self.server.model is None:
+                raise MLChain404Error("Call a hosted model at /models/<model_name>/call/<function_name>")
+            return self.server.model
+        if self.server.models is None:
+            raise MLChain404Error("Model {0} is not hosted".format(model_name), code="model_not_found")
+        return self.server.models.acquire(model_name)
+
+    def release_model(self, model_name=None):
+        if model_name is not None:
+            self.server.models.release(model_name)
+
+    def hold_model(self, model_name, output):
+        """
+        Keep a hosted model loaded until its generator output is consumed
+        :return: The wrapped generator, None if the model can be released when the call returns
+        """
+        if model_name is None:
+            return None
+        return hold_until_consumed(output, [lambda: self.release_model(model_name)])
+
+    def make_stream(self, headers, output):
+        """
+        Stream a generator output as Server-Sent Events if the client accepts them, else as
+        length-prefixed frames encoded by the serializer of the request
+        """
+        if EVENT_STREAM_CONTENT_TYPE in headers.get('Accept', ''):
+            serializer_type = 'json'
+            serializer = self.mlchain_format.serializers['json']
+            content_type = EVENT_STREAM_CONTENT_TYPE
+
+            def encode(item):
+                return encode_event(serializer.encode({'output': item}).decode())
+
+            def encode_error(error):
+                return encode_event(serializer.encode(error).decode(), event='error')
+            end = encode_event('{}', event='end')
+        else:
+            serializer_type = headers.get('mlchain-serializer', 'json')
+            serializer = self.mlchain_format.serializers.get(serializer_type)
+            if serializer is None:
+                serializer_type = 'json'
+                serializer = self.mlchain_format.serializers['json']
+            content_type = STREAM_CONTENT_TYPE
+
+            def encode(item):
+                return encode_frame(serializer.encode({'output': item}))
+
+            def encode_error(error):
+                return encode_frame(serializer.encode(error))
+            end = None
+
+        if inspect.isasyncgen(output):
+            chunks = _encode_async_stream(output, encode, encode_error, end)
+        else:
+            chunks = _encode_stream(output, encode, encode_error, end)
+        return StreamResponse(chunks, content_type, headers={
+            'response-type': 'mlchain/stream',
+            'mlchain-serializer': serializer_type,
+            'Cache-Control': 'no-cache'
+        })
+
+    def call_model(self, function_name, uid, kwargs, model=None):
+        """
+        Call the model, sharing one execution between identical concurrent requests if coalesced
+        """
+        if model is None:
+            model = self.server.model
+        key = model.get_coalesce_key(function_name, kwargs)
+        if key is None:
+            return model.call_function(function_name, uid, **kwargs)
+        return model.single_flight.do(key, lambda: model.call_function(function_name, uid, **kwargs))
+
     def __call__(self, *args, **kwargs): 
         if "function_name" in kwargs: 
             function_name = kwargs.pop('function_name')
@@ -91,41 +257,57 @@ class View:
 
         return self.call_function(function_name=function_name, **kwargs)
 
-    def call_function(self, function_name, **kws):
-        with push_scope() as sentry_scope:
-            transaction_name = "{0}  ||  {1}".format(mlconfig.MLCHAIN_SERVER_NAME, function_name)
-            sentry_scope.transaction = transaction_name
-            
-            with start_transaction(op="task", name=transaction_name):
+    def call_function(self, function_name, model_name=None, **kws):
+        metrics = self.server.metrics
+        labels = metrics.get_labels(function_name, model_name)
+        metrics.start(labels)
+        timings = {}
+        status = 500
+        begin = time.perf_counter()
+        try:
+            with self.server.tracer.trace(function_name) as sentry_scope:
                 uid = self.init_context()
 
                 request_context = {
                     'api_version': self.server.version
                 }
                 try:
+                    self.check_content_length(function_name, model_name, self.get_content_length())
                     headers, form, files, data = self.parse_data()
                 except Exception as ex:
                     request_context['time_process'] = 0
                     output = self.normalize_output(self.base_format, function_name, {},
                                                 None, ex, request_context)
+                    status = get_status(output)
                     return self.make_response(output)
 
                 formatter = self.get_format(headers, form, files, data)
                 start_time = time.time()
+                model = None
+                held = False
                 try:
                     if self.authentication is not None:
                         self.authentication.check(headers)
                     args, kwargs = formatter.parse_request(function_name, headers, form,
                                                         files, data, request_context)
-                    func = self.server.model.get_function(function_name)
-                    kwargs = self.server.get_kwargs(func, *args, **kwargs)
-                    kwargs = self.server._normalize_kwargs_to_valid_format(kwargs, func)
+                    timings['parse'] = time.perf_counter() - begin
+                    model = self.acquire_model(model_name)
+                    mark = time.perf_counter()
+                    plan = model.get_call_plan(function_name)
+                    kwargs = self.server.bind(plan, args, kwargs)
+                    timings['convert'] = time.perf_counter() - mark
 
                     uid = self.init_context_with_headers(headers, uid)
-                    sentry_scope.set_tag("transaction_id", uid)
+                    if sentry_scope is not None:
+                        sentry_scope.set_tag("transaction_id", uid)
                     logger.debug("Mlchain transaction id: {0}".format(uid))
 
-                    output = self.server.model.call_function(function_name, uid, **kwargs)
+                    mark = time.perf_counter()
+                    output = self.call_model(function_name, uid, kwargs, model)
+                    stream = self.hold_model(model_name, output)
+                    if stream is not None:
+                        output, held = stream, True
+                    timings['execute'] = time.perf_counter() - mark
                     exception = None
                 except MlChainError as ex:
                     exception = ex
@@ -133,20 +315,29 @@ class View:
                 except Exception as ex:
                     exception = ex
                     output = None
+                finally:
+                    if model is not None and not held:
+                        self.release_model(model_name)
 
                 time_process = time.time() - start_time
                 request_context['time_process'] = time_process
+                spans = self.get_spans(headers, timings, request_context)
+                mark = time.perf_counter()
                 output = self.normalize_output(formatter, function_name, headers,
-                                            output, exception, request_context)
+                                            output, exception, request_context, model=model)
+                timings['serialize'] = time.perf_counter() - mark
+                status = get_status(output)
+                self.add_server_timing(output, spans, timings['serialize'])
                 return self.make_response(output)
-
+        finally:
+            metrics.finish(labels, status, timings, time.perf_counter() - begin)
 
 class StarletteAsyncView(View):
     def __init__(self, server, formatter=None, authentication: Authentication = None):
         View.__init__(self, server, formatter, authentication)
 
         self.mlchain_format = AsyncMLchainFormat()
-        self.formats = [self.mlchain_format]
+        self.formats = [AsyncBodyFormat(), self.mlchain_format]
         if isinstance(formatter, BaseFormat):
             self.formats.insert(0, formatter)
 
@@ -156,32 +347,74 @@ class StarletteAsyncView(View):
     async def make_response(self, response: Union[RawResponse, FileResponse]):
         return super().make_response(response)
 
+    async def acquire_model(self, model_name=None):
+        """
+        Get the ServeModel of a request, a hosted model is loaded in an executor if needed
+        :model_name: Name of a model hosted in server.models, None is the served model
+        """
+        if model_name is None or self.server.models is None:
+            return View.acquire_model(self, model_name)
+        return await self.server.models.acquire_async(model_name)
+
+    async def call_model(self, function_name, uid, kwargs, model=None):
+        """
+        Call the model, sharing one execution between identical concurrent requests if coalesced
+        """
+        if model is None:
+            model = self.server.model
+        key = model.get_coalesce_key(function_name, kwargs)
+        if key is None:
+            return await model.call_async_function(function_name, uid, **kwargs)
+        return await model.single_flight.do_async(
+            key, lambda: model.call_async_function(function_name, uid, **kwargs))
+
+    async def normalize_output_async(self, formatter, function_name, headers,
+                                     output, exception, request_context, model=None):
+        """
+        Normalize and encode the output, in the executor of the converter when it is large
+        """
+        converter = self.server.converter
+        if exception is None and isinstance(converter, AsyncConverter) and converter.should_offload(output):
+            return await converter.offload(self.normalize_output, formatter, function_name, headers,
+                                           output, exception, request_context, model)
+        return self.normalize_output(formatter, function_name, headers,
+                                     output, exception, request_context, model)
+
     async def __call__(self, scope, receive, send, *args, **kwargs): 
         request = Request(scope, receive)
         function_name = request.path_params['function_name']
-        return await self.call_function(function_name, request, scope, receive, send, **kwargs)
+        model_name = request.path_params.get('model_name')
+        return await self.call_function(function_name, request, scope, receive, send,
+                                        model_name=model_name, **kwargs)
         
-    async def call_function(self, function_name, request, scope, receive, send, **kws):
+    async def call_function(self, function_name, request, scope, receive, send, model_name=None, **kws):
         function_name = function_name.strip("/")
-        with push_scope() as sentry_scope:
-            transaction_name = "{0}  ||  {1}".format(mlconfig.MLCHAIN_SERVER_NAME, function_name)
-            sentry_scope.transaction = transaction_name
-            
-            with start_transaction(op="task", name=transaction_name):
+        metrics = self.server.metrics
+        labels = metrics.get_labels(function_name, model_name)
+        metrics.start(labels)
+        timings = {}
+        status = 500
+        begin = time.perf_counter()
+        try:
+            with self.server.tracer.trace(function_name) as sentry_scope:
                 uid = self.init_context()
 
                 request_context = {
                     'api_version': self.server.version
                 }
                 try:
+                    self.check_content_length(function_name, model_name, request.headers.get('content-length'))
                     headers, form, files, data = await self.parse_data(request)
                 except Exception as ex:
                     request_context['time_process'] = 0
                     output = self.normalize_output(self.base_format, function_name, {},
                                                 None, ex, request_context)
+                    status = get_status(output)
                     return await self.make_response(output, request, scope, receive, send)
                 formatter = self.get_format(headers, form, files, data)
                 start_time = time.time()
+                model = None
+                held = False
                 try:
                     if self.authentication is not None:
                         self.authentication.check(headers)
@@ -192,14 +425,23 @@ class StarletteAsyncView(View):
                     else:
                         args, kwargs = formatter.parse_request(function_name, headers, form,
                                                             files, data, request_context)
-                    func = self.server.model.get_function(function_name)
-                    kwargs = self.server.get_kwargs(func, *args, **kwargs)
-                    kwargs = await self.server._normalize_kwargs_to_valid_format(kwargs, func)
+                    timings['parse'] = time.perf_counter() - begin
+                    model = await self.acquire_model(model_name)
+                    mark = time.perf_counter()
+                    plan = model.get_call_plan(function_name)
+                    kwargs = await self.server.bind(plan, args, kwargs)
+                    timings['convert'] = time.perf_counter() - mark
                     uid = self.init_context_with_headers(headers, uid)
-                    sentry_scope.set_tag("transaction_id", uid)
+                    if sentry_scope is not None:
+                        sentry_scope.set_tag("transaction_id", uid)
                     logger.debug("Mlchain transaction id: {0}".format(uid))
 
-                    output = await self.server.model.call_async_function(function_name, uid, **kwargs)
+                    mark = time.perf_counter()
+                    output = await self.call_model(function_name, uid, kwargs, model)
+                    stream = self.hold_model(model_name, output)
+                    if stream is not None:
+                        output, held = stream, True
+                    timings['execute'] = time.perf_counter() - mark
                     exception = None
                 except MlChainError as ex:
                     exception = ex
@@ -207,9 +449,133 @@ class StarletteAsyncView(View):
                 except Exception as ex:
                     exception = ex
                     output = None
+                finally:
+                    if model is not None and not held:
+                        self.release_model(model_name)
 
                 time_process = time.time() - start_time
                 request_context['time_process'] = time_process
-                output = self.normalize_output(formatter, function_name, headers,
-                                            output, exception, request_context)
+                spans = self.get_spans(headers, timings, request_context)
+                mark = time.perf_counter()
+                output = await self.normalize_output_async(formatter, function_name, headers,
+                                                           output, exception, request_context, model=model)
+                timings['serialize'] = time.perf_counter() - mark
+                status = get_status(output)
+                self.add_server_timing(output, spans, timings['serialize'])
                 return await self.make_response(output, request, scope, receive, send)
+        finally:
+            metrics.finish(labels, status, timings, time.perf_counter() - begin)
+
+class StarletteWebSocketView(StarletteAsyncView):
+    """
+    Calls on one persistent WebSocket. Each message is a call {id, function, args, kwargs, model, headers},
+    binary messages are msgpack and text messages are JSON, the reply {id, output, time} or {id, error, code}
+    uses the same encoding. Calls of a socket run concurrently, up to max_inflight at once, after which
+    the socket isn't read until one of them replies
+    """
+
+    def __init__(self, server, authentication: Authentication = None, max_inflight=64):
+        StarletteAsyncView.__init__(self, server, None, authentication)
+        self.max_inflight = max_inflight
+
+    async def __call__(self, scope, receive, send):
+        websocket = WebSocket(scope, receive, send)
+        if self.authentication is not None:
+            try:
+                self.authentication.check({**websocket.query_params, **websocket.headers})
+            except MlChainError as ex:
+                await websocket.close(code=1008, reason=ex.msg)
+                return
+        await websocket.accept()
+
+        slots = asyncio.Semaphore(self.max_inflight)
+        send_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                await slots.acquire()
+                message = await websocket.receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                task = asyncio.ensure_future(self.reply(websocket, message, send_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: slots.release())
+        except WebSocketDisconnect:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def reply(self, websocket, message, send_lock):
+        binary = message.get('bytes') is not None
+        serializer = self.mlchain_format.serializers['msgpack' if binary else 'json']
+        metrics = self.server.metrics
+        call_id = None
+        labels = None
+        timings = {}
+        status = 500
+        begin = time.perf_counter()
+        start_time = time.time()
+        try:
+            try:
+                data = message['bytes'] if binary else message['text'].encode()
+                call = serializer.decode(data)
+                call_id = call.get('id')
+                function_name = call['function']
+                labels = metrics.get_labels(function_name, call.get('model'))
+                metrics.start(labels)
+                timings['parse'] = time.perf_counter() - begin
+                with self.server.tracer.trace(function_name):
+                    output = await self.call(call, len(data), timings)
+                output = {'id': call_id, 'output': output, 'time': round(time.time() - start_time, 2)}
+                status = 200
+            except Exception as ex:
+                output = {'id': call_id, **_stream_error(ex)}
+                status = ex.status_code if isinstance(ex, MlChainError) else 500
+
+            mark = time.perf_counter()
+            converter = self.server.converter
+            if isinstance(converter, AsyncConverter) and converter.should_offload(output.get('output')):
+                encoded = await converter.offload(serializer.encode, output)
+            else:
+                encoded = serializer.encode(output)
+            timings['serialize'] = time.perf_counter() - mark
+            async with send_lock:
+                if binary:
+                    await websocket.send_bytes(encoded)
+                else:
+                    await websocket.send_text(encoded.decode())
+        finally:
+            if labels is not None:
+                metrics.finish(labels, status, timings, time.perf_counter() - begin)
+
+    async def call(self, call, content_length=None, timings=None):
+        """
+        Run one call received on a socket and get its output
+        :content_length: Bytes of the message, checked against the max content length of the function
+        :timings: Dict filled with the seconds of the convert and execute stages
+        """
+        function_name = call['function']
+        model_name = call.get('model')
+        headers = call.get('headers') or {}
+        timings = {} if timings is None else timings
+        uid = self.init_context_with_headers(headers, self.server.tracer.new_request_id())
+        self.check_content_length(function_name, model_name, content_length)
+        model = await self.acquire_model(model_name)
+        try:
+            mark = time.perf_counter()
+            plan = model.get_call_plan(function_name)
+            kwargs = await self.server.bind(plan, call.get('args') or [], call.get('kwargs') or {})
+            timings['convert'] = time.perf_counter() - mark
+            mark = time.perf_counter()
+            output = await self.call_model(function_name, uid, kwargs, model)
+            # A socket reply carries one value, streamed outputs are sent whole
+            if inspect.isasyncgen(output):
+                output = [item async for item in output]
+            elif inspect.isgenerator(output):
+                output = await run_in_threadpool(list, output)
+            timings['execute'] = time.perf_counter() - mark
+        finally:
+            self.release_model(model_name)
+        return output
@@ -0,0 +1,79 @@
+"""
+Framework overhead per call of a no-op function, with and without the lean request path.
+The WSGI and ASGI apps are called directly, so no HTTP client or socket is measured.
+Run: python -m tests.benchmark_overhead [--calls 5000]
+"""
+import argparse
+import asyncio
+import time
+from io import BytesIO
+
+from werkzeug.test import EnvironBuilder
+from mlchain.base import ServeModel
+from mlchain.server.flask_server import FlaskServer
+from mlchain.server.starlette_server import StarletteServer
+
+
+class NoopModel():
+    def noop(self, value: int = 0):
+        return value
+
+
+def bench_flask(server, calls):
+    app = server.app.wsgi_app
+    environ = EnvironBuilder(path='/call/noop', method='POST', data={'value': '1'},
+                             headers={'mlchain-context-user': 'bench', 'User-Agent': 'bench'}).get_environ()
+    body = environ['wsgi.input'].read()
+
+    def start_response(status, headers, exc_info=None):
+        assert status.startswith('200'), status
+
+    def call():
+        for _ in app(dict(environ, **{'wsgi.input': BytesIO(body)}), start_response):
+            pass
+    call()
+    start_time = time.perf_counter()
+    for _ in range(calls):
+        call()
+    return (time.perf_counter() - start_time) / calls
+
+
+def bench_starlette(server, calls):
+    app = server.app
+    body = b'{"value": 1}'
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+             'scheme': 'http', 'path': '/call/noop', 'raw_path': b'/call/noop', 'root_path': '',
+             'query_string': b'', 'server': ('testserver', 80), 'client': ('testclient', 50000),
+             'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()),
+                         (b'mlchain-context-user', b'bench'), (b'user-agent', b'bench')]}
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            assert message['status'] == 200, message
+
+    async def run():
+        await app(dict(scope), receive, send)
+        start_time = time.perf_counter()
+        for _ in range(calls):
+            await app(dict(scope), receive, send)
+        return (time.perf_counter() - start_time) / calls
+    return asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=5000)
+    args = parser.parse_args()
+    for name, server_class, bench in [('flask', FlaskServer, bench_flask),
+                                      ('starlette', StarletteServer, bench_starlette)]:
+        for lean in [False, True]:
+            server = server_class(ServeModel(NoopModel()), lean=lean)
+            seconds = bench(server, args.calls)
+            print("{0:<10} lean={1!s:<6} {2:8.1f} us/call".format(name, lean, seconds * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+import asyncio
+import logging
+import os
+import tempfile
+import socket
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from mlchain.base import ServeModel
+from mlchain.base.serve_model import batch, non_thread
+import numpy as np
+from mlchain.base.batching import AdaptiveBatchSize, PaddingBuffer
+from mlchain.base.exceptions import MLChainAssertionError, MLChainBusyError, MlChainError
+from mlchain.base.replicas import ReplicaPool
+from mlchain.base.coordinator import BatchCoordinator, CoordinatorClient, COORDINATOR_ENV, wait_for_coordinator, \
+    _send_frame, _recv_frame
+
+logger = logging.getLogger()
+
+
+class BatchModel():
+    def __init__(self):
+        self.batch_sizes = []
+
+    @batch(name='double', variables={'values': int}, variable_names={'values': 'value'},
+           max_batch_size=4, max_wait_ms=200)
+    def double_batch(self, values):
+        self.batch_sizes.append(len(values))
+        return [value * 2 for value in values]
+
+    @batch(name='async_double', variables={'values': int}, variable_names={'values': 'value'},
+           max_batch_size=4, max_wait_ms=200)
+    async def async_double_batch(self, values):
+        await asyncio.sleep(0)
+        self.batch_sizes.append(len(values))
+        return [value * 2 for value in values]
+
+    @batch(name='slow_size', variables={'payloads': bytes}, variable_names={'payloads': 'payload'},
+           max_batch_size=1, max_queue_bytes=1000)
+    def slow_size_batch(self, payloads):
+        time.sleep(0.3)
+        return [len(payload) for payload in payloads]
+
+    @batch(name='padded_sum', variables={'images': np.ndarray}, variable_names={'images': 'image'},
+           max_batch_size=4, max_wait_ms=200, bucket_by='images', bucket_granularity=8, pad='images')
+    def padded_sum_batch(self, images, images_mask, images_shapes):
+        self.batch_sizes.append(images.shape)
+        assert images.flags['C_CONTIGUOUS']
+        return [(int(image.sum()), int(mask.sum()), shape)
+                for image, mask, shape in zip(images, images_mask, images_shapes)]
+
+    @batch(name='broken', variables={'values': int}, variable_names={'values': 'value'})
+    def broken_batch(self, values):
+        raise ValueError("This exception is expected")
+
+
+class ArgsError(Exception):
+    # Pickles, but can't be unpickled since __init__ doesn't take its args
+    def __init__(self, a, b):
+        Exception.__init__(self, "{0} and {1}".format(a, b))
+
+
+class SlowModel():
+    def __init__(self):
+        self.batch_sizes = []
+
+    @non_thread()
+    def predict(self, value):
+        time.sleep(0.2)
+        return id(self)
+
+    def custom_error(self):
+        raise ArgsError('a', 'b')
+
+    @batch(name='slow_double', variables={'values': int}, variable_names={'values': 'value'},
+           max_batch_size=2, max_wait_ms=50)
+    def slow_double_batch(self, values):
+        time.sleep(0.2)
+        self.batch_sizes.append(len(values))
+        return [value * 2 for value in values]
+
+
+class TestBatch(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        logger.info("Running batch test")
+
+    def test_flush_on_max_batch_size(self):
+        model = BatchModel()
+        serve_model = ServeModel(model)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            outputs = list(pool.map(lambda v: serve_model.call_function('double', None, value=v), range(8)))
+        assert outputs == [v * 2 for v in range(8)]
+        assert model.batch_sizes == [4, 4]
+
+    def test_flush_on_deadline(self):
+        model = BatchModel()
+        serve_model = ServeModel(model)
+        start_time = time.time()
+        assert serve_model.call_function('double', None, value=3) == 6
+        assert time.time() - start_time >= 0.15
+        assert model.batch_sizes == [1]
+
+    def test_batch_exception(self):
+        serve_model = ServeModel(BatchModel())
+        with self.assertRaises(ValueError):
+            serve_model.call_function('broken', None, value=1)
+
+    def test_bytes_admission(self):
+        serve_model = ServeModel(BatchModel())
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            # The first call runs, the second one is queued alone even though it is oversized
+            running = pool.submit(serve_model.call_function, 'slow_size', None, payload=b'0' * 600)
+            time.sleep(0.1)
+            queued = pool.submit(serve_model.call_function, 'slow_size', None, payload=b'0' * 600)
+            time.sleep(0.1)
+            with self.assertRaises(MLChainBusyError) as context:
+                serve_model.call_function('slow_size', None, payload=b'0' * 600)
+            assert context.exception.status_code == 429
+            assert 'Retry-After' in context.exception.headers
+            assert running.result() == 600
+            assert queued.result() == 600
+
+    def test_adaptive_batch_size(self):
+        # 10ms fixed cost and 5ms per item: 20 items fit under 120ms
+        controller = AdaptiveBatchSize(latency_target_ms=120, max_batch_size=64)
+        for size in [1, 2, 4, 8, 16, 32] * 8:
+            controller.record(size, 0.010 + 0.005 * size)
+        assert controller.batch_size in (21, 22)
+        assert controller.status()['curve']['slope_ms_per_item'] == 5.0
+
+        controller = AdaptiveBatchSize(latency_target_ms=1000, max_batch_size=16)
+        for size in [1, 2] * 8:
+            controller.record(size, 0.001 * size)
+        assert controller.batch_size == 16
+
+    def test_shape_bucket_and_padding(self):
+        model = BatchModel()
+        serve_model = ServeModel(model)
+        shapes = [(3, 5), (8, 8), (2, 7), (12, 4)]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            outputs = list(pool.map(lambda shape: serve_model.call_function(
+                'padded_sum', None, image=np.ones(shape, dtype=np.int32)), shapes))
+        assert outputs == [(h * w, h * w, (h, w)) for h, w in shapes]
+        # (3, 5), (8, 8) and (2, 7) share the 8x8 bucket, (12, 4) is alone in the 16x8 bucket
+        assert sorted(model.batch_sizes) == [(1, 12, 4), (3, 8, 8)]
+
+    def test_padding_buffer_reuse(self):
+        buffer = PaddingBuffer(pad_value=-1)
+        tensor, _, _ = buffer.pad([np.ones((2, 3)), np.ones((1, 2))])
+        row = tensor[0]
+        del tensor
+        # A view of the last batch is still alive: the next batch must not overwrite it
+        other, _, _ = buffer.pad([np.zeros((2, 3))])
+        assert (row == 1).all()
+        assert not np.shares_memory(row, other)
+        raw = buffer.raw
+        del row, other
+        buffer.pad([np.zeros((2, 2))])
+        assert buffer.raw is raw
+
+    def test_batch_status(self):
+        serve_model = ServeModel(BatchModel())
+        serve_model.call_function('double', None, value=1)
+        status = serve_model._get_batch_status()
+        assert set(status) == {'double', 'async_double', 'slow_size', 'padded_sum', 'broken'}
+        assert status['double']['batch_size'] == 4
+        assert status['double']['queue'] == 0
+
+    def test_async_batch(self):
+        model = BatchModel()
+        serve_model = ServeModel(model)
+
+        async def run():
+            return await asyncio.gather(*[serve_model.call_async_function('double', None, value=v)
+                                          for v in range(8)])
+        assert asyncio.run(run()) == [v * 2 for v in range(8)]
+        assert model.batch_sizes == [4, 4]
+
+    def test_async_batch_coroutine_function(self):
+        model = BatchModel()
+        serve_model = ServeModel(model)
+
+        async def run():
+            return await asyncio.gather(*[serve_model.call_async_function('async_double', None, value=v)
+                                          for v in range(3)])
+        assert asyncio.run(run()) == [0, 2, 4]
+        assert model.batch_sizes == [3]
+        assert serve_model.call_function('async_double', None, value=5) == 10
+
+    def test_replica_pool(self):
+        serve_model = ServeModel(SlowModel(), replicas=4)
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            outputs = list(pool.map(lambda v: serve_model.call_function('predict', None, value=v), range(4)))
+        # Each replica has its own non_thread lock, so the calls run side by side
+        assert time.time() - start_time < 0.6
+        assert len(set(outputs)) == 4
+        assert serve_model._get_replica_status() == {'replicas': 4, 'available': 4}
+
+    def test_batch_on_replicas(self):
+        model = SlowModel()
+        serve_model = ServeModel(model, replicas=2, model_factory=SlowModel)
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            outputs = list(pool.map(lambda v: serve_model.call_function('slow_double', None, value=v), range(4)))
+        assert outputs == [v * 2 for v in range(4)]
+        assert time.time() - start_time < 0.38
+        replicas = serve_model.replica_pool.replicas
+        assert sum(len(replica.batch_sizes) for replica in replicas) == 2
+
+    def test_async_replica_pool(self):
+        serve_model = ServeModel(SlowModel(), replicas=2)
+
+        async def run():
+            return await asyncio.gather(*[serve_model.call_async_function('slow_double', None, value=v)
+                                          for v in range(4)])
+        assert asyncio.run(run()) == [0, 2, 4, 6]
+
+    def test_async_replica_cancel(self):
+        pool = ReplicaPool(['first'])
+
+        async def run():
+            replica = await pool.get_async()
+            waiters = [asyncio.ensure_future(pool.get_async()) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            # A cancelled waiter doesn't take the replica, the next one gets it
+            waiters[0].cancel()
+            pool.put(replica)
+            assert await waiters[1] == 'first'
+            assert waiters[0].cancelled()
+            pool.put('first')
+            with self.assertRaises(MlChainError):
+                async with pool.acquire_async():
+                    await pool.get_async(timeout=0.05)
+        asyncio.run(run())
+        assert pool.status() == {'replicas': 1, 'available': 1}
+        with pool.acquire() as replica:
+            assert replica == 'first'
+
+    def test_coordinator(self):
+        model = BatchModel()
+        path = os.path.join(tempfile.mkdtemp(), 'batch.sock')
+        coordinator = BatchCoordinator(ServeModel(model), path)
+        threading.Thread(target=coordinator.serve_forever, daemon=True).start()
+        while not os.path.exists(path):
+            time.sleep(0.01)
+        try:
+            # Two workers forward their inputs, batches form across both of them
+            workers = [ServeModel(BatchModel()) for _ in range(2)]
+            for worker in workers:
+                worker.use_coordinator(CoordinatorClient(path, timeout=5))
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                outputs = list(pool.map(lambda v: workers[v % 2].call_function('double', None, value=v), range(8)))
+            assert outputs == [v * 2 for v in range(8)]
+            assert model.batch_sizes == [4, 4]
+
+            with self.assertRaises(ValueError):
+                workers[0].call_function('broken', None, value=1)
+
+            async def run():
+                return await asyncio.gather(*[workers[1].call_async_function('double', None, value=v)
+                                              for v in range(4)])
+            assert asyncio.run(run()) == [0, 2, 4, 6]
+        finally:
+            coordinator.close()
+
+    def test_coordinator_proxy(self):
+        model = SlowModel()
+        path = os.path.join(tempfile.mkdtemp(), 'batch.sock')
+        assert not wait_for_coordinator(path, timeout=0.2)
+        coordinator = BatchCoordinator(ServeModel(model), path)
+        threading.Thread(target=coordinator.serve_forever, daemon=True).start()
+        assert wait_for_coordinator(path, timeout=5)
+        os.environ[COORDINATOR_ENV] = path
+        try:
+            worker = ServeModel(None, model_factory=SlowModel)
+        finally:
+            del os.environ[COORDINATOR_ENV]
+        try:
+            # The worker never builds the model, all its calls run on the coordinator
+            assert worker.proxy and 'batch_sizes' not in worker.model.__dict__
+            assert worker.replica_pool is None
+            worker.use_coordinator(CoordinatorClient(path, timeout=5))
+            assert worker.call_function('predict', None, value=1) == id(model)
+            assert worker.call_function('slow_double', None, value=2) == 4
+            assert asyncio.run(worker.call_async_function('predict', None, value=1)) == id(model)
+            assert model.batch_sizes == [1]
+            with self.assertRaises(MLChainAssertionError):
+                worker.swap_model()
+            # The coordinator sends an error the worker can load, the connection keeps working
+            with self.assertRaisesRegex(MlChainError, 'ArgsError: a and b'):
+                worker.call_function('custom_error', None)
+            assert worker.call_function('slow_double', None, value=3) == 6
+        finally:
+            coordinator.close()
+
+    def test_coordinator_bad_frame(self):
+        path = os.path.join(tempfile.mkdtemp(), 'batch.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+
+        def reply_unloadable():
+            conn, _ = server.accept()
+            request_id = _recv_frame(conn)[0]
+            _send_frame(conn, threading.Lock(), (request_id, False, ArgsError('a', 'b')))
+            time.sleep(1)
+            conn.close()
+        threading.Thread(target=reply_unloadable, daemon=True).start()
+        try:
+            client = CoordinatorClient(path)
+            future = client.submit('double', (), {'value': 1})
+            # The reader fails the pending calls instead of leaving them waiting forever
+            with self.assertRaisesRegex(MlChainError, 'closed'):
+                future.result(timeout=5)
+        finally:
+            server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from mlchain.base import ServeModel, cache
+from mlchain.base.cache import ResultCache, content_hash
+from mlchain.base.singleflight import SingleFlight
+from mlchain.server.flask_server import FlaskServer
+from starlette.testclient import TestClient
+from mlchain.server.starlette_server import StarletteServer, StarletteView
+
+logger = logging.getLogger()
+
+
+class CacheModel():
+    def __init__(self):
+        self.calls = 0
+
+    @cache(max_bytes=1024)
+    def mean(self, image: np.ndarray):
+        self.calls += 1
+        return float(image.mean())
+
+    @cache(max_bytes=1024)
+    def normalize(self, image: np.ndarray):
+        self.calls += 1
+        return {'image': image / image.max()}
+
+    def echo(self, text: str):
+        self.calls += 1
+        return text
+
+    def slow_echo(self, text: str):
+        self.calls += 1
+        time.sleep(0.2)
+        return text
+
+    async def async_slow_echo(self, text: str):
+        self.calls += 1
+        await asyncio.sleep(0.2)
+        return text
+
+
+class TestCache(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        logger.info("Running cache test")
+
+    def test_content_hash(self):
+        image = np.arange(12, dtype=np.uint8).reshape(3, 4)
+        key = content_hash('mean', (), {'image': image})
+        assert key == content_hash('mean', (), {'image': image.copy()})
+        assert key != content_hash('mean', (), {'image': image.reshape(4, 3)})
+        assert key != content_hash('mean', (), {'image': image.astype(np.int16)})
+        assert key != content_hash('echo', (), {'image': image})
+
+    def test_lru_and_ttl(self):
+        result_cache = ResultCache(max_bytes=250)
+        result_cache.put('a', b'0' * 100)
+        result_cache.put('b', b'0' * 100)
+        assert result_cache.get('a')[0]
+        result_cache.put('c', b'0' * 100)
+        # b is the least recently used one
+        assert not result_cache.get('b')[0]
+        assert result_cache.status()['evictions'] == 1
+        assert not result_cache.put('d', b'0' * 300)
+
+        result_cache = ResultCache(ttl=0.05)
+        result_cache.put('a', 1)
+        assert result_cache.get('a') == (True, 1)
+        time.sleep(0.1)
+        assert result_cache.get('a') == (False, None)
+
+    def test_serve_model_cache(self):
+        model = CacheModel()
+        serve_model = ServeModel(model, caches={'echo': {'ttl': 60}})
+        for _ in range(3):
+            assert serve_model.call_function('mean', None, image=np.ones((2, 2))) == 1.0
+            assert serve_model.call_function('echo', None, text='hello') == 'hello'
+        assert model.calls == 2
+        status = serve_model._get_cache_status()
+        assert status['mean']['hits'] == 2
+        assert status['echo']['misses'] == 1
+
+    def test_cached_output_copied(self):
+        model = CacheModel()
+        serve_model = ServeModel(model)
+        image = np.array([1.0, 2.0])
+        for _ in range(3):
+            output = serve_model.call_function('normalize', None, image=image)
+            assert output['image'].tolist() == [0.5, 1.0]
+            # Mutating what a call returned must not change the next hit
+            output['image'][:] = 0
+            output['image'] = None
+        assert model.calls == 1
+
+    def test_cache_status_header(self):
+        flask_client = FlaskServer(ServeModel(CacheModel())).app.test_client()
+        starlette_client = TestClient(StarletteServer(ServeModel(CacheModel())).app)
+        for client in [flask_client, starlette_client]:
+            response = client.post('/call/mean', data={'image': '[[1, 2], [3, 4]]'})
+            assert response.headers['Cache-Status'] == 'mlchain; fwd=miss; stored'
+            response = client.post('/call/mean', data={'image': '[[1, 2], [3, 4]]'})
+            assert response.headers['Cache-Status'] == 'mlchain; hit'
+            response = client.post('/call/echo', data={'text': 'hello'})
+            assert 'Cache-Status' not in response.headers
+
+    def test_coalesce(self):
+        model = CacheModel()
+        serve_model = ServeModel(model, coalesce=['slow_echo'])
+        flask_client = FlaskServer(serve_model).app.test_client()
+        texts = ['a', 'a', 'a', 'b']
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            responses = list(pool.map(lambda text: flask_client.post('/call/slow_echo', data={'text': text}), texts))
+        assert [response.json['output'] for response in responses] == texts
+        assert model.calls == 2
+        assert serve_model.single_flight.status() == {'in_flight': 0, 'coalesced': 2}
+
+    def test_coalesce_async(self):
+        model = CacheModel()
+        serve_model = ServeModel(model, coalesce=True)
+        view = StarletteView(StarletteServer(serve_model))
+
+        async def run():
+            return await asyncio.gather(*[view.call_model('async_slow_echo', None, {'text': text})
+                                          for text in ['a', 'a', 'b']])
+        assert asyncio.run(run()) == ['a', 'a', 'b']
+        assert model.calls == 2
+
+    def test_coalesce_leader_cancelled(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        async def slow():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return 'done'
+
+        async def run():
+            leader = asyncio.ensure_future(single_flight.do_async('key', slow))
+            await asyncio.sleep(0.01)
+            waiter = asyncio.ensure_future(single_flight.do_async('key', slow))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            # The waiter runs the call again instead of getting None or the leader's cancellation
+            return await waiter
+        assert asyncio.run(run()) == 'done'
+        assert len(calls) == 2
+
+        class Interrupted(BaseException):
+            pass
+
+        def interrupted():
+            time.sleep(0.1)
+            raise Interrupted()
+
+        def leader():
+            try:
+                single_flight.do('key', interrupted)
+            except Interrupted:
+                pass
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            pool.submit(leader)
+            time.sleep(0.01)
+            assert pool.submit(single_flight.do, 'key', lambda: 'done').result() == 'done'
+
+
+if __name__ == '__main__':
+    unittest.main()
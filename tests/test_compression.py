@@ -0,0 +1,149 @@
+import os
+import gzip
+import logging
+import threading
+import unittest
+
+from werkzeug.serving import make_server
+from starlette.testclient import TestClient
+from mlchain.base import ServeModel, compression, max_content_length
+from mlchain.base.content_encoding import Compression, decompress, parse_accept_encoding
+from mlchain.base.exceptions import MlChainError
+from mlchain.base.serializer import JsonSerializer
+from mlchain.client import HttpClient
+from mlchain.server.flask_server import FlaskServer
+from mlchain.server.starlette_server import StarletteServer
+
+logger = logging.getLogger()
+
+
+class CompressionModel():
+    def text(self, size: int = 4096):
+        return 'a' * size
+
+    @compression(enabled=False)
+    def image(self, size: int = 4096):
+        return 'a' * size
+
+    def size(self, data: bytes):
+        return len(data)
+
+    @max_content_length(1000)
+    def small_size(self, data: bytes):
+        return len(data)
+
+
+class TestCompression(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        logger.info("Running compression test")
+
+    def test_negotiate(self):
+        assert parse_accept_encoding('gzip;q=0.5, br') == {'gzip': 0.5, 'br': 1.0}
+        policy = Compression(encodings=['gzip'])
+        assert policy.negotiate('gzip, deflate') == 'gzip'
+        assert policy.negotiate('gzip;q=0') is None
+        assert policy.negotiate('*') == 'gzip'
+        assert policy.negotiate('br') is None
+        assert policy.negotiate(None) is None
+        assert policy.compress(b'a' * 10, 'gzip') == (b'a' * 10, None)
+        body, encoding = policy.compress(b'a' * 2048, 'gzip')
+        assert encoding == 'gzip' and gzip.decompress(body) == b'a' * 2048
+        assert policy.compress(b'a' * 2048, 'gzip', 'application/msgpack_blosc') == (b'a' * 2048, None)
+        assert policy.compress(b'a' * 2048, 'gzip', 'image/png; q=1')[1] is None
+
+    def test_decompress_limit(self):
+        body = gzip.compress(b'\x00' * 100000)
+        assert decompress(body, 'gzip', max_size=100000) == b'\x00' * 100000
+        with self.assertRaises(MlChainError) as context:
+            decompress(body, 'gzip', max_size=1000)
+        assert context.exception.status_code == 413
+        with self.assertRaises(MlChainError) as context:
+            decompress(body, 'unknown')
+        assert context.exception.status_code == 415
+        with self.assertRaises(MlChainError) as context:
+            decompress(body[:-20], 'gzip')
+        assert context.exception.status_code == 400
+
+    def test_opt_in(self):
+        client = FlaskServer(ServeModel(CompressionModel())).app.test_client()
+        response = client.post('/call/text', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+        # Compressed requests are still accepted
+        body = gzip.compress(b'{"data": "abc"}')
+        response = client.post('/call/size', data=body, headers={'Content-Type': 'application/json',
+                                                                 'Content-Encoding': 'gzip'})
+        assert response.json['output'] == 3
+
+        os.environ['COMPRESSION'] = 'true'
+        try:
+            client = FlaskServer(ServeModel(CompressionModel())).app.test_client()
+        finally:
+            del os.environ['COMPRESSION']
+        response = client.post('/call/text', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+
+    def test_decompress_body_limit(self):
+        body = gzip.compress(b'{"data": "' + b'a' * 3000000 + b'"}')
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        for client in [FlaskServer(ServeModel(CompressionModel())).app.test_client(),
+                       TestClient(StarletteServer(ServeModel(CompressionModel())).app)]:
+            is_flask = hasattr(client, 'application')
+            response = client.post('/call/size', headers=headers, **{'data' if is_flask else 'content': body})
+            assert (response.json if is_flask else response.json())['output'] == 3000000
+            # The limit of the function applies to the decompressed body
+            response = client.post('/call/small_size', headers=headers, **{'data' if is_flask else 'content': body})
+            assert response.status_code == 413
+            assert (response.json if is_flask else response.json())['code'] == 'too_large'
+
+    def test_flask(self):
+        client = FlaskServer(ServeModel(CompressionModel()), compression=True).app.test_client()
+        response = client.post('/call/text', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert JsonSerializer().decode(gzip.decompress(response.data))['output'] == 'a' * 4096
+        response = client.post('/call/text', data={'size': 10}, headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+        response = client.post('/call/image', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+
+        body = gzip.compress(b'{"data": "abc"}')
+        response = client.post('/call/size', data=body, headers={'Content-Type': 'application/json',
+                                                                 'Content-Encoding': 'gzip'})
+        assert response.json['output'] == 3
+        response = client.post('/call/size', data=body, headers={'Content-Type': 'application/json',
+                                                                 'Content-Encoding': 'unknown'})
+        assert response.status_code == 415
+
+        client = FlaskServer(ServeModel(CompressionModel()), compression=False).app.test_client()
+        response = client.post('/call/text', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+
+    def test_starlette(self):
+        client = TestClient(StarletteServer(ServeModel(CompressionModel()), compression={'min_size': 100}).app)
+        response = client.post('/call/text', data={'size': 200}, headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.json()['output'] == 'a' * 200
+
+        body = gzip.compress(b'{"data": "abc"}')
+        response = client.post('/call/size', content=body, headers={'Content-Type': 'application/json',
+                                                                    'Content-Encoding': 'gzip'})
+        assert response.json()['output'] == 3
+        response = client.post('/call/size', content=b'not gzip', headers={'Content-Type': 'application/json',
+                                                                           'Content-Encoding': 'gzip'})
+        assert response.status_code == 400
+
+    def test_client(self):
+        server = make_server('127.0.0.1', 0, FlaskServer(ServeModel(CompressionModel())).app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            model = HttpClient(api_address='127.0.0.1:{0}'.format(server.server_port), serializer='json',
+                               headers={}, compression='gzip')
+            assert model.text(size=10000) == 'a' * 10000
+            assert model.size(b'\x00' * 10000) == 10000
+            self.assertRaises(AssertionError, HttpClient, api_address='127.0.0.1', compression='unknown')
+        finally:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
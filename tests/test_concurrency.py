@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from mlchain.base import ServeModel, limit
+from mlchain.base.exceptions import MLChainBusyError
+from mlchain.base.limiter import ConcurrencyLimiter
+from mlchain.server.flask_server import FlaskServer
+
+logger = logging.getLogger()
+
+
+class LimitedModel():
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+
+    @limit(max_concurrency=1, max_queue=1)
+    def ocr_document(self, seconds: float = 0.2):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        time.sleep(seconds)
+        self.running -= 1
+        return 'done'
+
+    async def async_ocr_document(self, seconds: float = 0.2):
+        await asyncio.sleep(seconds)
+        return 'done'
+
+    def classify(self):
+        return 'cat'
+
+    @limit(max_concurrency=1, max_queue=0)
+    def stream_pages(self, pages: int = 2):
+        for page in range(pages):
+            yield page
+
+    async def async_stream_pages(self, pages: int = 2):
+        for page in range(pages):
+            yield page
+
+
+class TestConcurrency(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        logger.info("Running concurrency limit test")
+
+    def test_concurrency_limiter(self):
+        limiter = ConcurrencyLimiter(max_concurrency=2, timeout=0.05)
+        limiter.acquire()
+        limiter.acquire()
+        start_time = time.time()
+        with self.assertRaises(MLChainBusyError):
+            limiter.acquire()
+        assert time.time() - start_time >= 0.05
+        limiter.release()
+        with limiter:
+            assert limiter.status()['running'] == 2
+        limiter.release()
+        assert limiter.status() == {'max_concurrency': 2, 'max_queue': None, 'running': 0,
+                                    'waiting': 0, 'rejected': 1}
+
+    def test_sync_limit(self):
+        model = LimitedModel()
+        serve_model = ServeModel(model)
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [pool.submit(serve_model.call_function, 'ocr_document', None, seconds=0.2)
+                       for _ in range(3)]
+            time.sleep(0.05)
+            # The cheap function isn't held up by the limited one
+            assert serve_model.call_function('classify', None) == 'cat'
+        outputs = []
+        for future in futures:
+            try:
+                outputs.append(future.result())
+            except MLChainBusyError:
+                outputs.append('busy')
+        assert sorted(outputs) == ['busy', 'done', 'done']
+        assert model.max_running == 1
+        assert serve_model._get_limit_status()['ocr_document']['rejected'] == 1
+
+    def test_async_limit(self):
+        serve_model = ServeModel(LimitedModel(), limits={
+            'async_ocr_document': {'max_concurrency': 2, 'max_queue': 1}
+        })
+
+        async def run():
+            return await asyncio.gather(*[serve_model.call_async_function('async_ocr_document', None, seconds=0.1)
+                                          for _ in range(4)], return_exceptions=True)
+        start_time = time.time()
+        outputs = asyncio.run(run())
+        assert sum(isinstance(output, MLChainBusyError) for output in outputs) == 1
+        # The queued call runs once a slot is free
+        assert time.time() - start_time >= 0.2
+        assert serve_model._get_limit_status()['async_ocr_document']['running'] == 0
+
+    def test_stream_limit(self):
+        serve_model = ServeModel(LimitedModel(), replicas=2, limits={
+            'async_stream_pages': {'max_concurrency': 1, 'max_queue': 0}
+        })
+        status = serve_model._get_limit_status
+        # The stream keeps its slot and its replica until it is consumed
+        stream = serve_model.call_function('stream_pages', None, pages=2)
+        assert status()['stream_pages']['running'] == 1 and serve_model.replica_pool.available == 1
+        with self.assertRaises(MLChainBusyError):
+            serve_model.call_function('stream_pages', None)
+        assert list(stream) == [0, 1]
+        assert status()['stream_pages']['running'] == 0 and serve_model.replica_pool.available == 2
+        # Or until it is dropped without being read
+        stream = serve_model.call_function('stream_pages', None)
+        del stream
+        assert status()['stream_pages']['running'] == 0 and serve_model.replica_pool.available == 2
+
+        async def run():
+            stream = await serve_model.call_async_function('async_stream_pages', None, pages=3)
+            assert status()['async_stream_pages']['running'] == 1
+            return [page async for page in stream]
+        assert asyncio.run(run()) == [0, 1, 2]
+        assert status()['async_stream_pages']['running'] == 0 and serve_model.replica_pool.available == 2
+
+    def test_server(self):
+        client = FlaskServer(ServeModel(LimitedModel())).app.test_client()
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            responses = list(pool.map(lambda _: client.post('/call/ocr_document', data={'seconds': 0.2}),
+                                      range(3)))
+        status_codes = sorted(response.status_code for response in responses)
+        assert status_codes == [200, 200, 429]
+        busy = [response for response in responses if response.status_code == 429][0]
+        assert 'Retry-After' in busy.headers
+        assert client.get('/api/limits').json['output']['ocr_document']['max_concurrency'] == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,13 @@
+import asyncio
 import logging
+import threading
 import unittest
 from typing import *
 
 import numpy as np
-from mlchain.base.converter import Converter, get_type
+from mlchain.base.converter import Converter, AsyncConverter, get_type
+from mlchain.base.call_plan import CallPlan
+from mlchain.base.exceptions import MLChainAssertionError
 
 logger = logging.getLogger()
 
@@ -68,6 +72,47 @@ class TestConverter(unittest.TestCase):
             self.assertTrue(check_type(value, test_case['type']),
                             msg="{0}: {1} -> {2}".format(test_case['type'], test_case['origin'], test_case['expected']))
 
+    def test_call_plan(self):
+        def predict(image: np.ndarray, scale: float = 1.0, tags: List[int] = None, raw=None):
+            pass
+
+        plan = CallPlan('predict', predict)
+        kwargs = plan.bind(("[[1,2],[3,4]]",), {'scale': '2.5', 'tags': '[1, 2]', 'unknown': 1}, self.converter)
+        assert isinstance(kwargs['image'], np.ndarray)
+        assert kwargs['scale'] == 2.5
+        assert kwargs['tags'] == [1, 2]
+        assert 'unknown' not in kwargs
+        # The str -> float converter is resolved once and reused
+        assert plan.parameters['scale'].resolve('3', self.converter.convert_dict) is \
+            Converter.convert_dict[str][float]
+        with self.assertRaises(MLChainAssertionError):
+            plan.bind((), {'scale': 1.0}, self.converter)
+
+        def accept_all(value: int, **kwargs):
+            pass
+
+        kwargs = CallPlan('accept_all', accept_all).bind((), {'value': '1', 'extra': 'x'}, self.converter)
+        assert kwargs == {'value': 1, 'extra': 'x'}
+
+    def test_async_offload(self):
+        converter = AsyncConverter(offload_threshold=1024)
+        def predict(image: np.ndarray):
+            pass
+
+        async def run():
+            loop_thread = threading.get_ident()
+            small = await converter.apply(lambda value: threading.get_ident(), b'0' * 10)
+            large = await converter.apply(lambda value: threading.get_ident(), b'0' * 2048)
+            image = '[' + ','.join(['1'] * 2048) + ']'
+            kwargs = await CallPlan('predict', predict).bind_async((image,), {}, converter)
+            return loop_thread, small, large, kwargs['image']
+
+        loop_thread, small, large, image = asyncio.run(run())
+        assert small == loop_thread
+        assert large != loop_thread
+        assert image.shape == (2048,)
+        assert not AsyncConverter(offload_threshold=None).should_offload(b'0' * 2048)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import os
+import time
+import unittest
+
+from mlchain import mlchain_context
+from mlchain.base import ServeModel
+from mlchain.base.exceptions import MLChainBusyError
+from starlette.testclient import TestClient
+from mlchain.server.starlette_server import StarletteServer
+
+logger = logging.getLogger()
+
+
+class BlockingModel():
+    def slow(self, seconds: float = 0.3):
+        time.sleep(seconds)
+        return mlchain_context.MLCHAIN_CONTEXT_ID
+
+    def pid(self):
+        return os.getpid()
+
+    async def tick(self):
+        return 'tick'
+
+
+class TestExecutor(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        logger.info("Running executor test")
+
+    def test_loop_not_blocked(self):
+        serve_model = ServeModel(BlockingModel())
+
+        async def run():
+            mlchain_context['MLCHAIN_CONTEXT_ID'] = 'request'
+            slow = asyncio.ensure_future(serve_model.call_async_function('slow', None))
+            start_time = time.time()
+            assert await serve_model.call_async_function('tick', None) == 'tick'
+            tick_time = time.time() - start_time
+            return await slow, tick_time
+
+        context_id, tick_time = asyncio.run(run())
+        assert tick_time < 0.1
+        assert context_id == 'request'
+        assert serve_model._get_executor_status()['default']['running'] == 0
+
+    def test_queue_bound(self):
+        serve_model = ServeModel(BlockingModel(), executor={
+            'max_workers': 4,
+            'functions': {'slow': {'max_workers': 1, 'max_queue': 1}}
+        })
+
+        async def run():
+            return await asyncio.gather(*[serve_model.call_async_function('slow', None, seconds=0.1)
+                                          for _ in range(3)], return_exceptions=True)
+        outputs = asyncio.run(run())
+        assert sum(isinstance(output, MLChainBusyError) for output in outputs) == 1
+        status = serve_model._get_executor_status()
+        assert status['slow']['max_workers'] == 1
+        assert status['slow']['rejected'] == 1
+
+    def test_process_executor(self):
+        serve_model = ServeModel(BlockingModel(), executor={'type': 'process', 'max_workers': 1})
+        try:
+            assert asyncio.run(serve_model.call_async_function('pid', None)) != os.getpid()
+        finally:
+            serve_model.close()
+
+    def test_server(self):
+        client = TestClient(StarletteServer(ServeModel(BlockingModel()), offload_threshold=1).app)
+        response = client.post('/call/slow', data={'seconds': 0.01})
+        assert response.status_code == 200
+        # The output is encoded off the event loop with the request id of the request
+        assert response.json()['output'] == response.json()['request_id']
+        assert client.get('/api/executors').json()['output']['default']['type'] == 'thread'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import logging
+import os
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from mlchain.base import ServeModel, warmup, batch, limit
+from mlchain.base.exceptions import MLChainNotReadyError
+from mlchain.server.flask_server import FlaskServer
+
+logger = logging.getLogger()
+
+
+class SlowLoadingModel():
+    def __init__(self, load_time=0.0):
+        time.sleep(load_time)
+        self.warmed = []
+
+    @warmup({'image': '[[1, 2], [3, 4]]'})
+    def predict(self, image: np.ndarray):
+        self.warmed.append(image.shape)
+        return float(image.sum())
+
+    def echo(self, text: str):
+        self.warmed.append(text)
+        return text
+
+
+class VersionedModel():
+    generation = 0
+
+    def __init__(self):
+        VersionedModel.generation += 1
+        self.generation = VersionedModel.generation
+
+    @batch(name='slow_version', variables={'texts': str}, variable_names={'texts': 'text'},
+           max_batch_size=4, max_wait_ms=10)
+    def slow_version_batch(self, texts):
+        time.sleep(0.2)
+        return [self.generation for _ in texts]
+
+    def version(self):
+        return self.generation
+
+
+class LimitedModel():
+    @limit(max_concurrency=1)
+    def predict(self, value: int):
+        return value
+
+
+class RelimitedModel():
+    @limit(max_concurrency=3, max_queue=2)
+    def predict(self, value: int):
+        return value * 2
+
+
+class TestLifecycle(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        logger.info("Running lifecycle test")
+
+    def test_warmup(self):
+        serve_model = ServeModel(SlowLoadingModel(), warmup={'echo': [{'text': 'hello'}]})
+        assert sorted(map(str, serve_model.model.warmed)) == ['(2, 2)', 'hello']
+        assert serve_model._check_ready() == 'ready'
+
+        serve_model.warm_up({'echo': [{'text': 'again'}]}, background=True)
+        time.sleep(0.1)
+        assert serve_model.model.warmed[-1] == 'again'
+        assert serve_model._check_ready() == 'ready'
+
+    def test_failed_warmup(self):
+        serve_model = ServeModel(SlowLoadingModel(), warmup={'echo': [{'wrong': 1}]})
+        with self.assertRaises(MLChainNotReadyError):
+            serve_model._check_ready()
+
+    def test_background_load(self):
+        serve_model = ServeModel(None, model_factory=lambda: SlowLoadingModel(0.3), background_load=True)
+        client = FlaskServer(serve_model).app.test_client()
+        assert client.get('/api/ping').status_code == 200
+        assert client.get('/api/ready').status_code == 503
+        response = client.post('/call/echo', data={'text': 'hello'})
+        assert response.status_code == 503
+        assert response.json['code'] == 'not_ready'
+
+        for _ in range(50):
+            if client.get('/api/ready').status_code == 200:
+                break
+            time.sleep(0.05)
+        assert client.get('/api/ready').status_code == 200
+        assert client.post('/call/echo', data={'text': 'hello'}).json['output'] == 'hello'
+
+    def test_swap_model(self):
+        serve_model = ServeModel(None, model_factory=VersionedModel)
+        first = serve_model.call_function('version', None)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            in_flight = pool.submit(serve_model.call_function, 'slow_version', None, text='a')
+            time.sleep(0.05)
+            assert serve_model.swap_model()['generation'] == 1
+            assert serve_model.call_function('version', None) == first + 1
+            # The batch running during the swap finishes on the old instance
+            assert in_flight.result() == first
+        assert serve_model.call_function('slow_version', None, text='b') == first + 1
+
+    def test_swap_model_limits(self):
+        serve_model = ServeModel(LimitedModel())
+        assert serve_model._get_limit_status()['predict']['max_concurrency'] == 1
+        serve_model.swap_model(RelimitedModel())
+        status = serve_model._get_limit_status()['predict']
+        assert status['max_concurrency'] == 3 and status['max_queue'] == 2
+        assert serve_model.call_function('predict', None, value=2) == 4
+
+    def test_swap_model_api(self):
+        serve_model = ServeModel(None, model_factory=VersionedModel)
+        assert FlaskServer(serve_model).app.test_client().post('/api/admin/swap_model').status_code == 404
+
+        os.environ['ADMIN_KEYS'] = 'secret;other'
+        try:
+            client = FlaskServer(serve_model).app.test_client()
+        finally:
+            del os.environ['ADMIN_KEYS']
+        assert client.post('/api/admin/swap_model').status_code == 401
+        response = client.post('/api/admin/swap_model', headers={'x-api-key': 'other'})
+        assert response.status_code == 200
+        assert response.json['output']['generation'] == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+import tempfile
+import unittest
+
+from starlette.testclient import TestClient
+from mlchain.base import ServeModel, batch
+from mlchain.base.metrics import MetricsRegistry, SharedMetrics, render, merge_families
+from mlchain.server.flask_server import FlaskServer
+from mlchain.server.starlette_server import StarletteServer
+
+logger = logging.getLogger()
+
+
+def get_text(response):
+    # Flask and Starlette test clients
+    return response.data.decode() if hasattr(response, 'data') else response.text
+
+
+def get_sample(text, line_start):
+    for line in text.splitlines():
+        if line.startswith(line_start + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return None
+
+
+class MetricModel():
+    def metric_add(self, a: int, b: int = 1):
+        return a + b
+
+    def metric_fail(self):
+        raise ValueError("failed call")
+
+    @batch(name='metric_double', variables={'values': int}, variable_names={'values': 'value'},
+           max_batch_size=4, max_wait_ms=50)
+    def metric_double_batch(self, values):
+        return [value * 2 for value in values]
+
+
+class TestMetrics(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        logger.info("Running metrics test")
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        registry.counter('calls_total', 'Calls', ['function']).inc(function='a')
+        histogram = registry.histogram('latency_seconds', 'Latency', ['function'], buckets=(0.1, 1))
+        histogram.observe(0.05, function='a')
+        histogram.observe(5, function='a')
+        text = render(registry.families())
+        assert '# TYPE latency_seconds histogram' in text
+        assert get_sample(text, 'calls_total{function="a"}') == 1
+        assert get_sample(text, 'latency_seconds_bucket{function="a",le="0.1"}') == 1
+        assert get_sample(text, 'latency_seconds_bucket{function="a",le="1.0"}') == 1
+        assert get_sample(text, 'latency_seconds_bucket{function="a",le="+Inf"}') == 2
+        assert get_sample(text, 'latency_seconds_count{function="a"}') == 2
+
+    def test_flask(self):
+        client = FlaskServer(ServeModel(MetricModel())).app.test_client()
+        before = get_text(client.get('/api/metrics'))
+        client.post('/call/metric_add', data={'a': 1})
+        client.post('/call/metric_add', data={'a': 'x'})
+        client.post('/call/metric_fail')
+        client.post('/call/not_served_function')
+        text = get_text(client.get('/api/metrics'))
+
+        def delta(line_start):
+            return get_sample(text, line_start) - (get_sample(before, line_start) or 0)
+        assert delta('mlchain_requests_total{model="",function="metric_add",status="200"}') == 1
+        assert delta('mlchain_requests_total{model="",function="metric_fail",status="500"}') == 1
+        assert 'function="not_served_function"' not in text
+        assert get_sample(text, 'mlchain_request_stage_seconds_count{model="",function="metric_add",stage="execute"}')
+        assert get_sample(text, 'mlchain_request_stage_seconds_count{model="",function="metric_add",stage="serialize"}')
+        assert get_sample(text, 'mlchain_requests_in_flight{model="",function="metric_add"}') == 0
+
+    def test_starlette(self):
+        client = TestClient(StarletteServer(ServeModel(MetricModel())).app)
+        assert client.post('/call/metric_double', data={'value': 2}).json()['output'] == 4
+        client.post('/call/metric_add', data={'a': 1})
+        text = client.get('/api/metrics').text
+        assert get_sample(text, 'mlchain_batch_size_count{function="metric_double"}') >= 1
+        assert get_sample(text, 'mlchain_batch_queue_depth{model="",function="metric_double"}') == 0
+        assert get_sample(text, 'mlchain_executor_workers{model="",executor="default"}') >= 1
+        assert get_sample(text, 'mlchain_executor_saturation{model="",executor="default"}') == 0
+
+    def test_shared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            registry = MetricsRegistry()
+            registry.counter('calls_total', 'Calls').inc(2)
+            registry.gauge('in_flight', 'In flight').inc(1)
+            shared = SharedMetrics(directory, registry.families)
+            worker = MetricsRegistry()
+            worker.counter('calls_total', 'Calls').inc(3)
+            worker.gauge('in_flight', 'In flight').inc(5)
+            # A live worker and one that exited
+            for pid in [os.getppid(), 2 ** 22 + 1]:
+                with open(os.path.join(directory, 'metrics-{0}.json'.format(pid)), 'w') as f:
+                    json.dump({'pid': pid, 'families': worker.families()}, f)
+            text = render(shared.families())
+            assert get_sample(text, 'calls_total') == 8
+            assert get_sample(text, 'in_flight') == 6
+            # The exited worker is folded into the retired file, its counters stay in the totals
+            dead_path = os.path.join(directory, 'metrics-{0}.json'.format(2 ** 22 + 1))
+            assert not os.path.exists(dead_path)
+            assert os.path.exists(os.path.join(directory, 'retired.json'))
+            text = render(shared.families())
+            assert get_sample(text, 'calls_total') == 8
+            assert get_sample(text, 'in_flight') == 6
+            # Snapshots are keyed by pid and a per-process id, a reused pid doesn't replace them
+            own = [name for name in os.listdir(directory) if name.startswith('metrics-{0}-'.format(os.getpid()))]
+            assert len(own) == 1
+
+        merged = merge_families([(True, registry.families()), (False, registry.families())])
+        assert get_sample(render(merged), 'in_flight') == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import time
+import logging
+import threading
+import unittest
+
+from starlette.testclient import TestClient
+from mlchain.base import ServeModel
+from mlchain.server.profiler import SamplingProfiler
+from mlchain.server.flask_server import FlaskServer
+from mlchain.server.starlette_server import StarletteServer
+
+logger = logging.getLogger()
+
+
+class ProfiledModel():
+    def ping(self):
+        return 'pong'
+
+
+def spin_model_code(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(range(100))
+
+
+def build_client(server_class):
+    os.environ['ADMIN_KEYS'] = 'secret'
+    try:
+        server = server_class(ServeModel(ProfiledModel()))
+    finally:
+        del os.environ['ADMIN_KEYS']
+    if server_class is FlaskServer:
+        return server.app.test_client()
+    return TestClient(server.app)
+
+
+class TestProfiler(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        logger.info("Running profiler test")
+
+    def test_sample(self):
+        thread = threading.Thread(target=spin_model_code, args=(0.5,), name='busy worker')
+        thread.start()
+        stacks, duration = SamplingProfiler().sample(0.2, rate=200)
+        thread.join()
+        assert 0.15 < duration < 0.5
+        assert threading.current_thread().name not in stacks
+        assert any(key[0] == 'spin_model_code' for stack in stacks['busy worker'] for key in stack)
+
+    def test_admin_only(self):
+        assert FlaskServer(ServeModel(ProfiledModel())).app.test_client().get(
+            '/api/admin/profile').status_code == 404
+        for client in [build_client(FlaskServer), build_client(StarletteServer)]:
+            assert client.get('/api/admin/profile?seconds=0.1').status_code == 401
+            response = client.get('/api/admin/profile?seconds=1000', headers={'x-api-key': 'secret'})
+            assert response.status_code == 400
+
+    def test_flask_collapsed(self):
+        client = build_client(FlaskServer)
+        thread = threading.Thread(target=spin_model_code, args=(0.5,), name='busy worker')
+        thread.start()
+        response = client.get('/api/admin/profile?seconds=0.2', headers={'x-api-key': 'secret'})
+        thread.join()
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        lines = [line for line in response.data.decode().splitlines() if line.startswith('busy_worker;')]
+        assert any('spin_model_code (test_profiler.py:' in line for line in lines)
+        assert all(int(line.rsplit(' ', 1)[1]) > 0 for line in lines)
+
+    def test_starlette_speedscope(self):
+        client = build_client(StarletteServer)
+        thread = threading.Thread(target=spin_model_code, args=(0.5,), name='busy worker')
+        thread.start()
+        response = client.get('/api/admin/profile?seconds=0.2&format=speedscope&rate=200',
+                              headers={'x-api-key': 'secret'})
+        thread.join()
+        assert response.status_code == 200
+        profile = response.json()
+        frames = profile['shared']['frames']
+        busy = [item for item in profile['profiles'] if item['name'] == 'busy worker'][0]
+        assert busy['type'] == 'sampled' and len(busy['samples']) == len(busy['weights'])
+        assert any(frames[index]['name'] == 'spin_model_code' for sample in busy['samples'] for index in sample)
+        # The event loop keeps serving while profiling
+        assert client.get('/api/ping').status_code == 200
+
+
+if __name__ == '__main__':
+    unittest.main()
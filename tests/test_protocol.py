@@ -0,0 +1,106 @@
+import logging
+import threading
+import unittest
+
+import numpy as np
+from werkzeug.serving import make_server
+from starlette.testclient import TestClient
+from mlchain.base import ServeModel
+from mlchain.base.serializer import MsgpackSerializer, JsonSerializer
+from mlchain.base.stream import encode_frames, decode_frames
+from mlchain.client import HttpClient
+from mlchain.server.flask_server import FlaskServer
+from mlchain.server.starlette_server import StarletteServer
+
+logger = logging.getLogger()
+
+
+def get_content(response):
+    # Flask and Starlette test clients
+    return response.data if hasattr(response, 'data') else response.content
+
+
+def get_json(response):
+    return JsonSerializer().decode(get_content(response))
+
+
+class ProtocolModel():
+    def add(self, a: int, b: int = 1):
+        return a + b
+
+    def size(self, data: bytes, scale: int = 1):
+        return len(data) * scale
+
+    def total(self, image: np.ndarray):
+        return int(image.sum())
+
+    def kind(self, data):
+        return type(data).__name__
+
+
+class TestProtocol(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        logger.info("Running protocol test")
+
+    def clients(self):
+        return [FlaskServer(ServeModel(ProtocolModel())).app.test_client(),
+                TestClient(StarletteServer(ServeModel(ProtocolModel())).app)]
+
+    def test_json_body(self):
+        for client in self.clients():
+            # A plain JSON body, like curl -d '{"a": 2}'
+            response = client.post('/call/add?b=5', data='{"a": 2}', headers={'Content-Type': 'application/json'})
+            assert response.status_code == 200
+            assert get_json(response)['output'] == 7
+            response = client.post('/call/add', data='[[2], {"b": 3}]', headers={'Content-Type': 'application/json'})
+            assert get_json(response)['output'] == 5
+
+    def test_msgpack_body(self):
+        serializer = MsgpackSerializer()
+        body = serializer.encode([[], {'image': np.ones((2, 3), dtype=np.uint8)}])
+        for client in self.clients():
+            response = client.post('/call/total', data=body, headers={'Content-Type': 'application/msgpack',
+                                                                       'mlchain-serializer': 'msgpack'})
+            assert response.status_code == 200
+            assert serializer.decode(get_content(response))['output'] == 6
+
+    def test_attachments(self):
+        serializer = JsonSerializer()
+        body = encode_frames([serializer.encode([['__attachment__0'], {'scale': 2}]), b'\x00' * 10])
+        for client in self.clients():
+            response = client.post('/call/size', data=body, headers={'Content-Type': 'application/mlchain-attachments',
+                                                                      'mlchain-serializer': 'json'})
+            assert get_json(response)['output'] == 20
+            response = client.post('/call/size', data=body[:-1], headers={'Content-Type': 'application/mlchain-attachments'})
+            assert response.status_code == 422
+            # A parameter without type gets bytes, not a view of the body
+            kind_body = encode_frames([serializer.encode([['__attachment__0'], {}]), b'\x00'])
+            response = client.post('/call/kind', data=kind_body, headers={'Content-Type': 'application/mlchain-attachments'})
+            assert get_json(response)['output'] == 'bytes'
+
+    def test_decode_frames(self):
+        body = encode_frames([b'params', b'\x01' * 5])
+        frames = decode_frames(body)
+        assert all(isinstance(frame, memoryview) for frame in frames)
+        assert frames[1].obj is body and frames[1] == b'\x01' * 5
+
+    def test_client(self):
+        server = make_server('127.0.0.1', 0, FlaskServer(ServeModel(ProtocolModel())).app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            address = '127.0.0.1:{0}'.format(server.server_port)
+            for serializer in ['json', 'msgpack']:
+                model = HttpClient(api_address=address, serializer=serializer, headers={}, multipart=False)
+                assert model.size(b'\x00' * 1000, scale=3) == 3000
+                assert model.add(1, b=2) == 3
+            # Multipart forms by default, which servers without single-body calls accept too
+            model = HttpClient(api_address=address, serializer='json', headers={})
+            assert model.multipart
+            assert model.size(b'\x00' * 10) == 10
+        finally:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
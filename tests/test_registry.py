@@ -0,0 +1,126 @@
+import logging
+import unittest
+
+import numpy as np
+from mlchain.base import ModelRegistry, ServeModel
+from mlchain.base.exceptions import MlChainError, MLChain404Error
+from mlchain.server.flask_server import FlaskServer
+from starlette.testclient import TestClient
+from mlchain.server.starlette_server import StarletteServer
+
+logger = logging.getLogger()
+
+
+class ScaleModel():
+    def __init__(self, scale):
+        self.scale = scale
+
+    def predict(self, value: float):
+        return value * self.scale
+
+    async def async_predict(self, value: float):
+        return value * self.scale
+
+    def multiples(self, count: int = 3):
+        for i in range(count):
+            yield i * self.scale
+
+
+def build_registry(memory_budget=None):
+    registry = ModelRegistry(memory_budget=memory_budget)
+    registry.register('double', lambda: ScaleModel(2), memory=100)
+    registry.register('triple', lambda: ScaleModel(3), memory=100)
+    registry.register('ten', lambda: ServeModel(ScaleModel(10)), memory=100)
+    return registry
+
+
+class TestRegistry(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        logger.info("Running model registry test")
+
+    def test_lazy_load_and_lru(self):
+        registry = build_registry(memory_budget=250)
+        assert not any(model['loaded'] for model in registry.status()['models'].values())
+
+        assert registry.load('double').call_function('predict', None, value=1) == 2
+        registry.load('triple')
+        registry.load('double')
+        # triple is the least recently used one
+        registry.load('ten')
+        status = registry.status()
+        assert status['memory'] == 200
+        assert status['models']['double']['loaded']
+        assert not status['models']['triple']['loaded']
+        assert status['models']['triple']['evictions'] == 1
+        assert status['models']['double']['loads'] == 1
+
+    def test_in_use_not_evicted(self):
+        registry = build_registry(memory_budget=100)
+        serve_model = registry.acquire('double')
+        registry.load('triple')
+        # double is the least recently used one but it's still in use
+        status = registry.status()
+        assert status['models']['double']['loaded']
+        assert not status['models']['triple']['loaded']
+        assert serve_model.call_function('predict', None, value=2) == 4
+        registry.release('double')
+        assert registry.status()['memory'] == 100
+
+    def test_evict_in_use(self):
+        registry = build_registry()
+        serve_model = registry.acquire('double')
+        # The call in flight keeps the model, it is evicted on release
+        assert not registry.evict('double')
+        assert registry.status()['models']['double']['evict_pending']
+        assert serve_model.call_function('predict', None, value=2) == 4
+        registry.release('double')
+        status = registry.status()['models']['double']
+        assert not status['loaded'] and not status['evict_pending'] and status['evictions'] == 1
+        registry.load('double')
+        assert registry.evict('double')
+
+    def test_errors(self):
+        registry = build_registry()
+        registry.register('broken', lambda: 1 / 0)
+        with self.assertRaises(MLChain404Error):
+            registry.acquire('unknown')
+        with self.assertRaises(MlChainError):
+            registry.acquire('broken')
+        assert registry.status()['models']['broken']['load_errors'] == 1
+        assert registry.status()['models']['broken']['in_use'] == 0
+
+    def test_server(self):
+        flask_client = FlaskServer(build_registry()).app.test_client()
+        starlette_client = TestClient(StarletteServer(build_registry()).app)
+        for client in [flask_client, starlette_client]:
+            response = client.post('/models/triple/call/predict', data={'value': 2})
+            assert response.status_code == 200
+            response = client.post('/models/ten/call/predict', data={'value': 2})
+            assert response.status_code == 200
+            assert client.post('/models/unknown/call/predict', data={'value': 2}).status_code == 404
+            assert client.post('/call/predict', data={'value': 2}).status_code == 404
+            assert client.get('/api/models').status_code == 200
+        assert flask_client.post('/models/triple/call/predict', data={'value': 2}).json['output'] == 6
+        response = starlette_client.post('/models/ten/call/async_predict', data={'value': 2})
+        assert response.json()['output'] == 20
+        assert starlette_client.get('/api/models').json()['output']['models']['ten']['calls'] == 2
+
+    def test_stream_in_use(self):
+        registry = build_registry()
+        client = FlaskServer(registry).app.test_client()
+        response = client.post('/models/double/call/multiples', data={'count': 3}, buffered=False)
+        # The hosted model can't be evicted while its stream is sent
+        assert registry.status()['models']['double']['in_use'] == 1
+        assert b''.join(response.response).count(b'output') == 3
+        response.close()
+        assert registry.status()['models']['double']['in_use'] == 0
+
+    def test_server_with_model(self):
+        client = FlaskServer(ScaleModel(1), models=build_registry()).app.test_client()
+        assert client.post('/call/predict', data={'value': 2}).json['output'] == 2
+        assert client.post('/models/double/call/predict', data={'value': 2}).json['output'] == 4
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import logging
+import threading
+import unittest
+
+from werkzeug.serving import make_server
+from starlette.testclient import TestClient
+from mlchain.base import ServeModel
+from mlchain.base.exceptions import MlChainError
+from mlchain.base.serializer import JsonSerializer, MsgpackSerializer
+from mlchain.base.stream import FrameDecoder, encode_frame
+from mlchain.client import HttpClient
+from mlchain.server.flask_server import FlaskServer
+from mlchain.server.starlette_server import StarletteServer
+
+logger = logging.getLogger()
+
+
+class StreamModel():
+    def tokens(self, n: int = 3):
+        for i in range(n):
+            yield 'token{0}'.format(i)
+
+    def broken(self):
+        yield 'first'
+        raise ValueError("broken stream")
+
+    async def async_tokens(self, n: int = 3):
+        for i in range(n):
+            yield i
+
+    def single(self):
+        return 'single'
+
+
+def decode_frames(content, serializer):
+    decoder = FrameDecoder()
+    frames = [serializer.decode(payload) for payload in decoder.feed(content)]
+    decoder.close()
+    return frames
+
+
+class TestStream(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        logger.info("Running stream test")
+
+    def test_frame_decoder(self):
+        decoder = FrameDecoder()
+        data = encode_frame(b'abc') + encode_frame(b'') + encode_frame(b'defg')
+        payloads = []
+        for i in range(0, len(data), 3):
+            payloads.extend(decoder.feed(data[i:i + 3]))
+        decoder.close()
+        assert payloads == [b'abc', b'', b'defg']
+        decoder.feed(b'\x00\x00')
+        self.assertRaises(ValueError, decoder.close)
+
+    def test_flask_frames(self):
+        client = FlaskServer(ServeModel(StreamModel())).app.test_client()
+        response = client.post('/call/tokens', data={'n': 2}, headers={'mlchain-serializer': 'msgpack'})
+        assert response.status_code == 200
+        assert response.headers['response-type'] == 'mlchain/stream'
+        frames = decode_frames(response.data, MsgpackSerializer())
+        assert frames == [{'output': 'token0'}, {'output': 'token1'}]
+
+        response = client.post('/call/broken')
+        frames = decode_frames(response.data, JsonSerializer())
+        assert frames[0] == {'output': 'first'}
+        assert 'broken stream' in frames[1]['error']
+
+    def test_starlette_events(self):
+        client = TestClient(StarletteServer(ServeModel(StreamModel())).app)
+        response = client.post('/call/async_tokens', data={'n': 2}, headers={'Accept': 'text/event-stream'})
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/event-stream')
+        events = [event for event in response.text.split('\n\n') if event]
+        assert events == ['data: {"output": 0}', 'data: {"output": 1}', 'event: end\ndata: {}']
+
+        response = client.post('/call/tokens', data={'n': 2})
+        frames = decode_frames(response.content, JsonSerializer())
+        assert frames == [{'output': 'token0'}, {'output': 'token1'}]
+
+    def test_client_stream(self):
+        server = make_server('127.0.0.1', 0, FlaskServer(ServeModel(StreamModel())).app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            model = HttpClient(api_address='127.0.0.1:{0}'.format(server.server_port), serializer='msgpack',
+                               headers={})
+            assert list(model.tokens.stream(n=3)) == ['token0', 'token1', 'token2']
+            assert model.tokens(n=2) == ['token0', 'token1']
+            assert list(model.single.stream()) == ['single']
+            outputs = model.broken.stream()
+            assert next(outputs) == 'first'
+            self.assertRaises(MlChainError, next, outputs)
+        finally:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import time
+import logging
+import unittest
+from unittest import mock
+
+from starlette.testclient import TestClient
+from mlchain import mlchain_context
+from mlchain.base import ServeModel, batch
+from mlchain.server import tracing
+from mlchain.server.tracing import RequestTracer
+from mlchain.server.flask_server import FlaskServer
+from mlchain.server.starlette_server import StarletteServer
+
+logger = logging.getLogger()
+
+
+class ContextModel():
+    def context(self):
+        return {key: value for key, value in mlchain_context.to_dict().items()
+                if isinstance(value, str)}
+
+
+class TimedModel():
+    def timed(self, value: int):
+        with mlchain_context.timer('preprocess'):
+            time.sleep(0.01)
+        with mlchain_context.timer('preprocess'):
+            time.sleep(0.01)
+        return value
+
+    @batch(name='double', variables={'values': int}, variable_names={'values': 'value'},
+           max_batch_size=4, max_wait_ms=20)
+    def double_batch(self, values):
+        return [value * 2 for value in values]
+
+
+def parse_server_timing(header):
+    spans = {}
+    for span in header.split(', '):
+        name, duration = span.split(';dur=')
+        spans[name] = float(duration)
+    return spans
+
+
+class TestTracing(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        logger.info("Running tracing test")
+
+    def test_request_ids(self):
+        tracer = RequestTracer(lean=True)
+        first, second = tracer.new_request_id(), tracer.new_request_id()
+        assert first != second
+        assert first.rsplit('-', 1)[0] == second.rsplit('-', 1)[0]
+        assert int(second.rsplit('-', 1)[1], 16) > int(first.rsplit('-', 1)[1], 16)
+        assert len(RequestTracer().new_request_id()) == 36
+
+    def test_sampling(self):
+        with mock.patch.object(tracing, 'push_scope') as push_scope:
+            with RequestTracer(lean=True, sample_rate=0).trace('noop') as scope:
+                assert scope is None
+            assert not push_scope.called
+        tracer = RequestTracer(lean=True, sample_rate=1)
+        with tracer.trace('noop') as scope:
+            assert scope is not None
+
+    def test_lean_context(self):
+        headers = {'mlchain-context-user': 'alice', 'User-Agent': 'test'}
+        for lean in [False, True]:
+            for client in [FlaskServer(ServeModel(ContextModel()), lean=lean).app.test_client(),
+                           TestClient(StarletteServer(ServeModel(ContextModel()), lean=lean).app)]:
+                response = client.post('/call/context', headers=headers)
+                context = response.json if hasattr(response, 'data') else response.json()
+                context = context['output']
+                assert context['MLCHAIN_CONTEXT_USER'] == 'alice'
+                assert context['MLCHAIN_CONTEXT_ID'] == response.headers['request_id']
+                assert ('User-Agent' in context or 'user-agent' in context) == (not lean)
+
+    def test_server_timing(self):
+        for client in [FlaskServer(ServeModel(TimedModel())).app.test_client(),
+                       TestClient(StarletteServer(ServeModel(TimedModel())).app)]:
+            response = client.post('/call/timed', data={'value': 3})
+            body = response.json if hasattr(response, 'data') else response.json()
+            spans = parse_server_timing(response.headers['Server-Timing'])
+            assert list(spans) == ['parse', 'convert', 'execute', 'preprocess', 'serialize']
+            assert 20 <= spans['preprocess'] <= spans['execute']
+            assert body['output'] == 3 and 'timings' not in body
+
+            response = client.post('/call/double', data={'value': 2}, headers={'mlchain-timings': 'true'})
+            body = response.json if hasattr(response, 'data') else response.json()
+            spans = parse_server_timing(response.headers['Server-Timing'])
+            assert {'queue', 'batch'} <= set(spans)
+            assert spans['queue'] >= 15
+            assert set(body['timings']) == set(spans) - {'serialize'}
+
+
+if __name__ == '__main__':
+    unittest.main()
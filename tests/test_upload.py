@@ -0,0 +1,94 @@
+import logging
+import os
+import tempfile
+import threading
+import unittest
+from io import BytesIO, IOBase
+from pathlib import Path
+from typing import BinaryIO
+
+from werkzeug.serving import make_server
+from starlette.testclient import TestClient
+from mlchain.base import ServeModel, max_content_length
+from mlchain.base.uploads import SPOOL_MAX_SIZE
+from mlchain.client import HttpClient
+from mlchain.server.flask_server import FlaskServer
+from mlchain.server.starlette_server import StarletteServer
+
+logger = logging.getLogger()
+
+
+class UploadModel():
+    def path(self, video: Path):
+        assert isinstance(video, Path)
+        return [str(video), video.stat().st_size, video.read_bytes()[:4].decode()]
+
+    def handle(self, video: BinaryIO):
+        assert isinstance(video, IOBase) or hasattr(video, 'read')
+        return len(video.read())
+
+    def raw(self, video):
+        return len(video) if isinstance(video, bytes) else type(video).__name__
+
+    @max_content_length(1024)
+    def small(self, data: bytes):
+        return len(data)
+
+
+class TestUpload(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        logger.info("Running upload test")
+
+    def test_flask_path(self):
+        client = FlaskServer(ServeModel(UploadModel())).app.test_client()
+        content = b'head' + b'0' * (SPOOL_MAX_SIZE + 10)
+        response = client.post('/call/path', data={'video': (BytesIO(content), 'video.mp4')})
+        name, size, head = response.json['output']
+        # A large upload is parsed into a named temporary file given as is, deleted after the request
+        assert size == len(content) and head == 'head'
+        assert not os.path.exists(name)
+
+        response = client.post('/call/handle', data={'video': (BytesIO(b'abc'), 'video.mp4')})
+        assert response.json['output'] == 3
+
+    def test_starlette_path(self):
+        client = TestClient(StarletteServer(ServeModel(UploadModel())).app)
+        response = client.post('/call/path', files={'video': ('video.mp4', b'head0000')})
+        name, size, head = response.json()['output']
+        assert size == 8 and head == 'head' and name.endswith('.mp4')
+        response = client.post('/call/handle', files={'video': ('video.mp4', b'abc')})
+        assert response.json()['output'] == 3
+
+    def test_max_content_length(self):
+        for client in [FlaskServer(ServeModel(UploadModel())).app.test_client(),
+                       TestClient(StarletteServer(ServeModel(UploadModel())).app)]:
+            response = client.post('/call/small', data={'data': 'a' * 2048})
+            assert response.status_code == 413
+            response = client.post('/call/small', data={'data': 'a' * 10})
+            assert response.status_code == 200
+
+        serve_model = ServeModel(UploadModel(), max_content_lengths={'path': 10})
+        client = FlaskServer(serve_model).app.test_client()
+        response = client.post('/call/path', data={'video': (BytesIO(b'0' * 100), 'video.mp4')})
+        assert response.status_code == 413
+
+    def test_client_files(self):
+        server = make_server('127.0.0.1', 0, FlaskServer(ServeModel(UploadModel())).app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            model = HttpClient(api_address='127.0.0.1:{0}'.format(server.server_port), headers={})
+            with tempfile.NamedTemporaryFile(suffix='.mp4') as f:
+                f.write(b'head' + b'0' * 100)
+                f.flush()
+                assert model.path(Path(f.name))[1] == 104
+                f.seek(0)
+                assert model.handle(f) == 104
+            # Parameters without annotation still get the bytes sent by the client
+            assert model.raw(b'abc') == 3
+        finally:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import socket
+import threading
+import time
+import unittest
+
+import numpy as np
+import uvicorn
+from starlette.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+from mlchain.base import ServeModel, max_content_length
+from mlchain.base.exceptions import MlChainError
+from mlchain.base.serializer import MsgpackSerializer, JsonSerializer
+from mlchain.client import WebSocketClient
+from mlchain.server.authentication import Authentication
+from mlchain.server.starlette_server import StarletteServer
+
+logger = logging.getLogger()
+
+
+class SocketModel():
+    async def wait(self, seconds: float = 0.2, name: str = ''):
+        await asyncio.sleep(seconds)
+        return name
+
+    def add(self, a: int, b: int = 1):
+        return a + b
+
+    def norm(self, image: np.ndarray):
+        return float(np.linalg.norm(image))
+
+    def fail(self):
+        raise ValueError("failed call")
+
+    @max_content_length(100)
+    def small(self, data: bytes):
+        return len(data)
+
+
+def get_sample(text, line_start):
+    for line in text.splitlines():
+        if line.startswith(line_start + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return None
+
+
+class TestWebSocket(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        logger.info("Running websocket test")
+
+    def test_concurrent_calls(self):
+        serializer = MsgpackSerializer()
+        client = TestClient(StarletteServer(ServeModel(SocketModel())).app)
+        with client.websocket_connect('/ws/call') as websocket:
+            websocket.send_bytes(serializer.encode({'id': 1, 'function': 'wait', 'kwargs': {'name': 'slow'}}))
+            websocket.send_bytes(serializer.encode({'id': 2, 'function': 'add', 'args': ['2'], 'kwargs': {'b': 3}}))
+            websocket.send_bytes(serializer.encode({'id': 3, 'function': 'fail'}))
+            replies = [serializer.decode(websocket.receive_bytes()) for _ in range(3)]
+        # The slow call doesn't hold back the others
+        assert [reply['id'] for reply in replies] == [2, 3, 1]
+        assert replies[0]['output'] == 5
+        assert 'failed call' in replies[1]['error']
+        assert replies[2]['output'] == 'slow'
+
+        with client.websocket_connect('/ws/call') as websocket:
+            websocket.send_text('{"id": "a", "function": "add", "kwargs": {"a": 1}}')
+            assert JsonSerializer().decode(websocket.receive_text().encode())['output'] == 2
+
+    def test_backpressure(self):
+        serializer = MsgpackSerializer()
+        client = TestClient(StarletteServer(ServeModel(SocketModel()), ws_max_inflight=1).app)
+        with client.websocket_connect('/ws/call') as websocket:
+            websocket.send_bytes(serializer.encode({'id': 1, 'function': 'wait', 'kwargs': {'seconds': 0.2}}))
+            websocket.send_bytes(serializer.encode({'id': 2, 'function': 'add', 'kwargs': {'a': 1}}))
+            replies = [serializer.decode(websocket.receive_bytes()) for _ in range(2)]
+        # The second call is read once the first replied
+        assert [reply['id'] for reply in replies] == [1, 2]
+
+    def test_metrics(self):
+        serializer = MsgpackSerializer()
+        client = TestClient(StarletteServer(ServeModel(SocketModel())).app)
+        before = client.get('/api/metrics').text
+        with client.websocket_connect('/ws/call') as websocket:
+            websocket.send_bytes(serializer.encode({'id': 1, 'function': 'add', 'kwargs': {'a': 1}}))
+            assert serializer.decode(websocket.receive_bytes())['output'] == 2
+            websocket.send_bytes(serializer.encode({'id': 2, 'function': 'fail'}))
+            assert 'failed call' in serializer.decode(websocket.receive_bytes())['error']
+            websocket.send_bytes(serializer.encode({'id': 3, 'function': 'small', 'kwargs': {'data': b'\x00' * 200}}))
+            assert serializer.decode(websocket.receive_bytes())['code'] == 'too_large'
+        text = client.get('/api/metrics').text
+
+        def delta(line_start):
+            return get_sample(text, line_start) - (get_sample(before, line_start) or 0)
+        assert delta('mlchain_requests_total{model="",function="add",status="200"}') == 1
+        assert delta('mlchain_requests_total{model="",function="fail",status="500"}') == 1
+        assert delta('mlchain_requests_total{model="",function="small",status="413"}') == 1
+        for stage in ['parse', 'convert', 'execute', 'serialize']:
+            assert delta('mlchain_request_stage_seconds_count{{model="",function="add",stage="{0}"}}'.format(stage)) == 1
+        assert get_sample(text, 'mlchain_requests_in_flight{model="",function="add"}') == 0
+
+    def test_authentication(self):
+        server = StarletteServer(ServeModel(SocketModel()), authentication=Authentication(['key']))
+        client = TestClient(server.app)
+        with client.websocket_connect('/ws/call', headers={'api-key': 'key'}) as websocket:
+            websocket.send_bytes(MsgpackSerializer().encode({'id': 1, 'function': 'add', 'kwargs': {'a': 1}}))
+            assert MsgpackSerializer().decode(websocket.receive_bytes())['output'] == 2
+        with self.assertRaises(WebSocketDisconnect):
+            with client.websocket_connect('/ws/call'):
+                pass
+        assert client.post('/call/add', data={'a': 1}).status_code == 401
+
+    def test_client(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        server = uvicorn.Server(uvicorn.Config(StarletteServer(ServeModel(SocketModel())).app,
+                                               host='127.0.0.1', port=port, log_level='warning'))
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            time.sleep(0.01)
+        try:
+            with WebSocketClient(api_address='127.0.0.1:{0}'.format(port)) as model:
+                assert model.add(1, b=2) == 3
+                assert model.norm(np.ones((2, 2))) == 2.0
+                self.assertRaises(MlChainError, model.fail)
+
+                outputs = {}
+
+                def call(i):
+                    outputs[i] = model.wait(seconds=0.2, name=str(i))
+                threads = [threading.Thread(target=call, args=(i,)) for i in range(5)]
+                start_time = time.time()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                # The calls of all threads share the socket and run at once
+                assert time.time() - start_time < 0.8
+                assert outputs == {i: str(i) for i in range(5)}
+        finally:
+            server.should_exit = True
+
+
+if __name__ == '__main__':
+    unittest.main()